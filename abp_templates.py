@@ -13,6 +13,10 @@ This is meant to be used as a quick reference to determine if a segment is suita
 
 We still use biosppy.signals.ecg for R peak detection
 
+TemplateView draws all beats of a segment with one multi_line glyph plus a median and 5-95 percentile envelope
+computed in one vectorized pass over the (beats x samples) template matrix, so the number of renderers does not
+grow with the number of beats. It is used for the current segment on the Waveforms tab of wf_explore.py.
+
 """
 
 import pandas as pd
@@ -23,7 +27,9 @@ from biosppy.signals import ecg
 from bokeh.plotting import figure 
 from bokeh.io import output_file, show
 from bokeh.layouts import column
-from bokeh.models import ColumnDataSource
+from bokeh.models import ColumnDataSource, Band
+
+envelope_pct = [5, 50, 95]
 
 def _extract_heartbeats(signal=None, rpeaks=None, before=200, after=400):
 # taken from biosppy.signals.ecg
@@ -122,13 +128,67 @@ def extract_heartbeats(signal=None, rpeaks=None, sampling_rate=240.,
 
 def abp_templates (wf, seg_num):
     abp=wf.segments[seg_num]['ABP']
-    ecg_s=wf.chan_slice(['II'],seg_num).values.reshape(1,6400)[0]
-    (ts, filtered, rpeaks, templates_ts, templates, HR_ts, HR)=ecg.ecg(ecg_s, sampling_rate=240., show=False)
-    templates = extract_heartbeats(signal=abp, rpeaks=rpeaks, sampling_rate=240., before=0.0, after=0.8)
+    ecg_s=wf.chan_slice(['II'],seg_num).values.ravel()
+    (ts, filtered, rpeaks, templates_ts, templates, HR_ts, HR)=ecg.ecg(ecg_s, sampling_rate=float(wf.Fs), show=False)
+    templates = extract_heartbeats(signal=abp, rpeaks=rpeaks, sampling_rate=float(wf.Fs), before=0.0, after=0.8)
     ts = np.linspace(0,(abp.index[-1]-abp.index[0]).total_seconds()/len(templates[0]),num=len(templates[1]))
 
     return templates, ts
 
+def beat_matrix (signal, rpeaks, before, after):
+    # vectorized _extract_heartbeats: (beats x before+after) array of the beats that fit inside the signal
+    signal = np.asarray(signal)
+    R = np.sort(np.asarray(rpeaks, dtype=int))
+    R = R[(R - before >= 0) & (R + after <= len(signal))]
+    return signal[R[:, None] + np.arange(-before, after)[None, :]]
+
+def segment_templates (seg, wave_chan, ecg_chan='II', sampling_rate=240., before=0.0, after=0.8):
+    # beats of wave_chan in a segment DataFrame (any length) aligned on the R-peaks of ecg_chan
+    # returns (templates, ts) with ts in seconds relative to the R-peak
+    (ts, filtered, rpeaks, templates_ts, templates, HR_ts, HR) = ecg.ecg(seg[ecg_chan].values, sampling_rate=sampling_rate, show=False)
+    b, a = int(before * sampling_rate), int(after * sampling_rate)
+    templates = beat_matrix(seg[wave_chan].values, rpeaks, b, a)
+    return templates, np.arange(-b, a) / sampling_rate
+
+def envelope (templates):
+    # median and percentile envelope of a template matrix in one call
+    if len(templates) == 0:
+        return {'p{}'.format(q): np.zeros(0) for q in envelope_pct}
+    P = np.nanpercentile(templates, envelope_pct, axis=0)
+    return {'p{}'.format(q): P[i] for i, q in enumerate(envelope_pct)}
+
+
+class TemplateView:
+    # reusable template overlay: one multi_line for the beats, a Band for the 5-95 percentile envelope and a median line
+
+    def __init__ (self, y_axis_label='ABP (mmHg)', plot_width=400, plot_height=400, before=0.0, after=0.8, sampling_rate=240.):
+        self.before = before
+        self.after = after
+        self.sampling_rate = sampling_rate
+        self.beats = ColumnDataSource(data={'xs': [], 'ys': []})
+        self.env = ColumnDataSource(data={'ts': np.zeros(0), 'p5': np.zeros(0), 'p50': np.zeros(0), 'p95': np.zeros(0)})
+        self.figure = figure(x_axis_label='Time (s)', y_axis_label=y_axis_label,
+                             tools=['box_zoom', 'xwheel_zoom', 'pan', 'reset',],
+                             plot_width=plot_width, plot_height=plot_height)
+        self.figure.multi_line(xs='xs', ys='ys', source=self.beats, line_alpha=0.2, line_color='grey')
+        self.figure.add_layout(Band(base='ts', lower='p5', upper='p95', source=self.env, level='underlay',
+                                    fill_alpha=0.3, fill_color='steelblue', line_width=0))
+        self.figure.line(x='ts', y='p50', source=self.env, line_width=2, line_color='navy')
+
+    def update (self, seg, wave_chan, ecg_chan='II', title=None):
+        # show the beats of a segment DataFrame
+        try:
+            templates, ts = segment_templates(seg, wave_chan, ecg_chan, self.sampling_rate, self.before, self.after)
+        except Exception as e:
+            print ('No templates for segment: {}'.format(e))
+            templates, ts = np.zeros((0, 0)), np.zeros(0)
+        self.beats.data = {'xs': [ts] * len(templates), 'ys': [row.astype(np.float32) for row in templates]}
+        env = envelope(templates)
+        env['ts'] = ts if len(templates) else np.zeros(0)
+        self.env.data = env
+        self.figure.title.text = title if title is not None else '{} beats'.format(len(templates))
+        return templates, ts
+
 def main ():
     
     from sys import platform
@@ -144,21 +204,9 @@ def main ():
 
     #plot a good segment
     
-    templates, ts = abp_templates(wf, 2)
-    df = pd.DataFrame(templates).transpose() # store the templates in a single dataframe
-    df.columns = df.columns.astype(str) # Bokeh wants columns to be names as str
-    df['ts']=ts                         # add the time series to the df
-    t_source = ColumnDataSource(df)
-    
-    
-    p_abp_t = figure(x_axis_label='Time (s)', y_axis_label='ABP (mmHg)', 
-                     tools=['box_zoom', 'xwheel_zoom', 'pan', 'reset',],
-                     plot_width=400, plot_height=400, )
-
-    p_abp_t.title.text = 'Bad Segment'
-    
-    for i in range(df.shape[1]-1):
-        p_abp_t.line(x='ts', y=str(i), source=t_source)
+    view = TemplateView()
+    view.update(wf.segments[2], wf.seg_channel, title='Segment 2')
+    p_abp_t = view.figure
     
     output_file('template.html', title='ABP Template')
     layout=column(p_abp_t)
@@ -1,11 +1,16 @@
 % test
-function [onsets, feats, BeatQ, R] = wabp_wrap (py_ABP)
+% py_ABP: ABP samples at Fs Hz (default 240); callers pass 125 Hz data resampled once per record (wf_resample.py)
+function [onsets, feats, BeatQ, R] = wabp_wrap (py_ABP, Fs)
 
     Fwf = 125;
-    Fs  = 240;
+    if nargin < 2
+        Fs = 240;
+    end
     
     ABP = cell2mat(py_ABP)';
-    ABP = resample(ABP,Fwf,Fs);
+    if Fs ~= Fwf
+        ABP = resample(ABP,Fwf,Fs);
+    end
     onsets = wabp(ABP);
     if length (onsets) > 1
         feats  = abpfeature(ABP, onsets);
@@ -22,6 +22,8 @@ To implement:
 
 Classes:
     
+    StageCache: memoized outputs of the Waveform pipeline stages
+    
     ABP_class: superclass with ABP range specified
     CVP_class
     ECG_class
@@ -71,12 +73,70 @@ from matplotlib.backends.backend_pdf import PdfPages
 import seaborn as sns
 import biosppy.signals.ecg as ecg
 import matlab.engine
+import wf_quality
+import wf_meta
+import wf_metrics
+import wf_resample
+import time
 #if 'linux' in platform:
 #    plt.use('Agg')
     
     
 #%matplotlib notebook 
 
+_eng = None
+
+def get_matlab ():
+    # start the MATLAB engine once per process (starting it takes several seconds) and reuse it
+    global _eng
+    if _eng is None:
+        _eng = matlab.engine.start_matlab()
+        _eng.addpath(r'/.');
+        _eng.addpath(r'./WFDB'); 
+    return _eng
+
+def count_bytes (key, df):
+    # bytes of an hdf5 table read into memory (wf_metrics), returned so callers can total their own reads
+    nbytes = int(df.memory_usage(deep=False).sum())
+    wf_metrics.counter('wf_hdf5_bytes_read_total', 'Bytes read from hdf5 tables', key=key).inc(nbytes)
+    return nbytes
+
+class StageCache:
+    # Memoized outputs of the Waveform processing stages: read -> clean -> segment -> quality -> features -> wavelets
+    # Each output is keyed by (stage, parameters) where the parameters include the key of the upstream stage,
+    # so changing eg seg_level recomputes segmentation and everything after it but reuses the cleaned data.
+    # A Waveform and the Wavelet objects derived from it share one cache (see Waveform.share).
+    
+    def __init__ (self):
+        self.store = {}
+        self.hits = 0
+        self.misses = 0
+        
+    def run (self, stage, params, fn, keep=True):
+        # return (key, output) for a stage, calling fn() only if it has not been run with these parameters
+        # keep=False: don't hold on to the output (eg raw reads that the next stage modifies in place)
+        key = (stage,) + tuple(params)
+        if key in self.store:
+            self.hits += 1
+            wf_metrics.counter('wf_stage_cache_total', 'Stage cache lookups', stage=stage, result='hit').inc()
+            print ('Stage {}: using cached result'.format(stage))
+            return key, self.store[key]
+        self.misses += 1
+        wf_metrics.counter('wf_stage_cache_total', 'Stage cache lookups', stage=stage, result='miss').inc()
+        out = fn()
+        if keep:
+            self.store[key] = out
+        return key, out
+    
+    def invalidate (self, stage=None):
+        # drop cached outputs (of one stage, or everything)
+        for key in [k for k in self.store if stage is None or k[0] == stage]:
+            del self.store[key]
+            
+    def stats (self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits/total if total else 0.0}
+
 class ABP_class:
     ABP_hi = 300
     ABP_lo = -10
@@ -104,10 +164,24 @@ class Waveform(ABP_class, CVP_class, ECG_class):
     ABP_cols = ['AR1','AR2','AR3']
     CVP_cols = ['CVP1','CVP2']
     ECG_cols = ['I','II','III','V']
+    HR_lead = 'I'        # ECG lead HR is computed from, and so the lead checked for lead off
 #    SQI_threshold = 0.6  # SQI below this will not be converted to wavelets
+    compact = False      # compact mode: float32 waves, out of range samples kept in a packed bitmap (self.invalid) instead of zeroed
+    invalid = None       # np.packbits of the invalid sample mask along the rows, one column per entry in invalid_cols
+    invalid_cols = []
+    read_chunk = 500000  # rows per chunk when reading in compact mode
     
-    def __init__(self, filename=None, start=0, duration=0, end=0, process=False, level=8, seg_channel = 'ABP'):
+    def __init__(self, filename=None, start=0, duration=0, end=0, process=False, level=8, seg_channel = 'ABP', compact=False):
     # if information is supplied on initialization, read the waveform and vitals from the given file
+        self.compact = compact
+        self.stages = StageCache()
+        self.clean_key = None
+        self.seg_key = None
+        self.quality_key = None
+        self.Fs = wf_meta.default_Fs   # set from the record's metadata when a file is read
+        self.filename = None           # case file and record row of the first sample, when read from a file
+        self.first_row = None
+        self.bytes_read = 0            # bytes of /Waveforms and /Vitals rows this object read from the file
         if filename is not None:
             print ('Initializing and reading from file {}'.format(filename))
             self.read(filename, start, duration, end)
@@ -117,16 +191,18 @@ class Waveform(ABP_class, CVP_class, ECG_class):
         self.features = {}   # wfdb generated features for each segment
         self.seg_SQI = {}    # segment signal quality (array) - use to supress bad data before classification
         self.bad_segments = []
-        self.Fs = 240 # default sample rate- should also set time constant
         self.seg_level = level
         self.seg_start_time = {}
         self.section_size = 0
         self.seg_channel = seg_channel
+        self.reject = None   # pre-screen result per segment (see wf_quality.prescreen)
+        self.rejected = []   # segments failing the pre-screen - expensive features are skipped for these
         
         if process:
         # automate pre-processing, segmentation, etc
             #self.rename_wfs()
             self.segmenter()
+            self.prescreen()
             self.check_times()
             self.wf_features()
     
@@ -138,30 +214,126 @@ class Waveform(ABP_class, CVP_class, ECG_class):
         # how to specify start time?? read as date_time
         # if start is blank - read whole file
         # if duration and end are blank, read from start to the end of the file
+        # read and clean are memoized stages - the raw read isn't kept as clean_wfs modifies it in place
+        read_params = (filename, str(start), duration, str(end))
+        read_key = ('read',) + read_params
+        def clean ():
+            self.waves, self.vitals = self.stages.run('read', read_params + (self.compact,), lambda: self._read(filename, start, duration, end), keep=False)[1]
+            self.clean_wfs()
+            return self.waves, self.vitals, self.invalid
+        clean_params = (read_key, self.compact, ABP_class.ABP_hi, ABP_class.ABP_lo, CVP_class.CVP_hi, CVP_class.CVP_lo, ECG_class.ECG_hi, ECG_class.ECG_lo)
+        self.clean_key, (self.waves, self.vitals, self.invalid) = self.stages.run('clean', clean_params, clean)
+        meta = wf_meta.get_meta(filename)
+        self.set_record(filename, meta.rows_for(self.waves.index[0], self.waves.index[0])[0] if len(self.waves) else 0)
+    
+    def _read (self, filename, start=0, duration=0, end=0):
+        # read stage: returns (waves, vitals) with empty columns dropped
         if start != 0:
             start_time = pd.to_datetime(start)
             if duration != 0:
                 print ('Reading from {} for {} s'.format(start_time, duration))
                 end_time = start_time + pd.to_timedelta(duration, 'S')
-                self.waves = pd.read_hdf(filename,'Waveforms',where='index>start_time & index<end_time')
+                self.waves = self._select(filename,'Waveforms','index>start_time & index<end_time', start_time, end_time)
                 self.vitals = pd.read_hdf(filename,'Vitals',where='index>start_time & index<end_time')
             elif end != 0:
                 end_time = pd.to_datetime(end)
                 print ('Reading from {} to {}'.format(start_time, end_time))
-                self.waves = pd.read_hdf(filename,'Waveforms',where='index>start_time & index<end_time')
+                self.waves = self._select(filename,'Waveforms','index>start_time & index<end_time', start_time, end_time)
                 self.vitals = pd.read_hdf(filename,'Vitals',where='index>start_time & index<end_time')
             else: 
                 print ('Reading from {} to end'.format(start_time))
-                self.waves = pd.read_hdf(filename,'Waveforms',where='index>start_time')
+                self.waves = self._select(filename,'Waveforms','index>start_time', start_time)
                 self.vitals = pd.read_hdf(filename,'Vitals',where='index>start_time')
         else:
             print ('Reading entire file')
-            self.waves = pd.read_hdf(filename,'Waveforms')
+            self.waves = self._select(filename,'Waveforms')
             self.vitals = pd.read_hdf(filename,'Vitals')
         
-        self.waves = self.waves.dropna(axis=1,how='all')
-        self.vitals = self.vitals.dropna(axis=1,how='all')
-        self.clean_wfs()
+        self.bytes_read += count_bytes('Waveforms', self.waves) + count_bytes('Vitals', self.vitals)
+        if len(self.waves):
+            meta = wf_meta.get_meta(filename)
+            self.waves = self.align_rates(filename, self.waves, meta.rows_for(self.waves.index[0], self.waves.index[0])[0])
+        return self.waves.dropna(axis=1,how='all'), self.vitals.dropna(axis=1,how='all')
+    
+    def _select (self, filename, key, where=None, start_time=None, end_time=None):
+        # read a table (start_time / end_time are the names used in the where string)
+        # compact mode reads in chunks and downcasts each one to float32, so the whole table is never held as float64
+        if not self.compact:
+            return pd.read_hdf(filename, key, where=where)
+        chunks = [chunk.astype(np.float32) for chunk in pd.read_hdf(filename, key, where=where, chunksize=Waveform.read_chunk)]
+        if not chunks:
+            return pd.read_hdf(filename, key, where=where).astype(np.float32)
+        return pd.concat(chunks, copy=False)
+    
+    def read_rows (self, filename, start_row, stop_row):
+        # read record rows start_row:stop_row of /Waveforms (row numbers, not times) plus the matching vitals
+        # used for grid anchored segmentation where segments are fixed blocks of record rows
+        read_params = (filename, 'rows', start_row, stop_row, self.compact)
+        def clean ():
+            print ('Reading rows {} to {}'.format(start_row, stop_row))
+            waves = pd.read_hdf(filename, 'Waveforms', start=start_row, stop=stop_row)
+            self.bytes_read += count_bytes('Waveforms', waves)
+            if self.compact:
+                waves = waves.astype(np.float32)
+            start_time = waves.index[0]
+            end_time = waves.index[-1]
+            vitals = pd.read_hdf(filename, 'Vitals', where='index>=start_time & index<=end_time')
+            self.bytes_read += count_bytes('Vitals', vitals)
+            self.waves = self.align_rates(filename, waves, start_row).dropna(axis=1, how='all')
+            self.vitals = vitals.dropna(axis=1, how='all')
+            self.clean_wfs()
+            return self.waves, self.vitals, self.invalid
+        self.clean_key, (self.waves, self.vitals, self.invalid) = self.stages.run('clean', read_params, clean)
+        self.set_record(filename, start_row)
+
+    def set_record (self, filename, first_row):
+        # the record the data was read from: its sample rate, and the record row of the first sample
+        self.filename = filename
+        self.first_row = first_row
+        self.Fs = wf_meta.get_meta(filename).Fs
+
+    def align_rates (self, filename, waves, start_row):
+        # channels recorded slower than the table (FileMeta.channel_Fs) only have a value every few rows; replace
+        # them with their record rate resampling (wf_resample's whole record cache if it has been built, otherwise
+        # converted from the rows read) so every row is a sample
+        meta = wf_meta.get_meta(filename)
+        for chan in waves.columns:
+            chan_Fs = meta.channel_Fs.get(chan, meta.Fs)
+            if chan_Fs != meta.Fs:
+                rs = wf_resample.cached(filename, chan, meta.Fs)
+                if rs is not None:
+                    values = rs.row_values(start_row, start_row + len(waves))
+                else:
+                    values = wf_resample.fill_rows(waves[chan].values, wf_resample.channel_stride(meta, chan), chan_Fs, meta.Fs)
+                waves[chan] = values.astype(waves[chan].dtype)
+        return waves
+
+    def read_frame (self, waves, vitals, key):
+        # use /Waveforms rows already in memory (eg from a live stream, see wf_stream.py) in place of a file read
+        # key identifies the rows in the stage cache (eg (source name, first sample, last sample))
+        def clean ():
+            self.waves = (waves.astype(np.float32) if self.compact else waves.copy()).dropna(axis=1, how='all')
+            self.vitals = vitals
+            self.clean_wfs()
+            return self.waves, self.vitals, self.invalid
+        self.clean_key, (self.waves, self.vitals, self.invalid) = self.stages.run('clean', ('frame',) + tuple(key) + (self.compact,), clean)
+
+    def share (self, other):
+        # use the cleaned data and stage cache of another Waveform (eg to process a second channel
+        # or to build a Wavelet object) so upstream stages are not recomputed
+        self.stages = other.stages
+        self.clean_key = other.clean_key
+        self.waves = other.waves
+        self.vitals = other.vitals
+        self.compact = other.compact
+        self.invalid = other.invalid
+        self.invalid_cols = other.invalid_cols
+        self.Fs = other.Fs
+        self.filename = other.filename
+        self.first_row = other.first_row
+        if self.clean_key is None:
+            # data assigned directly rather than read - identify it by the frame itself
+            self.clean_key = other.clean_key = ('frame', id(other.waves))
     
     def wf_clean (self, channel, high, low):
         # drop rows from the dataframe if ABP in channel is out of range
@@ -172,8 +344,43 @@ class Waveform(ABP_class, CVP_class, ECG_class):
         self.waves = df
         self.waves.fillna(0,inplace=True)  # may want to delete the rows entirely but this will support the classifier
         
+    def clean_compact (self):
+        # compact mode clean: one vectorized range check over all ABP/CVP/ECG channels at once
+        # out of range (and NaN) samples are recorded in a packed bitmap rather than overwritten with zeros;
+        # channel_values() applies the mask when segments are cut. NaNs in the other channels are zeroed.
+        cols = [x for x in self.waves.columns if x in Waveform.ABP_cols + Waveform.CVP_cols + Waveform.ECG_cols]
+        hi = np.array([ABP_class.ABP_hi if x in Waveform.ABP_cols else CVP_class.CVP_hi if x in Waveform.CVP_cols else ECG_class.ECG_hi for x in cols], dtype=np.float32)
+        lo = np.array([ABP_class.ABP_lo if x in Waveform.ABP_cols else CVP_class.CVP_lo if x in Waveform.CVP_cols else ECG_class.ECG_lo for x in cols], dtype=np.float32)
+        X = self.waves[cols].to_numpy(dtype=np.float32)
+        invalid = ~((X < hi) & (X > lo))
+        print ('Clean channels {}: {} samples out of range'.format(', '.join(cols), int(invalid.sum())))
+        self.invalid_cols = cols
+        self.invalid = np.packbits(invalid, axis=0)
+        # the other channels (eg SPO2 for PVI) aren't masked - zero their NaNs as wf_clean's fillna does
+        others = [x for x in self.waves.columns if x not in cols]
+        if others:
+            self.waves[others] = self.waves[others].fillna(0)
+        
+    def invalid_mask (self, chan, start=0, stop=None):
+        # boolean mask of invalid samples in rows start:stop of a channel (all False if the channel isn't masked)
+        stop = len(self.waves) if stop is None else min(stop, len(self.waves))
+        if self.invalid is None or chan not in self.invalid_cols:
+            return np.zeros(stop - start, dtype=bool)
+        b0 = start // 8
+        bits = np.unpackbits(self.invalid[b0:-(-stop // 8), self.invalid_cols.index(chan)])
+        return bits[start - b0*8:stop - b0*8].astype(bool)
+    
+    def channel_values (self, chan, start=0, stop=None):
+        # values of a channel for rows start:stop as they would be after wf_clean (invalid samples zeroed)
+        values = self.waves[chan].values[start:stop]
+        if not self.compact:
+            return values
+        return np.where(self.invalid_mask(chan, start, stop), np.float32(0), values)
+        
     def clean_wfs (self):
         # clean all CVP and ABP channels of out of range values
+        if self.compact:
+            return self.clean_compact()
         # right now deleting all the data... maybe should just delete the ABP and CVP... or replace by NaN
         #mask = df.my_channel > 20000
         #column_name = 'my_channel'
@@ -220,39 +427,97 @@ class Waveform(ABP_class, CVP_class, ECG_class):
             
             
     def segmenter (self, window_multiplier=1):
-        # need to adapt this to account for possibly different sampling rates
+        # segment stage - memoized on the cleaned data, level, window multiplier and channel
+        if self.clean_key is None:
+            self.clean_key = ('frame', id(self.waves))
+        if self.seg_channel not in self.waves.columns:
+            # vitals style names (eg AR1-M) map onto the waveform channel (AR1)
+            self.seg_channel = self.seg_channel.split('-')[0]
+        params = (self.clean_key, self.seg_level, window_multiplier, self.seg_channel, self.Fs)
+        self.seg_key, out = self.stages.run('segment', params, lambda: self._segment(window_multiplier))
+        self.segments, self.seg_start_time, self.section_size, self.seg_channel = out
+        
+    def _segment (self, window_multiplier=1):
         waveform = self.waves
         level = self.seg_level
+        seg_channel = self.seg_channel
         
 #        DATA_TIME_CONST = 0.004166747   #will need to adjust for MIMIC data
 #        section_size = math.ceil(13.5 / DATA_TIME_CONST)
-        self.section_size = int((100*2**level / 4)) * window_multiplier
-        print('Segmenting waveform. Level = {}, section size = {}'.format(level, self.section_size))
-        seg_idx = np.arange(0, len(waveform), self.section_size)
-        self.segments = {}
-        self.seg_start_time = {}
+        section_size = wf_meta.section_size(level, self.Fs) * window_multiplier   # same duration at every record rate
+        print('Segmenting waveform. Level = {}, section size = {}'.format(level, section_size))
+        seg_idx = np.arange(0, len(waveform), section_size)
+        segments = {}
+        seg_start_time = {}
+        if self.compact:
+            # cut segments from the masked channel values (zeros where wf_clean would have written them)
+            chan_values = self.channel_values(seg_channel)
+            ecg_values = self.channel_values('II')
         for i in range(1, len(seg_idx)):
-            try: signal = waveform.iloc[seg_idx[i-1]:seg_idx[i]][[self.seg_channel,'II']]
+            if self.compact:
+                a, b = seg_idx[i-1], seg_idx[i]
+                segments[i] = pd.DataFrame({seg_channel: chan_values[a:b], 'II': ecg_values[a:b]}, index=waveform.index[a:b])
+                seg_start_time[i] = waveform.index[seg_idx[i]].round('s')
+                continue
+            try: signal = waveform.iloc[seg_idx[i-1]:seg_idx[i]][[seg_channel,'II']]
             except KeyError: 
-                self.seg_channel = self.seg_channel.split('-')[0] 
-                signal = waveform.iloc[seg_idx[i-1]:seg_idx[i]][[self.seg_channel,'II']]
-            self.segments[i]=signal
-            self.seg_start_time[i] = waveform.index[seg_idx[i]].round('s')
+                seg_channel = seg_channel.split('-')[0] 
+                signal = waveform.iloc[seg_idx[i-1]:seg_idx[i]][[seg_channel,'II']]
+            segments[i]=signal
+            seg_start_time[i] = waveform.index[seg_idx[i]].round('s')
+        return segments, seg_start_time, section_size, seg_channel
+    
+    def prescreen (self):
+        # quality stage: fast artifact detection over all segments at once (flatline, clipping, zero runs, time gaps, ECG lead off)
+        # rejected segments are skipped by wf_features and the wavelet processing, ECG lead off only skips HR
+        if self.seg_channel in Waveform.CVP_cols:
+            hi, lo = CVP_class.CVP_hi, CVP_class.CVP_lo
+        else:
+            hi, lo = ABP_class.ABP_hi, ABP_class.ABP_lo
+        values = None
+        if self.compact:
+            values = {self.seg_channel: self.channel_values(self.seg_channel)}
+            if self.HR_lead in self.waves.columns:
+                values[self.HR_lead] = self.channel_values(self.HR_lead)
+        self.quality_key, self.reject = self.stages.run('quality', (self.seg_key, self.Fs, hi, lo, self.HR_lead), lambda:
+            wf_quality.prescreen(self.waves, self.seg_channel, self.section_size, self.Fs, hi, lo, ecg_channel=self.HR_lead,
+                                 ecg_hi=ECG_class.ECG_hi, ecg_lo=ECG_class.ECG_lo, nseg=len(self.segments), values=values))
+        self.rejected = list(self.reject.index[self.reject['reject'].values])
+
+    def lead_off_segments (self):
+        # segments with the HR lead off, or every segment if the file has no HR lead (pre-screen) - HR is skipped for these
+        if self.reject is None or 'ecg_lead_off' not in self.reject.columns:
+            return set()
+        return set(self.reject.index[self.reject['ecg_lead_off'].values.astype(bool)])
  
+    # attributes set by the features stage
+    feature_attrs = ['features', 'seg_SQI', 'bad_segments', 'MAP', 'PPV', 'PP', 'PVI', 'HR']
+    
     def wf_features (self, SQI_threshold = 0.5):
+        # features stage - memoized on the segmentation and pre-screen
+        params = (type(self).__name__, self.seg_key, self.quality_key, SQI_threshold)
+        out = self.stages.run('features', params, lambda: self._wf_features(SQI_threshold))[1]
+        for attr, value in out.items():
+            setattr(self, attr, value)
+    
+    def _wf_features (self, SQI_threshold = 0.5):
         # use MATLAB and wfdb code to generate features df and signal quality
         feats_cols=['Sys_t','SBP','Dia_t','DBP','PP','MAP','Beat_P','mean_dyneg','End_sys_t','AUS','End_sys_t2','AUS2']
+        self.features = {}
+        self.seg_SQI = {}
         
-        eng = matlab.engine.start_matlab()
-        eng.addpath(r'/.');
-        eng.addpath(r'./WFDB'); 
+        eng = get_matlab()
         
         for i in range(1, len(self.segments)+1):
-            seg = self.segments[i][self.seg_channel]
-            seglist = seg.values.tolist()
+            if i in self.rejected:
+                self.features[i] = []
+                self.seg_SQI[i] = 0.0
+                continue
+            seglist = self.wabp_values(i).tolist()
 #            print ('Processing segment {}'.format(i))
             try:
-                (onsets,feats, R, QF) = eng.wabp_wrap(seglist, nargout=4)
+                with wf_metrics.histogram('wf_feature_seconds', 'Per segment feature time', engine='matlab').time():
+                    (onsets,feats, R, QF) = eng.wabp_wrap(seglist, float(wf_resample.wabp_Fs), nargout=4)
                 df = pd.DataFrame(data=np.asarray(feats),columns=feats_cols)
                 self.features[i] = df
                 if isinstance(QF, float): 
@@ -274,6 +539,7 @@ class Waveform(ABP_class, CVP_class, ECG_class):
         self.PP = {}
         self.PVI = {} # pleth variability index
         self.HR = {}
+        lead_off = self.lead_off_segments()
         for i in range (1, len(self.segments)+1):
             if i not in self.bad_segments:
                 self.MAP[i] = self.features[i]['MAP'].mean()
@@ -288,34 +554,52 @@ class Waveform(ABP_class, CVP_class, ECG_class):
                 self.PPV[i] = 0
                 self.PP[i] = 0
                 self.PVI[i]= 0
+            if i in self.rejected or i in lead_off:
+                self.HR[i] = 0
+                continue
             try:
-                lead1 = self.chan_slice('I',i)
-                self.HR[i] = ecg.ecg(lead1.values, sampling_rate = self.Fs, show = False)[6].mean()  
+                lead1 = self.chan_slice(self.HR_lead,i)
+                with wf_metrics.histogram('wf_feature_seconds', 'Per segment feature time', engine='biosppy').time():
+                    self.HR[i] = ecg.ecg(lead1.values, sampling_rate = self.Fs, show = False)[6].mean()  
             except:
                 print ('Error with HR on segment {}'.format(i))
                 self.HR[i] = 0
+        return {attr: getattr(self, attr) for attr in Waveform.feature_attrs if hasattr(self, attr)}
                 
-                
+    def wabp_values (self, i):
+        # segment i of the segment channel at the rate the wfdb ABP functions expect (wf_resample.wabp_Fs)
+        # cut from the record's whole record resampling when it has been built (wf_resample.precompute or the
+        # channel profile pass) and the segment's rows are known; otherwise the segment is converted on its own
+        values = self.segments[i][self.seg_channel].values
+        if self.Fs == wf_resample.wabp_Fs:
+            return values
+        rs = None if self.filename is None else wf_resample.cached(self.filename, self.seg_channel, wf_resample.wabp_Fs)
+        if rs is None:
+            return wf_resample.convert(values, self.Fs, wf_resample.wabp_Fs)
+        start = self.first_row + (i - 1) * self.section_size
+        values = rs.rows(start, start + len(self.segments[i]))
+        if self.seg_channel in Waveform.CVP_cols:
+            hi, lo = CVP_class.CVP_hi, CVP_class.CVP_lo
+        else:
+            hi, lo = ABP_class.ABP_hi, ABP_class.ABP_lo
+        return np.where((values < hi) & (values > lo), values, 0)   # out of range and missing zeroed, as wf_clean
+
     def check_times (self):
-        # look at segemnts and see if there are abnormal lengths ( longer than the mode)
+        # duration check - memoized on the segmentation
+        self.bad_times = self.stages.run('times', (self.seg_key,), self._check_times)[1]
+                
+    def _check_times (self):
+        # find segments that span a gap in the timestamps (one np.diff pass over the index, see wf_meta.gap_index)
         # store the result in self.bad_times
-        from scipy import stats
-        seg_dur = []
-        
-        for i in range(1, len(self.segments)+1):
-            seg_dur.append(self.segments[i].index[-1]-self.segments[i].index[1])
-
-        norm_segment = stats.mode(seg_dur)[0][0]+pd.Timedelta(np.timedelta64(10, 'ms'))
-        
-        self.bad_times = []
-        for i in range(0, len(self.segments)):
-            if seg_dur[i] > norm_segment:
-                self.bad_times.append(i+1)
-                print('Bad segment {} duration {}'.format(i, seg_dur[i]))
-        pass
+        gap_rows = wf_meta.gap_index(self.waves.index.asi8, self.Fs)
+        # a gap at a segment boundary (row multiple of section_size) doesn't fall inside either segment
+        inside = gap_rows[gap_rows % self.section_size != 0]
+        bad_times = sorted(set((inside // self.section_size + 1).tolist()) & set(self.segments))
+        for i in bad_times:
+            print('Bad segment {} spans a gap in the timestamps'.format(i))
+        return bad_times
     
     def chan_slice (self, chan, seg, window_multiplier=1):
-        # need to adapt this to accound for possibly different sampling rates
         # return start and end indices for the segment
         
         waveform = self.waves
@@ -324,10 +608,13 @@ class Waveform(ABP_class, CVP_class, ECG_class):
 #        DATA_TIME_CONST = 0.004166747   #will need to adjust for MIMIC data
 #        section_size = math.ceil(13.5 / DATA_TIME_CONST)
 #       print('Segmenting waveform. Level = {}, section size = {}'.format(level, section_size))
-        section_size = int((100*2**level / 4)) * window_multiplier
+        section_size = wf_meta.section_size(level, self.Fs) * window_multiplier
     
         seg_idx = np.arange(0, len(waveform), section_size)
     #    start = seg_idx[seg-1]
+        if self.compact:
+            a, b = seg_idx[seg-1], seg_idx[seg]
+            return pd.Series(self.channel_values(chan, a, b), index=waveform.index[a:b], name=chan)
         signal = waveform.iloc[seg_idx[seg-1]:seg_idx[seg]][chan]
     
         return signal
@@ -353,9 +640,9 @@ class Waveform(ABP_class, CVP_class, ECG_class):
         
         ABP = self.segments[seg]['ABP']
         feats_df = self.features[seg]
-        sys_idx = (feats_df['Sys_t'].values * 240/125).round().astype(int).transpose().tolist()
-        sys_idx = (feats_df['Sys_t'].values * 240/125).round().astype(int).transpose().tolist()
-        dia_idx = (feats_df['Dia_t'].values * 240/125).round().astype(int).transpose().tolist()
+        # feature times are sample numbers at the wabp rate
+        sys_idx = (feats_df['Sys_t'].values * self.Fs/wf_resample.wabp_Fs).round().astype(int).transpose().tolist()
+        dia_idx = (feats_df['Dia_t'].values * self.Fs/wf_resample.wabp_Fs).round().astype(int).transpose().tolist()
         
         fig, axes = plt.subplots(len(chan_plots), 1, figsize=(10,10)) # change height based on number of channels...
         fig.suptitle('Segment {0:d} with SQI {1:0.1f} Segment MAP: {2:0.1f} mmHg, PPV: {3:0.1f} % PVI: {4:0.1f}'.format(seg,     
@@ -377,7 +664,7 @@ class Waveform(ABP_class, CVP_class, ECG_class):
             elif chan in ['I','II','III','V']:
                 # ECG lead so find R-peaks
                 ECG_sig = self.chan_slice(chan, seg)
-                R_peaks = np.array(ecg.christov_segmenter(signal=ECG_sig.values, sampling_rate=240.))[0]
+                R_peaks = np.array(ecg.christov_segmenter(signal=ECG_sig.values, sampling_rate=float(self.Fs)))[0]
     #            R_plot = pd.Series(index = lead1.index[R_peaks], data = lead1.values[R_peaks])
                 R_ts = ECG_sig.index[R_peaks]
                 
@@ -439,14 +726,20 @@ class Summary:
 
 class CVPWaveform(Waveform):
     def wf_features (self):
+        # features stage - memoized on the segmentation and pre-screen
+        params = (type(self).__name__, self.seg_key, self.quality_key)
+        out = self.stages.run('features', params, self._wf_features)[1]
+        for attr, value in out.items():
+            setattr(self, attr, value)
+    
+    def _wf_features (self):
         # use MATLAB and wfdb code to generate features df and signal quality
         
-        eng = matlab.engine.start_matlab()
-        eng.addpath(r'/.');
-        eng.addpath(r'./WFDB'); 
+        eng = get_matlab()
         
         self.PVI = {} # pleth variability index
         self.HR = {}
+        lead_off = self.lead_off_segments()
         for i in range (1, len(self.segments)+1):
             if i not in self.bad_segments:
                 if 'SPO2' in self.waves.columns:
@@ -454,12 +747,17 @@ class CVPWaveform(Waveform):
                     self.PVI[i]=( spo2.max()-spo2.min() )/ spo2.max()
             else:
                 self.PVI[i]= 0
+            if i in self.rejected or i in lead_off:
+                self.HR[i] = 0
+                continue
             try:
-                lead1 = self.chan_slice('I',i)
-                self.HR[i] = ecg.ecg(lead1.values, sampling_rate = self.Fs, show = False)[6].mean()  
+                lead1 = self.chan_slice(self.HR_lead,i)
+                with wf_metrics.histogram('wf_feature_seconds', 'Per segment feature time', engine='biosppy').time():
+                    self.HR[i] = ecg.ecg(lead1.values, sampling_rate = self.Fs, show = False)[6].mean()  
             except:
                 print ('Error with HR on segment {}'.format(i))
                 self.HR[i] = 0
+        return {'PVI': self.PVI, 'HR': self.HR}
             
 class ABPWavelet (Waveform):
 # ABPWavelet Class
@@ -473,8 +771,9 @@ class ABPWavelet (Waveform):
     wavelets = [] 
     
     def __init__ (self, waveform, process=True):
-        self.waves = waveform.waves
-        self.vitals = waveform.vitals  
+        self.share(waveform)
+        self.seg_key = waveform.seg_key
+        self.quality_key = waveform.quality_key
         self.seg_SQI = waveform.seg_SQI    # segment signal quality (array) - use to supress bad data before classification
         self.bad_segments = waveform.bad_segments
         self.Fs = waveform.Fs
@@ -483,6 +782,8 @@ class ABPWavelet (Waveform):
         self.HR = waveform.HR
         self.seg_start_time = waveform.seg_start_time
         self.seg_channel = waveform.seg_channel
+        self.reject = waveform.reject
+        self.rejected = waveform.rejected
         
         if process:
             self.processWaveform()
@@ -508,6 +809,12 @@ class ABPWavelet (Waveform):
         return np.sqrt(np.sum(np.array(coeff ** 2)) / len(coeff))
    
     def processWaveform(self, window_multiplier=1, normalize=True):
+        # wavelets stage - segmentation is shared with the source Waveform through the stage cache
+        self.segmenter()
+        params = (type(self).__name__, self.seg_key, self.quality_key, normalize)
+        self.wavelets = self.stages.run('wavelets', params, lambda: self._swt_energies(normalize))[1]
+        
+    def _swt_energies(self, normalize=True):
         energy = {}
         level = self.seg_level
 #        waveform = self.waves
@@ -516,12 +823,17 @@ class ABPWavelet (Waveform):
             energy[label[0]] = []
             energy[label[1]] = []
     
-        self.segmenter()
         scaler = MinMaxScaler(copy=True, feature_range=(0,1))
 #       print (len(self.segments))
         for i in range(1, len(self.segments)+1):
             #signal1 = waveform.head(3200)['AR1'] should just use the segments here *****
             #signal = waveform.iloc[segments[i-1]:segments[i]]['ABP']
+            if i in self.rejected:
+                # no SWT for segments that failed the pre-screen
+                for label in self.listCreator(level):
+                    energy[label[0]].append(np.nan)
+                    energy[label[1]].append(np.nan)
+                continue
             signal = self.segments[i][self.seg_channel]
             if normalize:
                 signal = pd.DataFrame(scaler.fit_transform(signal.to_frame()) )[0]
@@ -532,9 +844,8 @@ class ABPWavelet (Waveform):
                     energy[single_label].append(nrgCoeff)
         
         
-        self.wavelets = pd.DataFrame(data=energy, index = np.arange(1,len(self.segments)+1)) # fix this
-        self.wavelets = self.wavelets.drop(['cA1', 'cA2', 'cA3', 'cA4', 'cA5', 'cA6', 'cA7', 'cD1', 'cD2'], axis=1)
-#        return self.wavelets
+        wavelets = pd.DataFrame(data=energy, index = np.arange(1,len(self.segments)+1)) # fix this
+        return wavelets.drop(['cA1', 'cA2', 'cA3', 'cA4', 'cA5', 'cA6', 'cA7', 'cD1', 'cD2'], axis=1)
 
 #def wf_features (waveform):
     @staticmethod   
@@ -549,13 +860,14 @@ class ABPWavelet (Waveform):
     
     def _drop_bad (self, bad_list):
         
-        self.wavelets = self.wavelets.drop(bad_list)
+        self.wavelets = self.wavelets.drop(bad_list, errors='ignore')
     
     def clean_bad_segs (self):
         
         self.check_times()
         self._drop_bad(self.bad_times)
         self._drop_bad(self.bad_segments)
+        self._drop_bad(self.rejected)
         
     def generateFeatures (self):
         # generate the wavelet feature dataframe (including MAP and HR)
@@ -588,8 +900,9 @@ class CVPWavelet (Waveform):
     wavelets = [] 
     
     def __init__ (self, waveform, process=True):
-        self.waves = waveform.waves
-        self.vitals = waveform.vitals  
+        self.share(waveform)
+        self.seg_key = waveform.seg_key
+        self.quality_key = waveform.quality_key
         self.seg_SQI = waveform.seg_SQI    # segment signal quality (array) - use to supress bad data before classification
         self.bad_segments = waveform.bad_segments
         self.Fs = waveform.Fs
@@ -597,6 +910,8 @@ class CVPWavelet (Waveform):
         self.HR = waveform.HR
         self.seg_start_time = waveform.seg_start_time
         self.seg_channel = waveform.seg_channel
+        self.reject = waveform.reject
+        self.rejected = waveform.rejected
         
         if process:
             self.processWaveform()
@@ -622,6 +937,12 @@ class CVPWavelet (Waveform):
         return np.sqrt(np.sum(np.array(coeff ** 2)) / len(coeff))
    
     def processWaveform(self, window_multiplier=1, normalize=True):
+        # wavelets stage - segmentation is shared with the source Waveform through the stage cache
+        self.segmenter()
+        params = (type(self).__name__, self.seg_key, self.quality_key, normalize)
+        self.wavelets = self.stages.run('wavelets', params, lambda: self._swt_energies(normalize))[1]
+        
+    def _swt_energies(self, normalize=True):
         energy = {}
         level = self.seg_level
 #        waveform = self.waves
@@ -630,13 +951,18 @@ class CVPWavelet (Waveform):
             energy[label[0]] = []
             energy[label[1]] = []
     
-        self.segmenter()
         scaler = MinMaxScaler(copy=True, feature_range=(0,1))
 #       print (len(self.segments))
     
         for i in range(1, len(self.segments)+1):
             #signal1 = waveform.head(3200)['AR1'] should just use the segments here *****
             #signal = waveform.iloc[segments[i-1]:segments[i]]['ABP']
+            if i in self.rejected:
+                # no SWT for segments that failed the pre-screen
+                for label in self.listCreator(level):
+                    energy[label[0]].append(np.nan)
+                    energy[label[1]].append(np.nan)
+                continue
             signal = self.segments[i][self.seg_channel]
             if normalize:
                 signal = pd.DataFrame(scaler.fit_transform(signal.to_frame()) )[0]
@@ -647,9 +973,8 @@ class CVPWavelet (Waveform):
                     energy[single_label].append(nrgCoeff)
         
         
-        self.wavelets = pd.DataFrame(data=energy, index = np.arange(1,len(self.segments)+1)) # fix this
-        self.wavelets = self.wavelets.drop(['cA1', 'cA2', 'cA3', 'cA4', 'cA5', 'cA6', 'cA7', 'cD1', 'cD2'], axis=1)
-#        return self.wavelets
+        wavelets = pd.DataFrame(data=energy, index = np.arange(1,len(self.segments)+1)) # fix this
+        return wavelets.drop(['cA1', 'cA2', 'cA3', 'cA4', 'cA5', 'cA6', 'cA7', 'cD1', 'cD2'], axis=1)
 
 #def wf_features (waveform):
     @staticmethod   
@@ -664,13 +989,14 @@ class CVPWavelet (Waveform):
     
     def _drop_bad (self, bad_list):
         
-        self.wavelets = self.wavelets.drop(bad_list)
+        self.wavelets = self.wavelets.drop(bad_list, errors='ignore')
     
     def clean_bad_segs (self):
         
         self.check_times()
         self._drop_bad(self.bad_times)
         self._drop_bad(self.bad_segments)
+        self._drop_bad(self.rejected)
         
     def generateFeatures (self):
         # generate the wavelet feature dataframe (including MAP and HR)
@@ -697,7 +1023,7 @@ class Segment (Waveform):
         self.features = {}   # wfdb generated features for each segment
         self.seg_SQI = {}    # segment signal quality (array) - use to supress bad data before classification
 #        self.bad_segments = []
-        self.Fs = 240 # default sample rate- should also set time constant
+        self.Fs = wf_meta.default_Fs   # set from the record's metadata by read
         self.seg_level = level
         self.seg_start_time = {}
         self.section_size = 0
@@ -720,6 +1046,7 @@ class Segment (Waveform):
         # how to specify start time?? read as date_time
         # if start is blank - read whole file
         # if duration and end are blank, read from start to the end of the file
+        self.Fs = wf_meta.get_meta(filename).Fs
         duration = chunksize/self.Fs
         
         if start != 0:
@@ -769,9 +1096,9 @@ class Segment (Waveform):
         
         df = self.waves
         wave = df[wave_chan]
-        ecg_s = df[ECG_chan].values.reshape(1,6400)[0]
-        (ts, filtered, rpeaks, templates_ts, templates, HR_ts, HR)=ecg.ecg(ecg_s, sampling_rate=240., show=False)
-        templates = extract_heartbeats(signal=wave, rpeaks=rpeaks, sampling_rate=240., before=Bstep, after=Astep)
+        ecg_s = df[ECG_chan].values.ravel()
+        (ts, filtered, rpeaks, templates_ts, templates, HR_ts, HR)=ecg.ecg(ecg_s, sampling_rate=float(self.Fs), show=False)
+        templates = extract_heartbeats(signal=wave, rpeaks=rpeaks, sampling_rate=float(self.Fs), before=Bstep, after=Astep)
         ts = np.linspace(0,(wave.index[-1]-wave.index[0]).total_seconds()/len(templates[0]),num=len(templates[1]))
     
         return templates, ts
@@ -813,15 +1140,13 @@ class Segment (Waveform):
         # use MATLAB and wfdb code to generate features df and signal quality
         feats_cols=['Sys_t','SBP','Dia_t','DBP','PP','MAP','Beat_P','mean_dyneg','End_sys_t','AUS','End_sys_t2','AUS2']
         
-        eng = matlab.engine.start_matlab()
-        eng.addpath(r'/.');
-        eng.addpath(r'./WFDB'); 
+        eng = get_matlab()
         
         seg = self.waves[self.ABP_chan]
-        seglist = seg.values.tolist()
+        seglist = wf_resample.convert(seg.values, self.Fs, wf_resample.wabp_Fs).tolist()
 #            print ('Processing segment {}'.format(i))
         try:
-            (onsets,feats, R, QF) = eng.wabp_wrap(seglist, nargout=4)
+            (onsets,feats, R, QF) = eng.wabp_wrap(seglist, float(wf_resample.wabp_Fs), nargout=4)
             df = pd.DataFrame(data=np.asarray(feats),columns=feats_cols)
             self.features = df
             self.MAP = df['MAP'].mean()
@@ -916,17 +1241,10 @@ class Wavelet (Segment):
         
         return df        
         
-def plot_summary_to_pdf(outfile, spath='./*.sum'):       
-    files = glob.glob(spath)
-    with PdfPages(outfile) as pdf:
-        for f in files:
-            print (f)
-            sum_f = Summary()
-            sum_f.read(f)
-            sum_f.data.plot(subplots=True,figsize=(10,10),title=str(f))
-            
-            pdf.savefig()  # saves the current figure into a pdf page
-            plt.close()
+def plot_summary_to_pdf(outfile, spath='./*.sum', workers=4):
+    # pages are rendered in parallel from decimated summaries, only for changed .sum files (see wf_report.py)
+    import wf_report
+    wf_report.make_report(outfile, spath, workers=workers)
 
 def _extract_heartbeats(signal=None, rpeaks=None, before=200, after=400):
     """Extract heartbeat templates from an ECG signal, given a list of
@@ -1022,9 +1340,9 @@ def extract_heartbeats(signal=None, rpeaks=None, sampling_rate=240.,
 def wave_templates (seg, wave_chan, ECG_chan='II'):
     df = seg.waves
     wave = df[wave_chan]
-    ecg_s = df[ECG_chan].values.reshape(1,6400)[0]
-    (ts, filtered, rpeaks, templates_ts, templates, HR_ts, HR)=ecg.ecg(ecg_s, sampling_rate=240., show=False)
-    templates = extract_heartbeats(signal=wave, rpeaks=rpeaks, sampling_rate=240., before=0.1, after=0.7)
+    ecg_s = df[ECG_chan].values.ravel()
+    (ts, filtered, rpeaks, templates_ts, templates, HR_ts, HR)=ecg.ecg(ecg_s, sampling_rate=float(seg.Fs), show=False)
+    templates = extract_heartbeats(signal=wave, rpeaks=rpeaks, sampling_rate=float(seg.Fs), before=0.1, after=0.7)
     ts = np.linspace(0,(wave.index[-1]-wave.index[0]).total_seconds()/len(templates[0]),num=len(templates[1]))
 
     return templates, ts
\ No newline at end of file
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_batch.py
+
+Headless batch segmentation and feature extraction over the workflow catalog
+
+Works through the files table of a workflow DB (see wf_file_management.build_db) and runs the same
+Waveform / ABPWavelet / CVPWavelet processing that load_cb in wf_explore.py runs interactively,
+for the ABP and CVP channels picked by the channel profile of each file (wf_profile.py; files are profiled first
+if needed). Results are written in bulk to the features table.
+
+Files move through the status values defined in wf_file_management (NEW -> RUNNING -> DONE / ERROR).
+Results and the DONE status for a file are committed in the same transaction, so a crashed run can
+simply be restarted: interrupted files are reset and reprocessed, finished files are skipped.
+
+    Usage: python wf_batch.py workflow.db [--workers 4] [--level 8] [--retry-errors] [--compact] [--max-memory MB]
+
+With --max-memory each file is processed out of core (wf_chunked.ChunkedWaveform) in segment aligned blocks that
+fit the given budget per worker, instead of reading the whole file at once.
+
+"""
+
+import sqlite3
+import os.path
+import time
+import argparse
+from multiprocessing import Pool
+
+import pandas as pd
+import numpy as np
+
+import waveform
+import wf_file_management as wfm
+import wf_chunked
+import wf_profile
+import wf_resample
+
+
+def _channel_waveform (wf, channel, level):
+    # run segmentation and wfdb features for one channel on an already read waveform
+    if channel in waveform.Waveform.CVP_cols:
+        cwf = waveform.CVPWaveform(level=level, seg_channel=channel, compact=wf.compact)
+    else:
+        cwf = waveform.Waveform(level=level, seg_channel=channel, compact=wf.compact)
+    cwf.share(wf)
+    cwf.segmenter()
+    cwf.prescreen()
+    cwf.check_times()
+    cwf.wf_features()
+    return cwf
+
+def feature_rows (wvt, path, channel):
+    # build the features table rows for a processed wavelet object
+    df = wvt.wltFeatures.copy()
+    for col in wfm.feature_cols:
+        if col not in df.columns:
+            df[col] = np.nan
+    df = df[wfm.feature_cols]
+    case = os.path.basename(path).split('.')[0]
+    df['seg'] = df.index
+    df['file'] = path
+    df['channel'] = channel
+    df['entry'] = ['{}_{}_{:03d}'.format(case, channel, N) for N in df.index]
+    df['seg_start_time'] = [str(wvt.seg_start_time[N]) for N in df.index]
+    df['seg_length'] = wvt.section_size
+    df['Fs'] = wvt.Fs   # record rate: features of different rates aren't comparable (see wf_meta.section_size)
+    df['SQI'] = [wvt.seg_SQI.get(N, np.nan) for N in df.index]
+    bad = set(getattr(wvt, 'bad_times', [])) | set(wvt.bad_segments) | set(wvt.rejected)
+    df['bad'] = [int(N in bad) for N in df.index]
+    df['reject'] = wvt.reject['reasons'].reindex(df.index).values
+    return df
+
+def process_channels (columns, channels):
+    # ABP / CVP channels to process: the profiled selection, or every one present if the file has no profile
+    present = [c for c in waveform.Waveform.ABP_cols + waveform.Waveform.CVP_cols if c in columns]
+    return present if channels is None else [c for c in channels if c in present]
+
+def precompute (path, channels, max_memory_mb=None):
+    # whole record resampling caches (wf_resample) the file's channels need - normally already built by the
+    # channel profile pass, otherwise built here in one chunked pass over just those columns
+    first = pd.read_hdf(path, 'Waveforms', start=0, stop=1)
+    abp = [c for c in process_channels(first.columns, channels) if c in waveform.Waveform.ABP_cols]
+    wf_resample.precompute(path, abp, max_memory_mb)
+
+def process_file (job):
+    # worker entry point: job is (filename, path, level, compact, max_memory_mb, channels)
+    # channels: list from wf_profile.batch_channels, None processes every ABP / CVP channel in the file
+    # returns (filename, features df or None, segments, bytes read, error message)
+    filename, path, level, compact, max_memory_mb, channels = job
+    if max_memory_mb:
+        return process_file_chunked(job)
+    try:
+        precompute(path, channels, max_memory_mb)
+        wf = waveform.Waveform(path, level=level, compact=compact)
+        nbytes = wf.bytes_read
+        results = []
+        for channel in process_channels(wf.waves.columns, channels):
+            cwf = _channel_waveform(wf, channel, level)
+            if channel in waveform.Waveform.CVP_cols:
+                wvt = waveform.CVPWavelet(cwf, process=False)
+            else:
+                wvt = waveform.ABPWavelet(cwf, process=False)
+            # keep bad segments (flagged in the bad column) rather than dropping them with clean_bad_segs
+            wvt.processWaveform()
+            wvt.generateFeatures()
+            wvt.check_times()
+            results.append(feature_rows(wvt, path, channel))
+        if results:
+            df = pd.concat(results, ignore_index=True)
+        else:
+            df = None
+        nseg = 0 if df is None else len(df)
+        return filename, df, nseg, nbytes, None
+    except Exception as e:
+        return filename, None, 0, 0, '{}: {}'.format(type(e).__name__, e)
+
+def process_file_chunked (job):
+    # out of core version of process_file: the file is read once, block by block within max_memory_mb,
+    # and every channel is processed on each block
+    filename, path, level, compact, max_memory_mb, channels = job
+    try:
+        first = pd.read_hdf(path, 'Waveforms', start=0, stop=1)
+        chans = process_channels(first.columns, channels)
+        precompute(path, channels, max_memory_mb)
+        processed, nbytes = wf_chunked.process_channels(path, chans, level=level, max_memory_mb=max_memory_mb, compact=compact)
+        results = [feature_rows(processed[channel][1], path, channel) for channel in chans]
+        df = pd.concat(results, ignore_index=True) if results else None
+        nseg = 0 if df is None else len(df)
+        return filename, df, nseg, nbytes, None
+    except Exception as e:
+        return filename, None, 0, 0, '{}: {}'.format(type(e).__name__, e)
+
+def pending_files (db_file, retry_errors=False):
+    # files still to be processed, in catalog order
+    db = sqlite3.connect(db_file)
+    states = [wfm.STATUS_NEW]
+    if retry_errors:
+        states.append(wfm.STATUS_ERROR)
+    df = pd.read_sql('SELECT filename, path FROM files WHERE status IN ({})'.format(','.join('?'*len(states))),
+                     db, params=states)
+    db.close()
+    return df
+
+def write_results (db, filename, path, df):
+    # replace any partial rows for this file and mark it done in a single transaction
+    with db:
+        db.execute('DELETE FROM features WHERE file = ?', (path,))
+        if df is not None:
+            df.to_sql('features', db, if_exists='append', index=False, chunksize=1000)
+        wfm.set_file_status(db, filename, wfm.STATUS_DONE)
+
+def run (db_file, workers=4, level=8, retry_errors=False, compact=False, max_memory_mb=None):
+    if not os.path.isfile(db_file):
+        raise Exception('.db file does not exist')
+    wfm.make_feature_table(db_file)
+    wfm.reset_running(db_file)
+    files = pending_files(db_file, retry_errors)
+    print ('{} files to process with {} workers'.format(len(files), workers))
+    if len(files) == 0:
+        return
+    wf_profile.profile_catalog(db_file, workers=workers)
+
+    paths = dict(zip(files.filename, files.path))
+    db = sqlite3.connect(db_file)
+    channels = {f: wf_profile.batch_channels(wf_profile.file_channels(db, f)) for f in files.filename}
+    with db:
+        for filename in files.filename:
+            wfm.set_file_status(db, filename, wfm.STATUS_RUNNING)
+
+    jobs = [(f, p, level, compact, max_memory_mb, channels[f]) for f, p in zip(files.filename, files.path)]
+    t0 = time.time()
+    total_segs = 0
+    total_bytes = 0
+    done = 0
+    with Pool(processes=workers) as pool:
+        for filename, df, nseg, nbytes, err in pool.imap_unordered(process_file, jobs):
+            done += 1
+            if err is not None:
+                print ('[{}/{}] Error processing {}: {}'.format(done, len(jobs), filename, err))
+                with db:
+                    wfm.set_file_status(db, filename, wfm.STATUS_ERROR)
+                continue
+            write_results(db, filename, paths[filename], df)
+            total_segs += nseg
+            total_bytes += nbytes
+            elapsed = time.time() - t0
+            print ('[{}/{}] {}: {} segments | {:0.1f} segments/s, {:0.1f} MB/s'.format(
+                done, len(jobs), filename, nseg, total_segs/elapsed, total_bytes/1e6/elapsed))
+    db.close()
+
+    elapsed = time.time() - t0
+    print ('Processed {} files, {} segments, {:0.1f} MB in {:0.1f} s ({:0.1f} segments/s, {:0.1f} MB/s)'.format(
+        len(jobs), total_segs, total_bytes/1e6, elapsed, total_segs/elapsed, total_bytes/1e6/elapsed))
+
+def main ():
+    parser = argparse.ArgumentParser(description='Batch segmentation and feature extraction for a workflow DB')
+    parser.add_argument('db_file', help='workflow sqlite DB (see wf_file_management.build_db)')
+    parser.add_argument('--workers', type=int, default=4, help='number of worker processes')
+    parser.add_argument('--level', type=int, default=8, help='wavelet/segmentation level')
+    parser.add_argument('--retry-errors', action='store_true', help='also reprocess files that previously failed')
+    parser.add_argument('--compact', action='store_true', help='float32 reads with a packed invalid sample mask (about half the memory)')
+    parser.add_argument('--max-memory', type=float, default=None, help='process files out of core within this many MB per worker')
+    args = parser.parse_args()
+    run(args.db_file, workers=args.workers, level=args.level, retry_errors=args.retry_errors, compact=args.compact,
+        max_memory_mb=args.max_memory)
+
+if __name__ == "__main__":
+
+    main ()
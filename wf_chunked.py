@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_chunked.py
+
+Out-of-core Waveform processing for whole files
+
+Waveform.read with start=0 loads the entire /Waveforms table before anything else happens, which for multi-day
+cases needs tens of GB. ChunkedWaveform instead walks the file's segment grid (wf_meta.FileMeta.segment_grid) in
+segment aligned blocks of record rows, runs the usual clean/segment/quality/features/wavelet stages on each block
+(via GridSegmenter) and keeps only the per segment results. At most one block of raw samples is resident, with
+the block size derived from max_memory_mb. The record timestamps are a memory mapped .npy (wf_meta), built and
+scanned in fixed size chunks, so they stay out of the budget; what still grows with the recording is the per
+segment results and the segment grid (a few values per segment, ie per 6400 rows).
+
+    cwf = ChunkedWaveform(filename, 'AR1', max_memory_mb=512)
+    wf, wvt = cwf.process()    # Waveform / Wavelet objects with all per segment results (no raw segments)
+
+process_channels() does the same for several channels with one pass over the file: each block is read once and
+every channel's stages run on it before the next block is read.
+
+    results, nbytes = process_channels(filename, ['AR1', 'CVP1'], max_memory_mb=512)   # {channel: (wf, wvt)}
+
+"""
+
+import gc
+import time
+
+import pandas as pd
+
+import waveform
+import wf_incremental
+
+# working copies made while a block is processed (read frame, cleaned values, segment frames, SWT input)
+block_overhead = 4
+
+
+class ChunkedWaveform (wf_incremental.GridSegmenter):
+
+    def __init__ (self, filename, channel, level=8, max_memory_mb=512, compact=True):
+        wf_incremental.GridSegmenter.__init__(self, filename, channel, level=level, compact=compact, keep_raw=False)
+        self.max_memory_mb = max_memory_mb
+        self.block_segments = self._block_segments()
+
+    def _block_segments (self):
+        # number of segments per block that fits in the memory budget
+        columns = pd.read_hdf(self.filename, 'Waveforms', start=0, stop=1).shape[1]
+        bytes_per_row = (columns * (4 if self.compact else 8) + 8) * block_overhead
+        rows = self.max_memory_mb * 1e6 / bytes_per_row
+        return max(int(rows // self.section_size), 1)
+
+    def blocks (self, ks=None):
+        # (start_row, stop_row) blocks of adjacent grid segments, at most block_segments each
+        ks = list(self.grid) if ks is None else ks
+        for start_row, stop_row in self.runs([int(k) for k in ks if k not in self.done]):
+            step = self.block_segments * self.section_size
+            for a in range(start_row, stop_row, step):
+                yield a, min(a + step, stop_row)
+
+    def process (self, start_time=None, end_time=None):
+        # process every grid segment of the file (or of a time range) block by block
+        if start_time is not None:
+            ks = self.grid_range(start_time, end_time)
+        else:
+            ks = [int(k) for k in self.grid]
+        blocks = list(self.blocks(ks))
+        print ('Processing {} segments of {} in {} blocks of up to {} segments ({} MB budget)'.format(
+            len(ks), self.filename, len(blocks), self.block_segments, self.max_memory_mb))
+        t0 = time.time()
+        for n, (start_row, stop_row) in enumerate(blocks, 1):
+            self._process_run(start_row, stop_row)
+            gc.collect()   # drop the block's raw samples before the next read
+            print ('Block {}/{}: rows {} to {} ({:0.1f} s)'.format(n, len(blocks), start_row, stop_row, time.time()-t0))
+        return self.view([k for k in ks if k in self.done])
+
+
+def process_channels (filename, channels, level=8, max_memory_mb=512, compact=True):
+    # process every grid segment of several channels, reading each block of the file once for all of them
+    # returns ({channel: (wf, wvt)}, bytes read from the file)
+    cwfs = [ChunkedWaveform(filename, channel, level=level, max_memory_mb=max_memory_mb, compact=compact) for channel in channels]
+    if not cwfs:
+        return {}, 0
+    blocks = list(cwfs[0].blocks())   # the grid is the same for every channel at one level
+    print ('Processing {} ({}) in {} blocks of up to {} segments ({} MB budget)'.format(
+        filename, ', '.join(c.channel for c in cwfs), len(blocks), cwfs[0].block_segments, max_memory_mb))
+    t0 = time.time()
+    nbytes = 0
+    for n, (start_row, stop_row) in enumerate(blocks, 1):
+        block = waveform.Waveform(level=level, compact=compact)
+        block.read_rows(filename, start_row, min(stop_row + 1, cwfs[0].meta.nrows))
+        nbytes += block.bytes_read
+        for cwf in cwfs:
+            cwf._process_run(start_row, stop_row, source=block)
+        del block
+        gc.collect()   # drop the block's raw samples before the next read
+        print ('Block {}/{}: rows {} to {} ({:0.1f} s)'.format(n, len(blocks), start_row, stop_row, time.time()-t0))
+    return {cwf.channel: cwf.view([int(k) for k in cwf.grid if int(k) in cwf.done]) for cwf in cwfs}, nbytes
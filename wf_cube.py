@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_cube.py
+
+Multi-window wavelet feature cube from a single SWT pass
+
+The segment length is fixed by the level (wf_meta.section_size), so trying another window normally means re-running the whole
+Waveform + ABPWavelet pipeline. FeatureCube runs the stationary wavelet transform (db4, as ABPWavelet) once over each
+contiguous run of the record and keeps, for every block of hop samples, the sums of each coefficient and of its
+square together with the signal min/max. Window energies for any window that is a multiple of hop are then
+differences of cumulative sums, so all windows come out of the same pass:
+
+    cube = FeatureCube(filename, 'AR1', windows=(1600, 3200, 6400, 12800))
+    cube.build()
+    cube.cube                # (window, position, coefficient) array, positions every hop rows
+    cube.frame(6400)         # wltFeatures style DataFrame of non-overlapping 6400 sample windows
+
+Windows are laid out from the start of each contiguous run (like wf_meta.FileMeta.segment_grid) and windows that
+would cross a gap are NaN.
+
+ABPWavelet MinMax-scales each segment before the SWT. The SWT is linear and the db4 detail filters sum to zero, so
+the scaled energies are recovered from the window min/max: detail energies divide by the window range and the
+approximation is shifted by min * 2**(j/2) first (normalize=True). The transform runs over the whole run rather than
+each segment separately, so coefficients near segment edges differ slightly from the per segment (periodized) SWT.
+
+The per hop sums are cached next to the file metadata (wf_meta.cache_dir) so the cube can be re-sliced for other
+windows without touching the hdf5 file.
+
+"""
+
+import os
+import os.path
+import time
+
+import numpy as np
+import pandas as pd
+import pywt
+
+import waveform
+import wf_meta
+
+default_windows = (1600, 3200, 6400, 12800)
+block_rows = 2**20   # samples per SWT block (the SWT of a whole multi-hour run is run in padded blocks)
+
+
+class FeatureCube:
+
+    def __init__ (self, filename, channel, level=8, windows=default_windows, normalize=True, compact=True):
+        self.filename = filename
+        self.channel = channel.split('-')[0]
+        self.level = level
+        self.windows = sorted(windows)
+        self.hop = self.windows[0]
+        for w in self.windows:
+            if w % self.hop:
+                raise ValueError('Window {} is not a multiple of the smallest window {}'.format(w, self.hop))
+        self.normalize = normalize
+        self.compact = compact
+        if self.channel in waveform.Waveform.CVP_cols:
+            self.wf_class = waveform.CVPWaveform
+        else:
+            self.wf_class = waveform.Waveform
+        # the coefficients kept in wltFeatures (cA<level> and cD<level>..cD3)
+        labels = [l for pair in waveform.ABPWavelet.listCreator(level) for l in pair]
+        self.labels = [l for l in labels if l == 'cA{}'.format(level) or (l.startswith('cD') and int(l[2:]) >= 3)]
+        # DC gain of each kept coefficient (the approximation at level j passes a constant x 2**(j/2), details remove it)
+        self.gain = np.array([2**(int(l[2:])/2) if l.startswith('cA') else 0 for l in self.labels])
+        # filter support at the top level - padding needed so block edges don't reach the kept samples
+        self.pad = (pywt.Wavelet('db4').dec_len - 1) * 2**level
+        self.meta = wf_meta.get_meta(filename)
+        self.path = wf_meta.cache_path(filename, 'cube.{}.L{}.H{}.npz'.format(self.channel, level, self.hop))
+        self.cube = None
+
+    def build (self):
+        # load the per hop sums from the cache or compute them, then form the cube for all windows
+        if not self.load():
+            self.compute()
+            self.save()
+        self.cube = np.stack([self.window_energy(w) for w in self.windows])
+        return self.cube
+
+    def load (self):
+        if not os.path.isfile(self.path) or os.path.getmtime(self.path) < os.path.getmtime(self.filename):
+            return False
+        try:
+            with np.load(self.path, allow_pickle=False) as cached:
+                if list(cached['labels']) != self.labels:
+                    return False
+                for k in ['rows', 'run', 'S1', 'S2', 'lo', 'hi']:
+                    setattr(self, k, cached[k])
+        except wf_meta.cache_errors as e:
+            print ('Recomputing unreadable cube cache {}: {}'.format(self.path, e))
+            return False
+        return True
+
+    def save (self):
+        wf_meta.save_npz(self.path, labels=np.array(self.labels), rows=self.rows, run=self.run,
+                         S1=self.S1, S2=self.S2, lo=self.lo, hi=self.hi)
+
+    def _values (self, start_row, stop_row):
+        # cleaned channel values of record rows start_row:stop_row (as float64 for the SWT)
+        wf = self.wf_class(level=self.level, seg_channel=self.channel, compact=self.compact)
+        wf.read_rows(self.filename, start_row, stop_row)
+        return wf.channel_values(self.channel).astype(np.float64)
+
+    def compute (self):
+        # one padded SWT per block of about block_rows samples, summed per hop
+        t0 = time.time()
+        hop = self.hop
+        block_hops = max(block_rows // hop, 1)
+        step = 2**self.level
+        rows, run, S1, S2, lo, hi = [], [], [], [], [], []
+        for n, (r0, r1) in enumerate(self.meta.runs):
+            nhop = (r1 - r0) // hop
+            for h in range(0, nhop, block_hops):
+                a = r0 + h*hop
+                b = r0 + min(h + block_hops, nhop)*hop
+                # pad inside the run where possible, the SWT needs a multiple of 2**level samples
+                pa = min(self.pad, a - r0)
+                pb = min(self.pad, r1 - b)
+                x = self._values(a - pa, b + pb)
+                extra = -len(x) % step
+                x = np.pad(x, (0, extra), mode='reflect' if len(x) > extra else 'edge')
+                coeffs = pywt.swt(x, pywt.Wavelet('db4'), level=self.level)
+                named = {}
+                for (cA, cD), (lA, lD) in zip(coeffs, waveform.ABPWavelet.listCreator(self.level)):
+                    named[lA], named[lD] = cA, cD
+                k = (b - a) // hop
+                C = np.stack([named[l][pa:pa + b - a] for l in self.labels], axis=1).reshape(k, hop, len(self.labels))
+                X = x[pa:pa + b - a].reshape(k, hop)
+                S1.append(C.sum(axis=1))
+                S2.append((C**2).sum(axis=1))
+                lo.append(X.min(axis=1))
+                hi.append(X.max(axis=1))
+                rows.append(a + np.arange(k)*hop)
+                run.append(np.full(k, n))
+        empty = np.zeros((0, len(self.labels)))
+        self.rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        self.run = np.concatenate(run) if run else np.zeros(0, dtype=np.int64)
+        self.S1 = np.concatenate(S1) if S1 else empty
+        self.S2 = np.concatenate(S2) if S2 else empty
+        self.lo = np.concatenate(lo) if lo else np.zeros(0)
+        self.hi = np.concatenate(hi) if hi else np.zeros(0)
+        print ('SWT of {} hops of {} samples in {:0.1f} s'.format(len(self.rows), hop, time.time()-t0))
+
+    def window_energy (self, window):
+        # (position, coefficient) energies of windows starting at every hop (NaN where the window crosses a gap)
+        m = window // self.hop
+        n = len(self.rows)
+        out = np.full((n, len(self.labels)), np.nan)
+        if n < m:
+            return out
+        c1 = np.concatenate([np.zeros((1, len(self.labels))), np.cumsum(self.S1, axis=0)])
+        c2 = np.concatenate([np.zeros((1, len(self.labels))), np.cumsum(self.S2, axis=0)])
+        k = n - m + 1
+        S1 = c1[m:] - c1[:k]
+        S2 = c2[m:] - c2[:k]
+        valid = self.run[:k] == self.run[m-1:]
+        if self.normalize:
+            lo = np.min([self.lo[i:i+k] for i in range(m)], axis=0)
+            hi = np.max([self.hi[i:i+k] for i in range(m)], axis=0)
+            rng = np.where(hi > lo, hi - lo, np.nan)
+            a = lo[:, None] * self.gain[None, :]
+            # sum((c - a)**2) = S2 - 2 a S1 + window a**2
+            E = np.sqrt(np.maximum(S2 - 2*a*S1 + window*a**2, 0) / window) / rng[:, None]
+        else:
+            E = np.sqrt(S2 / window)
+        out[:k][valid] = E[valid]
+        return out
+
+    def frame (self, window):
+        # wltFeatures style DataFrame of non-overlapping windows laid out from the start of each run
+        if self.cube is None:
+            self.build()
+        E = self.cube[self.windows.index(window)]
+        m = window // self.hop
+        first = np.concatenate([[True], self.run[1:] != self.run[:-1]])
+        offset = np.arange(len(self.run)) - np.maximum.accumulate(np.where(first, np.arange(len(self.run)), 0))
+        keep = (offset % m == 0) & ~np.isnan(E).all(axis=1)
+        df = pd.DataFrame(E[keep], columns=self.labels, index=np.arange(1, int(keep.sum()) + 1))
+        df['seg_row'] = self.rows[keep]
+        df['seg_start_time'] = pd.to_datetime(self.meta.timestamps[self.rows[keep]])
+        return df
+
+    def positions (self):
+        # start time of every cube position
+        return pd.to_datetime(self.meta.timestamps[self.rows])
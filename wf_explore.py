@@ -30,7 +30,7 @@ Makes use of a sqlite DB file to define workflow for the specific analysis
     Global to do:
         1. clean up messy code!
         2. implement for remote server (local browser)
-        3. implement wavelet heatmap with linked waveform view
+        3. implement wavelet heatmap with linked waveform view (done: heatmap panel on the Waveforms tab)
         4. implement annotation view
 
 """
@@ -41,22 +41,37 @@ import pandas as pd
 import sqlite3
 import os.path
 import itertools
+from functools import partial
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from math import pi
 import matlab.engine
-from bokeh.models import DatetimeTickFormatter, PointDrawTool
+from bokeh.models import DatetimeTickFormatter, PointDrawTool, CustomJS
 
 from bokeh.plotting import figure 
 from bokeh.palettes import Category10
 from bokeh.io import output_notebook, show, output_file, curdoc
 from bokeh.layouts import column, row, layout
 from bokeh.models import ColumnDataSource, HoverTool, RadioButtonGroup, Span, LinearAxis, Range1d
+from bokeh.models import LinearColorMapper, FixedTicker
+from bokeh.palettes import Viridis256
+from bokeh.events import Tap
 from bokeh.layouts import widgetbox
 from bokeh.models.widgets import Slider, RangeSlider, CheckboxGroup,  Button, TextInput, Paragraph
 from bokeh.models.widgets import Panel, Tabs
 from bokeh.models.widgets import DataTable, DateFormatter, TableColumn
 import sys
 import waveform
+import wf_similarity
+import wf_sources
+import wf_incremental
+import wf_meta
+import wf_spectral
+import wf_hrv
+import wf_model
+import abp_templates
+import wf_file_management as wfm
 
 from participant import participant
 from xlrd import open_workbook
@@ -95,7 +110,7 @@ wf_classes = ['Unclassified', 'Normal', 'Abnormal']  # read this from the workfl
 vs_types = ['AR1-M','AR2-M','AR3-M','CVP1','CVP2']
 wf_present = {x:True for x in vs_types}
 wf_names = [['AR1-M','DateTime'],['AR2-M','DateTime'],['AR3-M','DateTime'],['CVP1','DateTime'],['CVP2','DateTime']]
-wf_radio_button = RadioButtonGroup ( labels = vs_types, active = 0)
+wf_radio_button = RadioButtonGroup ( labels = vs_types, active = 0, name='wf_radio_button')
 
 wf_types = ['AR1','AR2','AR3','CVP1','CVP2']
 visual_vitals = ['HR','SPO2-%','PVC','NBP-M']
@@ -120,6 +135,12 @@ def duration_HMS(start, stop):
     minutes, seconds = divmod (remainder, 60)
     return hours, minutes, seconds
 
+# Gaps in the waveform record (from the cached gap index) as left/right epoch-ms columns for shading
+min_gap_secs = 10
+def gap_columns(filename):
+    gaps = wf_meta.get_meta(filename).gaps(min_secs=min_gap_secs)
+    return {'left': wf_sources.time_to_ms(gaps['start']), 'right': wf_sources.time_to_ms(gaps['end'])}
+
 #Bokeh color iterator
 def color_gen():
     for arg in itertools.cycle(Category10[10]):
@@ -137,9 +158,20 @@ def read_files (db_file):
     db.close()
     return df
 
+def profiled_channel (data, index):
+    # radio button index of the channel picked by the channel profile (wf_profile.py): ABP, else CVP
+    # None if the file hasn't been profiled (or has neither); data is the files table or file_table.data
+    for col in ['abp_channel', 'cvp_channel']:
+        if col in data and data[col][index] in wf_types:
+            return wf_types.index(data[col][index])
+    return None
+
 # Attempts to find HRV data based on file name    
 def getHRV():
     found = False
+    if not os.path.isdir(dir_in_str):
+        print('Pressor/HRV directory {} not found'.format(dir_in_str.decode("utf-8")))
+        return None
     for file in os.listdir(dir_in_str):
         if cur_file_name.split('_')[0] == file.replace(b' ',b'').split(b'-')[0].decode("utf-8"):
             filename = os.fsdecode(file)
@@ -174,7 +206,7 @@ def getHRV():
     p.DFpressors = p.DFpressors.drop(['study_id'],axis='columns')
     p.DFpressors['DateTime'] = p.DFpressors.index
     p.DFpressors = p.DFpressors.melt(id_vars=['DateTime']).dropna(axis='rows',how='any').set_index('DateTime')
-    pressor_source.data = ColumnDataSource(p.DFpressors).data # updates pressor plot source
+    wf_sources.set_source(pressor_source, p.DFpressors, name='pressor_source') # updates pressor plot source
     return p
    
 # open database file
@@ -187,6 +219,9 @@ for selected_index in range(0, len(files)):
     cur_file_name = files.filename[selected_index] # the current file should be the file selected from the files table in db_file
     active_file = files.path[selected_index]
     vs_sum = waveform.Summary(active_file) # Get summary of vitals from active file
+    auto = profiled_channel(files, selected_index)
+    if auto is not None:
+        wf_radio_button.active = auto
     if not set(wf_names[wf_radio_button.active]).isdisjoint(list(vs_sum.data)):
         break
 # If the selected waveform cannot be found raise an error
@@ -194,18 +229,33 @@ if set(wf_names[wf_radio_button.active]).isdisjoint(list(vs_sum.data)):
     raise('No ' + vs_types[wf_radio_button.active] + 'signal')
 pressor_source = ColumnDataSource()
 p = getHRV()
+auto_channel = wf_radio_button.active   # channel last picked by the viewer (profile / fallback) rather than the annotator
+user_chose_channel = False              # the annotator clicked a different channel - keep it for the next files
 
 ################################## File Management ##################################
 
 ## File Management callbacks ##
+def channel_cb (attr, old, new):
+    # radio button changes that don't come from update() are the annotator's
+    global user_chose_channel
+    user_chose_channel = new != auto_channel
+
+@wf_sources.timed_callback
 def update():
-    global active_file, selected_index, vs_source
+    global active_file, selected_index, vs_source, auto_channel
     # Get the row number of the selected file
     selected_index_temp = file_table.selected["1d"]["indices"][0]
+    new_sum = waveform.Summary(file_table.data['path'][selected_index_temp])
+    # Use the channel picked by the catalog's channel profile (a default AR1 may be flushed or dead in this file),
+    # unless the annotator chose a channel themselves and the file has it
+    channel_index = wf_radio_button.active
+    auto = profiled_channel(file_table.data, selected_index_temp)
+    if auto is not None and (not user_chose_channel or set(wf_names[channel_index]).isdisjoint(list(new_sum.data))):
+        channel_index = auto
     # Change warning to match selection
-    warn_txt.text = 'No ' + vs_types[wf_radio_button.active] + ' found in selection'
+    warn_txt.text = 'No ' + vs_types[channel_index] + ' found in selection'
     # Check that the selected file has the waveform of interest
-    if set(wf_names[wf_radio_button.active]).isdisjoint(list(waveform.Summary(file_table.data['path'][selected_index_temp]).data)):
+    if set(wf_names[channel_index]).isdisjoint(list(new_sum.data)):
         # If it isn't there, ignore the change
         if warn_txt not in file_layout.children:
             file_layout.children.append(warn_txt)
@@ -228,7 +278,7 @@ def update():
     cur_file_box.text = 'Current File: '+ str(active_file.split('\\')[-1])
     selected_file.text = 'Current File: '+ str(active_file.split('\\')[-1])
     # Update the source of the plots
-    vs_sum = waveform.Summary(active_file)
+    vs_sum = new_sum
    
     # Reset vitals selections
     for elem in vs_types:
@@ -236,27 +286,33 @@ def update():
             vs_sum.data[elem] = [np.nan] * len(vs_sum.data.index)
             wf_present[elem] = False
         else: wf_present[elem] = True 
+    wf_present_source.data = {'type': vs_types, 'present': [wf_present[x] for x in vs_types]}
+    if channel_index != wf_radio_button.active:
+        auto_channel = channel_index
+        wf_radio_button.active = channel_index
     for elem in visual_vitals:
         if elem not in list(vs_sum.data): 
             vs_sum.data[elem] = [np.nan] * len(vs_sum.data.index)
     # Update plot data
-    vs_source.data = ColumnDataSource(data=vs_sum.data).data
+    wf_sources.set_source(vs_source, vs_sum.data, name='vs_source')
     date_range_slider.start = pd.to_datetime(min(vs_sum.data.index)).timestamp()*1000
     date_range_slider.end = pd.to_datetime(max(vs_sum.data.index)).timestamp()*1000
     date_range_slider.value = (date_range_slider.start, date_range_slider.end)
     p_main.title.text = 'Vitals Summary for file: {}'.format(cur_file_name )
     p_main.x_range.start = date_range_slider.start
     p_main.x_range.end = date_range_slider.end
+    gap_source.data = gap_columns(active_file)
+    show_hrv()
     
     print('New file selected: {}'.format(cur_file_name))
     
 ## File management widgets ##
 sel_file_txt = Paragraph(text='Current File: '+ str(active_file.split('\\')[-1]))
 warn_txt = Paragraph(text='No ' + vs_types[wf_radio_button.active] + ' found in selection')
-sel_file_button = Button(label='Change File',button_type='success')
+sel_file_button = Button(label='Change File',button_type='success', name='sel_file_button')
 
 files['start_time'] = pd.to_datetime(files['start_time'])
-file_table = ColumnDataSource(files)
+file_table = ColumnDataSource(files, name='file_table')
 
 columns = [
     TableColumn(field='filename', title='File'),
@@ -286,11 +342,13 @@ for elem in vs_types:
         vs_sum.data[elem] = [np.nan] * len(vs_sum.data.index)
         wf_present[elem] = False
     else: wf_present[elem] = True       
+# client side copy of wf_present for the trace switch callback
+wf_present_source = ColumnDataSource(data={'type': vs_types, 'present': [wf_present[x] for x in vs_types]})
 
 vs_width = 1200
 vs_height = 250
 
-vs_source = ColumnDataSource (data=vs_sum.data)
+vs_source = ColumnDataSource (data=wf_sources.frame_to_columns(vs_sum.data))
 
 # Create main figure (for ABP / CVP)
 p_main = figure(y_axis_label='ABP (mmHg)', x_axis_type='datetime', 
@@ -319,6 +377,10 @@ end_span = Span(location=max(vs_sum.data.index).timestamp()*1000,
                   line_dash='dashed', line_width=3)
 p_main.add_layout(end_span)
 
+# Shade missing waveform data
+gap_source = ColumnDataSource(data=gap_columns(active_file))
+p_main.quad(left='left', right='right', bottom=0, top=200, source=gap_source, fill_color='grey', fill_alpha=0.3, line_alpha=0)
+
 # Setting the second y axis range name and range
 p_main.extra_y_ranges = {"pressor": Range1d(start=0, end=20)}
 
@@ -349,7 +411,61 @@ for elem in visual_vitals:
     p_dict[elem].x_range = p_main.x_range
     p_dict[elem].line('DateTime', elem, source=vs_source, line_color=next(colors))
 
-seg_button = Button(label="Segment File", button_type="success")
+# HRV computed from the record's R-peaks (wf_hrv) - shown straight away if cached, otherwise on 'Compute HRV'
+hrv_source = ColumnDataSource(data={'DateTime': np.zeros(0), 'SDNN': np.zeros(0, dtype=np.float32),
+                                    'RMSSD': np.zeros(0, dtype=np.float32), 'LF_HF': np.zeros(0, dtype=np.float32)})
+p_dict['HRV'] = figure(y_axis_label='HRV (ms)', x_axis_type='datetime', plot_width=vs_width, plot_height=int(vs_height*1.3),tools=['box_zoom', 'xwheel_zoom', 'pan'])
+p_dict['HRV'].xaxis.formatter = vs_x_axis
+p_dict['HRV'].x_range = p_main.x_range
+p_dict['HRV'].extra_y_ranges = {'ratio': Range1d(start=0, end=10)}
+p_dict['HRV'].add_layout(LinearAxis(y_range_name='ratio', axis_label='LF/HF'), 'right')
+for elem in ['SDNN', 'RMSSD']:
+    p_dict['HRV'].line('DateTime', elem, source=hrv_source, line_color=next(colors), legend=elem)
+p_dict['HRV'].line('DateTime', 'LF_HF', source=hrv_source, line_color=next(colors), legend='LF/HF', y_range_name='ratio')
+
+# whole file R-peak detection runs off the Bokeh event loop in a separate process: PyTables/HDF5 can't be used from
+# two threads at once, and the viewer reads the same files on the main thread. spawn, not fork, so the worker
+# doesn't inherit this process's open HDF5 handles
+hrv_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+
+def show_hrv ():
+    # load the HRV table for the active file if it is cached (computing it is left to hrv_cb)
+    if not wf_hrv.cached(active_file):
+        hrv_source.data = {k: v[:0] for k, v in hrv_source.data.items()}
+        hrv_button.label = 'Compute HRV'
+        return
+    set_hrv(wf_hrv.hrv(active_file))
+
+def set_hrv (df):
+    wf_sources.set_source(hrv_source, df[['SDNN', 'RMSSD', 'LF_HF']], name='hrv_source')
+    hrv_button.label = 'HRV: {} windows'.format(len(df))
+
+def hrv_done (filename, future):
+    # next tick callback: show the result if the same file is still selected
+    hrv_button.disabled = False
+    try:
+        df = future.result()
+    except Exception as e:
+        print ('HRV failed for {}: {}'.format(filename, e))
+        hrv_button.label = 'HRV failed - retry'
+        return
+    if filename == active_file:
+        set_hrv(df)
+    else:
+        show_hrv()
+
+@wf_sources.timed_callback
+def hrv_cb ():
+    # start R-peak detection / HRV in the worker process and return straight away so other sessions aren't blocked;
+    # the result is pushed back to this document on its next tick
+    hrv_button.disabled = True
+    hrv_button.label = 'Computing HRV...'
+    doc = curdoc()
+    future = hrv_executor.submit(wf_hrv.hrv, active_file)
+    future.add_done_callback(lambda f, filename=active_file: doc.add_next_tick_callback(partial(hrv_done, filename, f)))
+
+seg_button = Button(label="Segment File", button_type="success", name='seg_button')
+hrv_button = Button(label="Compute HRV")
 selected_file = Paragraph(text = 'Current File: {0:s}'.format(os.path.split(active_file)[-1]))
 
 # Get the start and end datetime values of the data
@@ -363,22 +479,35 @@ selected_duration = Paragraph(text = 'Selected Duration: {0:0.0f}:{1:02.0f}:{2:0
 selected_dates = Paragraph(text=str(vs_start.round('s')) + ' to ' + str(vs_end.round('s')))
 checkbox_group = CheckboxGroup(labels = list(p_dict), active = list(range(0,len(p_dict))), inline = True)
 
-date_range_slider = RangeSlider(title="Date Range", start=vs_start.timestamp()*1000, end=vs_end.timestamp()*1000, value= (vs_start.timestamp()*1000, vs_end.timestamp()*1000), step=1, show_value = False, tooltips = False)
-
-# Callback for switching the main vital display (using radiobutton group)
-def wf_switch(attr, old, new):
-    if wf_present[vs_types[new]]:
-        p_main.yaxis.axis_label = vs_types[new]
-        p_main.title.text = vs_types[new] + ' Summary for file: {}'.format(cur_file_name )
-        for r in r_main:
-            r.glyph.line_alpha = 0
-        r_main[new].glyph.line_alpha =1
-    else:
-        print(vs_types[new] + ' not in selected file')
-        wf_radio_button.active = old 
-
+date_range_slider = RangeSlider(title="Date Range", start=vs_start.timestamp()*1000, end=vs_end.timestamp()*1000, value= (vs_start.timestamp()*1000, vs_end.timestamp()*1000), step=1, show_value = False, tooltips = False, name='date_range_slider')
+
+# Pure presentation callbacks run in the browser (CustomJS) - the server only sees the new widget values,
+# which are read when they are needed (eg load_cb reads date_range_slider.value and wf_radio_button.active)
+
+# Switching the main vital display (using radiobutton group)
+# if the selected vital is missing from the file the selection is reverted to the visible trace
+wf_switch = CustomJS(args=dict(renderers=r_main, present=wf_present_source, axis=p_main.yaxis[0], title=p_main.title), code="""
+    const i = cb_obj.active;
+    const label = cb_obj.labels[i];
+    if (!present.data['present'][i]) {
+        for (let j = 0; j < renderers.length; j++) {
+            if (renderers[j].glyph.line_alpha > 0 && j != i) { cb_obj.active = j; }
+        }
+        return;
+    }
+    for (let j = 0; j < renderers.length; j++) {
+        renderers[j].glyph.line_alpha = (j == i) ? 1 : 0;
+    }
+    axis.axis_label = label;
+    const parts = title.text.split(' Summary for file: ');
+    title.text = label + ' Summary for file: ' + parts[parts.length-1];
+""")
+
+grid = None   # grid anchored segmentation of the current file/channel, reused when the range is adjusted
+
+@wf_sources.timed_callback
 def load_cb ():
-    global wf, wvt
+    global wf, wvt, grid
     # Disable buttons while segmenting
     seg_button.disabled = True
     seg_button.label = 'Segmenting File'
@@ -391,54 +520,39 @@ def load_cb ():
     
     print ('Current x range is from {} to {})'.format(vs_start.round('s'), vs_end.round('s')))
     
-    start_str = vs_start.strftime('%Y%m%d-%H%M%S')
-    end_str = vs_end.strftime('%Y%m%d-%H%M%S')
-    
     # Perform the segmentation and wavelet operations on the selected data
-    if 'AR' in vs_types[wf_radio_button.active]:
-        wf = waveform.Waveform(active_file, start=start_str, end=end_str, process=True ,seg_channel = vs_types[wf_radio_button.active])
-        wvt = waveform.ABPWavelet(wf, process=True)
-    elif 'CVP' in vs_types[wf_radio_button.active]:
-        wf = waveform.CVPWaveform(active_file, start=start_str, end=end_str, process=True ,seg_channel = vs_types[wf_radio_button.active])
-        wvt = waveform.CVPWavelet(wf, process=True)
+    # segments sit on a fixed grid of record rows so only segments not already processed are read and computed
+    channel = vs_types[wf_radio_button.active]
+    if grid is None or not grid.matches(active_file, channel, 8):
+        grid = wf_incremental.GridSegmenter(active_file, channel, level=8)
+    wf, wvt = grid.process(vs_start, vs_end)
+    if len(wf.segments) == 0:
+        print ('Selection is shorter than one segment')
+        seg_button.disabled = False
+        seg_button.label = 'Segment File'
+        seg_button.button_type = 'success'
+        return
         
-    # Update the segment slider
-    seg_slider.value = 1
-    seg_slider.end=len(wf.segments)
-    
-    # Update the waveform panel plots
-    wf_source.data = ColumnDataSource(wf.segments[1]).data
-    wf_start = pd.to_datetime(min(wf_source.data['index'])).timestamp()*1000
-    wf_end = pd.to_datetime(max(wf_source.data['index'])).timestamp()*1000
-    
     p_seg.yaxis.axis_label = wf_types[wf_radio_button.active]
-    p_seg.x_range.start = wf_start
-    p_seg.x_range.end = wf_end
+    template_view.figure.yaxis.axis_label = wf_types[wf_radio_button.active]
+    template_view.sampling_rate = float(wf.Fs)
+    wf_line.glyph.y = wf_types[wf_radio_button.active]
     
     # Update pressor information if it exists
     if p:
         p_subset = p.DFpressors.loc[(p.DFpressors.index >= vs_start) & (p.DFpressors.index <= vs_end)]
         for elem in p_subset.index:
             print(int((elem - vs_start) / ((vs_end - vs_start) / len(wf.segments))+1))
-        pressor_seg.data = ColumnDataSource(p.DFpressors.loc[(p.DFpressors.index >= pd.to_datetime(p_seg.x_range.start/1000, unit = 's')) & (p.DFpressors.index <= pd.to_datetime(p_seg.x_range.end/1000, unit = 's'))]).data
-    
-    wf_line.glyph.y = wf_types[wf_radio_button.active]
-    p_wf_II.x_range.start = wf_start
-    p_wf_II.x_range.end = wf_end
     
-    # Show R peaks if selected
-    
-    if show_peaks.active == 'no': #deactivated
-        df = pd.DataFrame(wf_source.data)
-        df['DateTime'] = wf_source.data['index']
-        try: ind = [x.item() for x in pd.to_numeric(df['index'])]
-        except AttributeError: ind = list(pd.to_numeric(df['index']))
-        
-        try: ecg = [x.item()*1000 for x in df['II']]
-        except AttributeError: ecg = list(df['II']*1000)
-        ann, anntype = eng.wrapper(ind,ecg,'wf_files/'+active_file.split('\\')[-1].split('.')[0],240,nargout=2)
-        R_peaks = [int(ann[i][0]) for i, e in enumerate(anntype) if e == 'N']
-        ann_source.data = ColumnDataSource(df.iloc[R_peaks,:]).data 
+    # Update the segment slider and the waveform panel plots
+    # (changing the slider value triggers seg_callback, otherwise show the first segment directly)
+    seg_slider.end=len(wf.segments)
+    update_heatmap()
+    score_segments()
+    if seg_slider.value != 1:
+        seg_slider.value = 1
+    else:
+        show_segment(1)
         
     # Enable elements on vitals panel
     seg_button.disabled = False
@@ -447,36 +561,39 @@ def load_cb ():
     seg_button.button_type = 'success'
     print ('Read complete')
     
-# Handler for removing / adding vital plots using checkbox_group    
-def checkbox_click_handler(selected_checkboxes):
-    visible_glyphs = vs_plots.children
-    for index, glyph in enumerate(p_dict):
-        if index in selected_checkboxes:
-            if p_dict[glyph] not in visible_glyphs:
-                vs_plots.children.append(p_dict[glyph])
-        else:
-            if p_dict[glyph] in visible_glyphs:
-                vs_plots.children.remove(p_dict[glyph])
-                
-def date_time_slider(attr, old, new):
-    dates = date_range_slider.value
-    vs_start = pd.Timestamp(dates[0]/1000,unit='s')
-    vs_end = pd.Timestamp(dates[1]/1000,unit='s')
-    hours, minutes, seconds = duration_HMS(vs_start, vs_end)
-    fname = os.path.split(active_file)[1]
-    print('Current File: {0:s}\nSelected Duration: {1:0.0f}:{2:02.0f}:{3:02.0f}'.format(fname, hours,minutes,seconds))
-    selected_duration.text = ('Selected Duration: {0:0.0f}:{1:02.0f}:{2:02.0f}'.format(hours,minutes,seconds))
-    selected_dates.text =str(vs_start.round('s')) + ' to ' + str(vs_end.round('s'))
-    start_span.location = dates[0]
-    end_span.location = dates[1]
+# Showing / hiding vital plots using checkbox_group (plots stay in the layout, only visibility changes)
+checkbox_click_handler = CustomJS(args=dict(plots=[p_dict[x] for x in p_dict]), code="""
+    for (let j = 0; j < plots.length; j++) {
+        plots[j].visible = cb_obj.active.indexOf(j) >= 0;
+    }
+""")
+
+# Moving the area of interest spans and updating the duration / date text with the range slider
+date_time_slider = CustomJS(args=dict(start_span=start_span, end_span=end_span, duration=selected_duration, dates=selected_dates), code="""
+    const start = cb_obj.value[0];
+    const end = cb_obj.value[1];
+    start_span.location = start;
+    end_span.location = end;
+    const secs = Math.round((end - start) / 1000);
+    const hours = Math.floor(secs / 3600);
+    const minutes = Math.floor((secs % 3600) / 60);
+    const seconds = secs % 60;
+    const pad = (x) => (x < 10 ? '0' : '') + x;
+    duration.text = 'Selected Duration: ' + hours + ':' + pad(minutes) + ':' + pad(seconds);
+    const fmt = (t) => new Date(Math.round(t / 1000) * 1000).toISOString().slice(0, 19).replace('T', ' ');
+    dates.text = fmt(start) + ' to ' + fmt(end);
+""")
 
 seg_button.on_click(load_cb)
-checkbox_group.on_click(checkbox_click_handler)
-date_range_slider.on_change('value',date_time_slider)
-wf_radio_button.on_change('active',wf_switch)
+hrv_button.on_click(hrv_cb)
+show_hrv()
+checkbox_group.js_on_change('active', checkbox_click_handler)
+date_range_slider.js_on_change('value', date_time_slider)
+wf_radio_button.js_on_change('active', wf_switch)
+wf_radio_button.on_change('active', channel_cb)
 
 vs_layout = column()
-vs_layout.children.append(widgetbox(wf_radio_button, selected_file, selected_duration, seg_button, checkbox_group, date_range_slider, selected_dates))
+vs_layout.children.append(widgetbox(wf_radio_button, selected_file, selected_duration, seg_button, hrv_button, checkbox_group, date_range_slider, selected_dates))
 
 vs_layout.children.append(p_main)
 vs_plots = column()
@@ -492,6 +609,7 @@ vs_tab = Panel(child=vs_layout, title = 'Vitals')
 
 ## Waveform callbacks ##
 
+@wf_sources.timed_callback
 def save_button_cb ():
     choice = wf_classes[rbg.active]
     N = seg_slider.value
@@ -506,14 +624,98 @@ def save_button_cb ():
     db_row['seg_class'] = choice # assign the classification to the entry row
     db_row['seg_start_time'] = wvt.seg_start_time[N]
     db_row['seg_length']  = wvt.section_size
+    db_row['Fs']  = wvt.Fs
     db_row['channel']  = wvt.seg_channel
+    db_row['seg_row'] = wvt.seg_rows[N]  # record row offset - segments are anchored to a fixed grid of rows
     # write to the database
     db = sqlite3.connect(db_file)
+    wfm.ensure_columns(db, 'segments', dict({'seg_row':'INTEGER', 'channel':'TEXT', 'seg_length':'INTEGER', 'Fs':'FLOAT'},
+                                            **wf_spectral.column_types()))
     db_row.to_sql("segments", db, if_exists='append', index=False)
     db.close()
+    annotated_rows.add(wvt.seg_rows[N])
     print (db_row.head(1))
     seg_slider.value += 1
 
+def find_similar_cb ():
+    # query the catalog feature index (built from the features table by wf_batch.py) with the current segment
+    global feature_index
+    N = seg_slider.value
+    if N not in wvt.wltFeatures.index or N in wvt.rejected:
+        similar_txt.text = 'Segment {} has no features (rejected: {})'.format(N, wvt.reject.reasons[N] if N in wvt.rejected else 'bad segment')
+        return
+    if feature_index is None or not wf_meta.same_rate(feature_index.Fs, wf.Fs):
+        try:
+            feature_index = wf_similarity.FeatureIndex.from_db(db_file, Fs=wf.Fs)
+        except Exception as e:
+            similar_txt.text = str(e)
+            return
+    # leave the segment itself out of the results when the current file is in the catalog
+    row = feature_index.locate(active_file, N, wf.seg_channel, start_time=wf.seg_start_time[N])
+    res = feature_index.query(wvt.wltFeatures.loc[N], k=10, exclude=row)
+    res['file'] = [os.path.basename(f) for f in res['file']]
+    similar_source.data = {c: res[c].values for c in res.columns}
+    similar_txt.text = 'Segments similar to segment {} ({:0.1f} ms)'.format(N, feature_index.last_query_ms)
+
+def score_segments ():
+    # score the loaded segments with the saved model and order them by uncertainty (see wf_model.py)
+    global seg_scores, model
+    model = wf_model.load_model(db_file)
+    annotated_rows.clear()
+    db = sqlite3.connect(db_file)
+    try:
+        done = pd.read_sql('SELECT seg_row FROM segments WHERE file = ? AND seg_row IS NOT NULL', db, params=(active_file,))
+        annotated_rows.update(int(x) for x in done['seg_row'])
+    except Exception:
+        pass   # no segments table yet or one without seg_row
+    db.close()
+    if model is None:
+        seg_scores = None
+        model_txt.text = 'No model trained (python wf_model.py {} train)'.format(db_file)
+        return
+    if not wf_meta.same_rate(model.Fs, wf.Fs):
+        seg_scores = None
+        model_txt.text = 'Model was trained on {:g} Hz segments, this file is {:g} Hz'.format(model.Fs, wf.Fs)
+        return
+    seg_scores = model.score(wvt.wltFeatures)
+    model_txt.text = 'Model scores for {} segments'.format(len(seg_scores))
+
+def show_score (N):
+    if seg_scores is None or N not in seg_scores.index or seg_scores.pred[N] is None:
+        return
+    model_txt.text = 'Segment {}: model predicts {} (uncertainty {:0.2f})'.format(N, seg_scores.pred[N], seg_scores.uncertainty[N])
+
+def next_informative_cb ():
+    # jump to the most uncertain segment not annotated yet
+    if seg_scores is None:
+        return
+    exclude = [n for n, r in wvt.seg_rows.items() if r in annotated_rows] + list(wvt.rejected)
+    queue = wf_model.annotation_queue(seg_scores, exclude)
+    if not queue:
+        model_txt.text = 'All scored segments are annotated'
+        return
+    seg_slider.value = int(queue[0])
+    model_txt.text = model_txt.text + ' - {} left in queue'.format(len(queue) - 1)
+
+def update_heatmap ():
+    # wavelet energies of all loaded segments as one image, binned server side to the plot width
+    n = len(wf.segments)
+    df = wvt.wavelets.reindex(range(1, n + 1))
+    img, per_bin = wf_sources.binned_image(df, max_cols=heat_width)
+    heat_source.data = {'image': [img], 'x': [0.5], 'y': [0], 'dw': [img.shape[1] * per_bin], 'dh': [img.shape[0]]}
+    p_heat.x_range.start = 0.5
+    p_heat.x_range.end = n + 0.5
+    p_heat.y_range.end = img.shape[0]
+    p_heat.yaxis.ticker = FixedTicker(ticks=[i + 0.5 for i in range(len(df.columns))])
+    p_heat.yaxis.major_label_overrides = {str(i + 0.5): c for i, c in enumerate(df.columns)}
+    p_heat.title.text = 'Wavelet energies: {} segments, {} per column'.format(n, per_bin)
+
+def heat_tap_cb (event):
+    # clicking a heatmap column selects that segment (x is in segment numbers)
+    if seg_slider.disabled or event.x is None:
+        return
+    seg_slider.value = int(min(max(round(event.x), seg_slider.start), seg_slider.end))
+
 def slider_plus(): 
     if seg_slider.value != seg_slider.end:
         seg_slider.value += 1
@@ -525,42 +727,51 @@ def slider_minus():
 def disable_wf_panel(disable = True):
     seg_slider.disabled = disable
     save_seg_button.disabled = disable
+    similar_button.disabled = disable
+    next_button.disabled = disable
     plus.disabled = disable
     minus.disabled = disable
     
-def seg_callback (attr, old, new):
-    # segment selection callback
-    # add functionality to update the segment classification selector based on previously assigned classification (eg rbg.active)
+def show_segment (N):
+    # push segment N to the waveform panel as typed arrays (epoch-ms times, float32 values)
+    seg = wf.segments[N]
+    data = wf_sources.set_source(wf_source, seg, name='wf_source', index_name='index')
+    wf_start = data['index'][0]
+    wf_end = data['index'][-1]
     
-    N = seg_slider.value
-    wf_source.data = ColumnDataSource(wf.segments[N]).data
+    # pressor overlay for the time span of this segment
     if p:
-        pressor_seg.data = ColumnDataSource(p.DFpressors.loc[(p.DFpressors.index >= pd.to_datetime(p_seg.x_range.start/1000, unit = 's')) & (p.DFpressors.index <= pd.to_datetime(p_seg.x_range.end/1000, unit = 's'))]).data
-    if show_peaks.active == 'no':
-        df = pd.DataFrame(wf_source.data)
-        df['DateTime'] = wf_source.data['index']
-        try: ind = [x.item() for x in pd.to_numeric(df['index'])]
-        except AttributeError: ind = list(pd.to_numeric(df['index']))
-        try: ecg = [x.item()*1000 for x in df['II']]
-        except AttributeError: ecg = list(df['II']*1000)
-        ann, anntype = eng.wrapper(ind,ecg,'wf_files/'+active_file.split('\\')[-1].split('.')[0],240,nargout=2)
+        pressors = p.DFpressors.loc[(p.DFpressors.index >= seg.index[0]) & (p.DFpressors.index <= seg.index[-1])]
+        wf_sources.set_source(pressor_seg, pressors, name='pressor_seg')
+    
+    # Show R peaks if selected
+    if show_peaks.active == 'no': #deactivated
+        ind = seg.index.asi8.tolist()
+        ecg = (seg['II'].values*1000).tolist()
+        ann, anntype = eng.wrapper(ind,ecg,'wf_files/'+active_file.split('\\')[-1].split('.')[0],wf.Fs,nargout=2)
         R_peaks = [int(ann[i][0]) for i, e in enumerate(anntype) if e == 'N']
-        ann_source.data = ColumnDataSource(df.iloc[R_peaks,:]).data
+        wf_sources.set_source(ann_source, seg.iloc[R_peaks,:], name='ann_source', index_name='index', aliases=('DateTime',))
         
-    wf_start = pd.to_datetime(min(wf_source.data['index'])).timestamp()*1000
-    wf_end = pd.to_datetime(max(wf_source.data['index'])).timestamp()*1000
+    heat_span.location = N
+    template_view.update(seg, wf.seg_channel, title='Segment {} beats'.format(N))
     p_seg.x_range.start = wf_start
     p_seg.x_range.end = wf_end
     p_wf_II.x_range.start = wf_start
     p_wf_II.x_range.end = wf_end
+
+@wf_sources.timed_callback
+def seg_callback (attr, old, new):
+    # segment selection callback
+    # add functionality to update the segment classification selector based on previously assigned classification (eg rbg.active)
+    show_segment(seg_slider.value)
+    show_score(seg_slider.value)
     
 
 cur_file_box = Paragraph(text='Current File: '+ str(active_file.split('\\')[-1]))
 
-wf_source = ColumnDataSource(pd.read_hdf(active_file,key='Waveforms',stop=1))
-df = pd.DataFrame(wf_source.data)
-df['DateTime'] = wf_source.data['index']
-ann_source = ColumnDataSource(df)
+wf_first_row = pd.read_hdf(active_file,key='Waveforms',stop=1)
+wf_source = ColumnDataSource(wf_sources.frame_to_columns(wf_first_row, index_name='index'))
+ann_source = ColumnDataSource(wf_sources.frame_to_columns(wf_first_row, index_name='index', aliases=('DateTime',)))
 
 p_seg = figure(x_axis_label='Datetime',y_axis_label='ABP (mmHg)', x_axis_type='datetime', 
           tools=['box_zoom', 'xwheel_zoom', 'pan', hover, 'reset','crosshair'], plot_width=1000, plot_height = 400)
@@ -569,12 +780,15 @@ p_wf_II = figure(x_axis_label='Datetime',y_axis_label='II (mV)', x_axis_type='da
           tools=['box_zoom', 'xwheel_zoom', 'pan', hover, 'reset','crosshair'], plot_width=1000, plot_height = 400)
 p_wf_II.x_range = p_seg.x_range
 
+# beat templates of the current segment (one multi_line glyph + percentile envelope)
+template_view = abp_templates.TemplateView(plot_width=400, plot_height=400)
+
 wf_line = p_seg.line('index',wf_types[wf_radio_button.active], source=wf_source, color = next(colors))
 
 p_seg.extra_y_ranges = {"pressor_wf": Range1d(start=0, end=20)}
 p_seg.add_layout(LinearAxis(y_range_name="pressor_wf"), 'right')
 if p:
-    pressor_seg = ColumnDataSource(p.DFpressors)
+    pressor_seg = ColumnDataSource(wf_sources.frame_to_columns(p.DFpressors))
     pressor_seg_glyph = p_seg.circle(x = 'DateTime',y='value',source = pressor_seg,color = 'red',y_range_name="pressor_wf")
     PressorSegHoverTool = HoverTool(
         name= 'Pressor Hover',
@@ -590,21 +804,54 @@ II_c = p_wf_II.circle(x='DateTime',y='II',source=ann_source,color=next(colors))
 point_draw = PointDrawTool(renderers=[II_c])
 p_wf_II.add_tools(point_draw)
 
-seg_slider = Slider(start=1, end=2, value=1, step=1, title="Segment", disabled = True)
-save_seg_button = Button(label='Save Segment', button_type='success', disabled = True)
+# linked wavelet heatmap (replaces the seaborn plot_heatmap window) - x is the segment number
+heat_width = 1000
+heat_source = ColumnDataSource(data={'image': [np.zeros((1, 1), dtype=np.float32)], 'x': [0.5], 'y': [0], 'dw': [1], 'dh': [1]})
+heat_mapper = LinearColorMapper(palette=Viridis256, low=0, high=1, nan_color=(0, 0, 0, 0))
+p_heat = figure(x_axis_label='Segment', tools=['xwheel_zoom', 'xpan', 'reset', 'tap'], plot_width=heat_width, plot_height=200,
+                x_range=(0.5, 1.5), y_range=(0, 1), title='Wavelet energies')
+p_heat.image(image='image', x='x', y='y', dw='dw', dh='dh', source=heat_source, color_mapper=heat_mapper)
+heat_span = Span(location=1, dimension='height', line_color='red', line_width=2)
+p_heat.add_layout(heat_span)
+p_heat.on_event(Tap, heat_tap_cb)
+
+seg_slider = Slider(start=1, end=2, value=1, step=1, title="Segment", disabled = True, name='seg_slider')
+save_seg_button = Button(label='Save Segment', button_type='success', disabled = True, name='save_seg_button')
     
 seg_slider.on_change('value', seg_callback)    
 save_seg_button.on_click(save_button_cb)
+
+model = None
+seg_scores = None       # model scores of the loaded segments (wf_model.SegmentModel.score)
+annotated_rows = set()  # seg_row of segments of the active file already in the segments table
+next_button = Button(label='Next Most Informative', button_type='primary', disabled = True, name='next_button')
+next_button.on_click(next_informative_cb)
+model_txt = Paragraph(text='')
+
+feature_index = None
+similar_button = Button(label='Find Similar', button_type='primary', disabled = True)
+similar_button.on_click(find_similar_cb)
+similar_txt = Paragraph(text='')
+similar_source = ColumnDataSource(data={x:[] for x in wf_similarity.id_cols + ['distance']})
+similar_table = DataTable(source=similar_source, width=800, height=280, columns=[
+    TableColumn(field='file', title='File'),
+    TableColumn(field='channel', title='Channel'),
+    TableColumn(field='seg', title='Segment'),
+    TableColumn(field='seg_start_time', title='Start Time'),
+    TableColumn(field='distance', title='Distance'),
+])
 show_peaks = CheckboxGroup(labels = ['R Peaks'], active = [0])
-rbg = RadioButtonGroup ( labels = wf_classes, active = 0)
+rbg = RadioButtonGroup ( labels = wf_classes, active = 0, name='rbg')
 plus = Button(label = '+')
 minus = Button(label = '-')
 plus.on_click(slider_plus)
 minus.on_click(slider_minus)
 
-wf_layout = layout(children = [show_peaks, cur_file_box, row(minus, seg_slider, plus), rbg, save_seg_button])
-wf_layout.children.append(p_seg)
+wf_layout = layout(children = [show_peaks, cur_file_box, row(minus, seg_slider, plus), rbg, save_seg_button, row(next_button, model_txt)])
+wf_layout.children.append(p_heat)
+wf_layout.children.append(row(p_seg, template_view.figure))
 wf_layout.children.append(p_wf_II)
+wf_layout.children.append(column(row(similar_button, similar_txt), similar_table))
 wf_tab = Panel(child = wf_layout, title = 'Waveforms')
 
 ##################################  Bokeh Output ##################################
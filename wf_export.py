@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_export.py
+
+Columnar training set export of annotated segments and a streaming batch loader
+
+export() reads the labelled rows of the segments table, re-reads the segments' samples from their case files (by
+record row, see seg_row; nearby segments of a file are read together in blocks of up to block_rows rows) and writes
+them to sharded .npy arrays in an output directory:
+
+    X_0000.npy      float32 (n, channels, seg_length) cleaned samples of the segment channel and ECG lead II
+    F_0000.npy      float32 (n, features) feature columns from the segments table
+    y_0000.npy      int16 (n,) label index into manifest['labels']
+    meta.csv        one row per exported segment: shard, offset, entry, file, channel, seg, seg_row, seg_class
+    manifest.json   shard names and sizes, channels, seg_length, feature and label names
+
+Segments are assigned to shards in a random (seeded) order, so every shard mixes all the files, but the samples are
+still read file by file in record order and each segment is written to its (shard, offset) through the shards'
+np.lib.format.open_memmap handles; only one block is held in memory while exporting. The shards can be opened with
+mmap_mode='r'. SegmentLoader iterates over them in shuffled batches, keeping at most shards_in_memory shards mapped
+at a time, so a training epoch never opens the hdf5 case files:
+
+    python wf_export.py workflow.db training_set [--Fs 240] [--shard-size 2048] [--seed 0]
+
+A training set holds segments of one record rate (Fs, default wf_meta.default_Fs, rows saved without Fs count as
+that rate) and so one segment length, wf_meta.section_size(8, Fs) unless --seg-length is given.
+
+    for X, F, y in SegmentLoader('training_set', batch_size=64):
+        ...
+
+"""
+
+import os
+import os.path
+import json
+import sqlite3
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import waveform
+import wf_meta
+import wf_spectral
+import wf_file_management as wfm
+
+export_channels = ['wave', 'II']   # the segment channel (AR1/CVP1/...) and the ECG lead
+unlabelled = ['Unclassified']
+block_rows = 2**20                 # most record rows read at once for the segments of one file
+
+
+def labelled_segments (db_file, seg_length=6400, Fs=wf_meta.default_Fs):
+    # annotated segments of one record rate and length with a usable record row
+    db = sqlite3.connect(db_file)
+    df = pd.read_sql('SELECT * FROM segments', db)
+    db.close()
+    df = df[~df['seg_class'].isin(unlabelled) & df['seg_class'].notnull()]
+    if 'Fs' in df.columns:
+        df = df[wf_meta.same_rate(df['Fs'].values, Fs)]
+    if 'seg_length' in df.columns:
+        df = df[df['seg_length'].fillna(seg_length) == seg_length]
+    if 'channel' not in df.columns:
+        df['channel'] = 'AR1'
+    if 'seg_row' not in df.columns:
+        df['seg_row'] = np.nan
+    return df.reset_index(drop=True)
+
+def legacy_rows (df, seg_length):
+    # segments saved before seg_row existed: seg_start_time is the time of the sample after the segment rounded to
+    # the second, so one segment length before it is the start row give or take Fs rows. The estimate is snapped to
+    # the nearest start of the segment grid (wf_meta) when one is that close - segments of whole file reads start
+    # on the grid unless a gap came before them - and otherwise kept with that error.
+    missing = df['seg_row'].isnull()
+    for i in df.index[missing]:
+        meta = wf_meta.get_meta(df.at[i, 'file'])
+        r, _ = meta.rows_for(df.at[i, 'seg_start_time'], df.at[i, 'seg_start_time'])
+        if r < seg_length:
+            df.at[i, 'seg_row'] = np.nan
+            continue
+        r -= seg_length
+        grid = meta.segment_grid(seg_length)
+        if len(grid):
+            g = grid[np.argmin(np.abs(grid - r))]
+            if abs(g - r) <= meta.Fs:
+                r = g
+        df.at[i, 'seg_row'] = r
+    return df[df['seg_row'].notnull()].astype({'seg_row': np.int64})
+
+def read_blocks (filename, rows, seg_length, max_rows=block_rows):
+    # rows: segments of one file sorted by seg_row; reads segments that are near each other (within max_rows) in one
+    # go and yields (Waveform holding the block, first row of the block, the block's segments)
+    starts = rows['seg_row'].values
+    a = 0
+    while a < len(starts):
+        b = a + 1
+        while b < len(starts) and starts[b] + seg_length - starts[a] <= max_rows and starts[b] - starts[b-1] <= seg_length * 4:
+            b += 1
+        wf = waveform.Waveform(compact=True)
+        wf.read_rows(filename, int(starts[a]), int(starts[b-1]) + seg_length)
+        yield wf, int(starts[a]), rows.iloc[a:b]
+        a = b
+
+def segment_array (wf, channel, start, seg_length):
+    # cleaned (channel, II) samples of rows start:start+seg_length of a block as a (2, seg_length) float32 array
+    out = np.zeros((len(export_channels), seg_length), dtype=np.float32)
+    for j, chan in enumerate([channel.split('-')[0], 'II']):
+        if chan in wf.waves.columns:
+            values = wf.channel_values(chan, start, start + seg_length)
+            out[j, :len(values)] = values
+    return out
+
+def export (db_file, out_dir, seg_length=None, shard_size=2048, seed=0, Fs=wf_meta.default_Fs):
+    t0 = time.time()
+    seg_length = seg_length or wf_meta.section_size(8, Fs)
+    df = legacy_rows(labelled_segments(db_file, seg_length, Fs), seg_length)
+    df = df.sort_values(['file', 'seg_row']).reset_index(drop=True)   # sequential reads within each file
+    features = [c for c in wfm.feature_cols + wf_spectral.spectral_columns() if c in df.columns]
+    labels = sorted(df['seg_class'].unique())
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    # random (shard, offset) for every segment so the loader's shuffle buffer never holds just one or two files
+    position = np.random.RandomState(seed).permutation(len(df))
+    df['shard'] = position // shard_size
+    df['offset'] = position % shard_size
+    names = ['{:04d}'.format(k) for k in range(-(-len(df) // shard_size))]
+    X = [np.lib.format.open_memmap(os.path.join(out_dir, 'X_{}.npy'.format(name)), mode='w+', dtype=np.float32,
+                                   shape=(min(shard_size, len(df) - k * shard_size), len(export_channels), seg_length))
+         for k, name in enumerate(names)]
+    for filename, rows in df.groupby('file', sort=False):
+        for wf, first_row, block in read_blocks(filename, rows, seg_length):
+            for row in block.itertuples():
+                X[row.shard][row.offset] = segment_array(wf, row.channel, int(row.seg_row) - first_row, seg_length)
+        print ('{}: {} segments ({:0.1f} s)'.format(filename, len(rows), time.time()-t0))
+
+    shards = []
+    df = df.sort_values(['shard', 'offset']).reset_index(drop=True)
+    for k, part in df.groupby('shard'):
+        name = names[k]
+        X[k].flush()
+        np.save(os.path.join(out_dir, 'F_{}.npy'.format(name)), part[features].to_numpy(dtype=np.float32))
+        np.save(os.path.join(out_dir, 'y_{}.npy'.format(name)), part['seg_class'].map(labels.index).to_numpy(dtype=np.int16))
+        shards.append({'name': name, 'rows': len(part)})
+    del X
+
+    meta_cols = ['shard', 'offset', 'entry', 'file', 'channel', 'seg', 'seg_row', 'seg_class']
+    df[[c for c in meta_cols if c in df.columns]].to_csv(os.path.join(out_dir, 'meta.csv'), index=False)
+    manifest = {'db_file': db_file, 'Fs': Fs, 'seg_length': seg_length, 'seed': seed, 'channels': export_channels,
+                'features': features, 'labels': labels, 'shards': shards, 'rows': int(len(df))}
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    print ('Exported {} segments in {} shards to {} ({:0.1f} s)'.format(len(df), len(shards), out_dir, time.time()-t0))
+    return manifest
+
+
+class SegmentLoader:
+
+    def __init__ (self, path, batch_size=64, shuffle=True, seed=None, shards_in_memory=2):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shards_in_memory = max(shards_in_memory, 1)
+        self.rng = np.random.RandomState(seed)
+
+    def __len__ (self):
+        # batches per epoch
+        return -(-self.manifest['rows'] // self.batch_size)
+
+    def _open (self, name):
+        load = lambda x: np.load(os.path.join(self.path, '{}_{}.npy'.format(x, name)), mmap_mode='r')
+        return load('X'), load('F'), load('y')
+
+    def __iter__ (self):
+        # shuffled batches: shards are visited in random order, shards_in_memory at a time, and the rows of the open
+        # shards are shuffled together; each batch is a copy gathered from the memory mapped arrays
+        names = [s['name'] for s in self.manifest['shards']]
+        if self.shuffle:
+            self.rng.shuffle(names)
+        for g in range(0, len(names), self.shards_in_memory):
+            opened = [self._open(name) for name in names[g:g + self.shards_in_memory]]
+            index = np.concatenate([np.stack([np.full(len(o[2]), i), np.arange(len(o[2]))], axis=1)
+                                    for i, o in enumerate(opened)])
+            if self.shuffle:
+                index = index[self.rng.permutation(len(index))]
+            for b in range(0, len(index), self.batch_size):
+                batch = index[b:b + self.batch_size]
+                X, F, y = [], [], []
+                for i in np.unique(batch[:, 0]):
+                    rows = np.sort(batch[batch[:, 0] == i, 1])   # sorted rows read the mapped pages in order
+                    X.append(opened[i][0][rows])
+                    F.append(opened[i][1][rows])
+                    y.append(opened[i][2][rows])
+                yield np.concatenate(X), np.concatenate(F), np.concatenate(y)
+            del opened
+
+def main ():
+    parser = argparse.ArgumentParser(description='Export annotated segments to sharded .npy arrays for training')
+    parser.add_argument('db_file', help='workflow sqlite DB with a segments table')
+    parser.add_argument('out_dir', help='output directory for the shards and manifest')
+    parser.add_argument('--Fs', type=float, default=wf_meta.default_Fs, help='record rate (Hz) of the segments to export')
+    parser.add_argument('--seg-length', type=int, default=None, help='segment length in samples (default: wf_meta.section_size at level 8)')
+    parser.add_argument('--shard-size', type=int, default=2048, help='segments per shard')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the random assignment of segments to shards')
+    args = parser.parse_args()
+    export(args.db_file, args.out_dir, seg_length=args.seg_length, shard_size=args.shard_size, seed=args.seed, Fs=args.Fs)
+
+if __name__ == "__main__":
+
+    main ()
@@ -10,6 +10,9 @@ Workflow is based on a specific sqlite DB file for each task
 
 Currently implemented: 
     - make file table
+    - make feature table (batch processing output, see wf_batch.py)
+    - make channel table (per channel profiles used to pick the ABP / CVP channels, see wf_profile.py)
+    - file status bookkeeping for resumable batch runs
     - read all hdf5 files in a specified directory
 
 To do:
@@ -23,6 +26,15 @@ import os.path
 import pandas as pd
 import glob
 
+# files.status values - batch runs (wf_batch.py) move files through these states
+STATUS_NEW = 0
+STATUS_RUNNING = 1
+STATUS_DONE = 2
+STATUS_ERROR = -1
+
+# per segment feature columns written by batch processing
+feature_cols = ['cA8','cD3','cD4','cD5','cD6','cD7','cD8','MAP','HR']
+
 def make_file_table(db_file):
     print ('Opening database connection')
     db = sqlite3.connect(db_file)
@@ -56,11 +68,82 @@ def make_seg_table (db_file):
                   cD8 FLOAT,
                   MAP FLOAT,
                   HR FLOAT,
-                  seg_class TEXT)''')
+                  seg_class TEXT,
+                  seg_row INTEGER,
+                  Fs FLOAT)''')
     # Commit the change
     db.commit()
     db.close()
 
+def make_feature_table (db_file):
+    # features for every segment of every processed file (unlabelled)
+    # one row per file/channel/segment, written in bulk by wf_batch.py
+    db = sqlite3.connect(db_file)
+    cursor = db.cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS features(id INTEGER PRIMARY KEY,
+                  entry TEXT,
+                  file TEXT,
+                  channel TEXT,
+                  seg INTEGER,
+                  seg_start_time TEXT,
+                  seg_length INTEGER,
+                  cA8 FLOAT,
+                  cD3 FLOAT, 
+                  cD4 FLOAT,
+                  cD5 FLOAT,
+                  cD6 FLOAT,
+                  cD7 FLOAT,
+                  cD8 FLOAT,
+                  MAP FLOAT,
+                  HR FLOAT,
+                  SQI FLOAT,
+                  bad INTEGER,
+                  reject TEXT,
+                  Fs FLOAT)''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS features_file ON features(file, channel, seg)')
+    db.commit()
+    ensure_columns(db, 'features', {'reject':'TEXT', 'Fs':'FLOAT'})
+    db.close()
+
+def make_channel_table (db_file):
+    # per channel profile of each file (see wf_profile.py); the channels picked from it are kept in the files table
+    db = sqlite3.connect(db_file)
+    db.execute('''CREATE TABLE IF NOT EXISTS channels(file TEXT,
+                  channel TEXT,
+                  coverage FLOAT,
+                  mean FLOAT,
+                  variance FLOAT,
+                  pulsatility FLOAT,
+                  PRIMARY KEY(file, channel))''')
+    db.commit()
+    ensure_columns(db, 'files', {'abp_channel':'TEXT', 'cvp_channel':'TEXT'})
+    db.close()
+
+def ensure_columns (db, table, columns):
+    # add any missing columns ({name: sqlite type}) to an existing table so older workflow DBs keep working
+    existing = [row[1] for row in db.execute('PRAGMA table_info({})'.format(table))]
+    if not existing:
+        return   # table doesn't exist yet - it will be created with all columns on first write
+    with db:
+        for name, col_type in columns.items():
+            if name not in existing:
+                print ('Adding column {} to table {}'.format(name, table))
+                db.execute('ALTER TABLE {} ADD COLUMN "{}" {}'.format(table, name, col_type))
+
+def set_file_status (db, filename, status):
+    # db is an open sqlite connection so status changes can share a transaction with the results
+    db.execute('UPDATE files SET status = ? WHERE filename = ?', (status, filename))
+
+def reset_running (db_file):
+    # files left in STATUS_RUNNING by a crashed batch run go back to the queue
+    db = sqlite3.connect(db_file)
+    with db:
+        n = db.execute('UPDATE files SET status = ? WHERE status = ?', (STATUS_NEW, STATUS_RUNNING)).rowcount
+    db.close()
+    if n:
+        print ('Reset {} interrupted files'.format(n))
+    return n
+
 
 def build_db (db_file, source):
     # if source is a file - interpret as csv
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_hrv.py
+
+Heart rate variability computed from the record's own R-peaks
+
+Replaces the offline _HRV csv files (getHRV in wf_explore.py) for cases that don't have one:
+
+    rpeaks(filename)                 R-peak record rows for the whole file, found block by block in lead II with the
+                                     biosppy ecg pipeline (as Waveform.wf_features) and cached in wf_meta.cache_dir
+    hrv(filename, window, step)      HRV over sliding windows, cached per file and window settings
+
+All windows are computed at once: the time domain metrics (SDNN, RMSSD, pNN50) come from cumulative sums over the
+RR series and the frequency domain metrics (LF, HF, LF/HF) from one batched FFT over a strided view of the RR
+tachogram resampled at resample_Fs. RR intervals across record gaps or outside rr_min..rr_max ms are ignored and
+windows with less than min_coverage of their duration in valid beats are NaN.
+
+"""
+
+import os
+import os.path
+import time
+
+import numpy as np
+import pandas as pd
+import biosppy.signals.ecg as ecg
+
+import waveform
+import wf_meta
+
+ecg_channel = 'II'
+block_rows = 2**18      # rows of ECG per R-peak detection block (about 18 minutes at 240 Hz)
+overlap_secs = 2.0      # context read on either side of a block so beats at the edges are found once
+rr_min, rr_max = 300, 2000      # ms - plausible RR intervals
+resample_Fs = 4.0       # Hz - tachogram sampling rate for the FFT
+lf_band = (0.04, 0.15)
+hf_band = (0.15, 0.4)
+min_coverage = 0.8
+hrv_cols = ['HR', 'SDNN', 'RMSSD', 'pNN50', 'LF', 'HF', 'LF_HF', 'beats']
+
+
+def _cache_ok (path, filename):
+    return os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(filename)
+
+def _save (path, **arrays):
+    wf_meta.save_npz(path, **arrays)
+
+def detect_rpeaks (filename):
+    # R-peak record rows for the whole file, one contiguous run at a time so no block straddles a gap
+    meta = wf_meta.get_meta(filename)
+    Fs = meta.Fs
+    ov = int(overlap_secs * Fs)
+    peaks = []
+    t0 = time.time()
+    for r0, r1 in meta.runs:
+        for a in range(int(r0), int(r1), block_rows):
+            b = min(a + block_rows, int(r1))
+            a0, b0 = max(a - ov, int(r0)), min(b + ov, int(r1))
+            if b0 - a0 < 2 * Fs:
+                continue
+            wf = waveform.Waveform(compact=True)
+            wf.read_rows(filename, a0, b0)
+            if ecg_channel not in wf.waves.columns:
+                continue
+            try:
+                r = np.asarray(ecg.ecg(wf.channel_values(ecg_channel).astype(np.float64), sampling_rate=Fs, show=False)['rpeaks'])
+            except Exception as e:
+                print ('R-peak detection failed for rows {} to {}: {}'.format(a0, b0, e))
+                continue
+            r = r + a0
+            peaks.append(r[(r >= a) & (r < b)])
+    print ('R-peaks for {}: {} beats in {:0.1f} s'.format(filename, sum(len(p) for p in peaks), time.time()-t0))
+    return np.concatenate(peaks).astype(np.int64) if peaks else np.zeros(0, dtype=np.int64)
+
+def rpeaks (filename):
+    # cached R-peak record rows
+    path = wf_meta.cache_path(filename, 'rpeaks.npz')
+    if _cache_ok(path, filename):
+        try:
+            with np.load(path) as cached:
+                return cached['rows']
+        except wf_meta.cache_errors as e:
+            print ('Ignoring unreadable R-peak cache {}: {}'.format(path, e))
+    rows = detect_rpeaks(filename)
+    _save(path, rows=rows)
+    return rows
+
+def rr_series (peak_times, run_ids):
+    # RR intervals (ms) ending at each beat after the first, and whether each one is usable
+    rr = np.diff(peak_times) / 1e6
+    valid = (run_ids[1:] == run_ids[:-1]) & (rr >= rr_min) & (rr <= rr_max)
+    return rr, valid
+
+def time_domain (t, rr, valid, starts, window_ns):
+    # SDNN / RMSSD / pNN50 / HR for every window from cumulative sums (t: time of the beat ending each interval)
+    x = np.where(valid, rr, 0.0)
+    c0 = np.concatenate([[0], np.cumsum(valid)])
+    c1 = np.concatenate([[0], np.cumsum(x)])
+    c2 = np.concatenate([[0], np.cumsum(x**2)])
+    d = np.diff(rr)
+    dv = valid[1:] & valid[:-1]
+    dd = np.where(dv, d, 0.0)
+    e0 = np.concatenate([[0, 0], np.cumsum(dv)])
+    e2 = np.concatenate([[0, 0], np.cumsum(dd**2)])
+    e50 = np.concatenate([[0, 0], np.cumsum(dv & (np.abs(dd) > 50))])
+
+    lo = np.searchsorted(t, starts, side='left')
+    hi = np.searchsorted(t, starts + window_ns, side='left')
+    n = c0[hi] - c0[lo]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (c1[hi] - c1[lo]) / n
+        sdnn = np.sqrt(np.maximum((c2[hi] - c2[lo]) / n - mean**2, 0) * n / (n - 1))
+        # successive differences whose later interval lies in the window
+        lo_d = np.minimum(lo + 1, hi)
+        nd = e0[hi] - e0[lo_d]
+        rmssd = np.sqrt((e2[hi] - e2[lo_d]) / nd)
+        pnn50 = 100.0 * (e50[hi] - e50[lo_d]) / nd
+        coverage = (c1[hi] - c1[lo]) / (window_ns / 1e6)
+    return pd.DataFrame({'HR': 60000.0 / mean, 'SDNN': sdnn, 'RMSSD': rmssd, 'pNN50': pnn50,
+                         'beats': n, 'coverage': coverage})
+
+def frequency_domain (t, rr, valid, starts, window_ns):
+    # LF / HF power (ms^2) of the resampled tachogram for every window from one batched FFT
+    nwin = len(starts)
+    out = np.full((nwin, 2), np.nan)
+    if valid.sum() < 2 or nwin == 0:
+        return out
+    dt = int(1e9 / resample_Fs)
+    grid = np.arange(starts[0], starts[-1] + window_ns, dt)
+    tach = np.interp(grid, t[valid], rr[valid])
+    L = int(window_ns // dt)
+    hop = int((starts[1] - starts[0]) // dt) if nwin > 1 else L
+    if len(tach) < L:
+        return out
+    count = min(nwin, (len(tach) - L) // hop + 1)
+    frames = np.lib.stride_tricks.as_strided(tach, shape=(count, L), strides=(tach.strides[0]*hop, tach.strides[0]))
+    frames = frames - frames.mean(axis=1, keepdims=True)
+    w = np.hanning(L)
+    P = np.abs(np.fft.rfft(frames * w, axis=1))**2 / (resample_Fs * (w**2).sum())
+    P[:, 1:] *= 2
+    f = np.fft.rfftfreq(L, 1 / resample_Fs)
+    df = f[1] - f[0]
+    for j, (lo, hi) in enumerate([lf_band, hf_band]):
+        sel = (f >= lo) & (f < hi)
+        out[:count, j] = P[:, sel].sum(axis=1) * df
+    return out
+
+def compute_hrv (filename, window=300, step=60):
+    # HRV over sliding windows of window seconds every step seconds, indexed by window centre time
+    meta = wf_meta.get_meta(filename)
+    rows = rpeaks(filename)
+    if len(rows) < 3:
+        return pd.DataFrame(columns=hrv_cols)
+    peak_times = meta.timestamps[rows]
+    run_ids = np.searchsorted(meta.runs[:, 0], rows, side='right') - 1
+    rr, valid = rr_series(peak_times, run_ids)
+    t = peak_times[1:]
+    window_ns = int(window * 1e9)
+    starts = np.arange(t[0], t[-1] - window_ns + 1, int(step * 1e9), dtype=np.int64)
+    if len(starts) == 0:
+        return pd.DataFrame(columns=hrv_cols)
+    df = time_domain(t, rr, valid, starts, window_ns)
+    fd = frequency_domain(t, rr, valid, starts, window_ns)
+    df['LF'] = fd[:, 0]
+    df['HF'] = fd[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['LF_HF'] = df['LF'] / df['HF']
+    df.loc[df['coverage'] < min_coverage, ['SDNN', 'RMSSD', 'pNN50', 'LF', 'HF', 'LF_HF']] = np.nan
+    df.index = pd.to_datetime(starts + window_ns // 2)
+    df.index.name = 'DateTime'
+    return df[hrv_cols]
+
+def hrv (filename, window=300, step=60):
+    # cached HRV table for a case file
+    path = wf_meta.cache_path(filename, 'hrv.W{}.S{}.npz'.format(window, step))
+    if _cache_ok(path, filename):
+        try:
+            with np.load(path) as cached:
+                df = pd.DataFrame(cached['values'], columns=hrv_cols, index=pd.to_datetime(cached['index']))
+            df.index.name = 'DateTime'
+            return df
+        except wf_meta.cache_errors as e:
+            print ('Ignoring unreadable HRV cache {}: {}'.format(path, e))
+    df = compute_hrv(filename, window, step)
+    if len(df) == 0:
+        return df
+    _save(path, values=df.values.astype(np.float64), index=df.index.asi8)
+    return df
+
+def cached (filename, window=300, step=60):
+    # True if the HRV table is already cached (so the viewer can show it without running R-peak detection)
+    return _cache_ok(wf_meta.cache_path(filename, 'hrv.W{}.S{}.npz'.format(window, step)), filename)
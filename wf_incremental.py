@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_incremental.py
+
+Incremental, grid anchored segmentation for the waveform viewer
+
+Segments are fixed blocks of record rows laid out from the start of each contiguous (gap free) run of the record
+(wf_meta.FileMeta.segment_grid), so they are the same whatever range is selected on the vitals tab and never
+straddle a gap. A selection maps onto the grid segments that lie completely inside it (using the cached
+timestamps in wf_meta), so when the range is
+nudged and "Segment File" is pressed again only the grid segments that were not processed before (normally
+the new edges) are read from the hdf5 file and run through the clean/segment/quality/features/wavelet stages.
+
+    grid = GridSegmenter(filename, 'AR1', level=8)
+    wf, wvt = grid.process(start_time, end_time)   # Waveform / ABPWavelet views numbered 1..N like load_cb expects
+    wvt.seg_rows[N]                                # record row offset (start row) of segment N
+
+process_segments() runs the stages on a Waveform that already holds cleaned rows; the live stream (wf_stream.py)
+uses it for each new segment.
+
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+import waveform
+import wf_meta
+import wf_spectral
+import wf_metrics
+
+
+def process_segments (wf, wvt_class, keep_raw=True):
+    # run the segment/quality/features/wavelet stages on a Waveform holding cleaned data
+    # returns {segment number: per segment results} (the entries GridSegmenter.view assembles)
+    t0 = time.time()
+    wf.segmenter()
+    wf.prescreen()
+    wf.check_times()
+    wf.wf_features()
+    wvt = wvt_class(wf, process=False)
+    wvt.processWaveform()
+    wvt.generateFeatures()
+    wf_spectral.join_features(wvt)
+    results = {}
+    for i in wf.segments:
+        results[i] = {
+            'segment': wf.segments[i] if keep_raw else None,
+            'start': wf.seg_start_time[i],
+            'features': wf.features.get(i, []) if hasattr(wf, 'features') else [],
+            'SQI': wf.seg_SQI.get(i, 0.0),
+            'MAP': getattr(wf, 'MAP', {}).get(i, 0),
+            'PP': getattr(wf, 'PP', {}).get(i, 0),
+            'PPV': getattr(wf, 'PPV', {}).get(i, 0),
+            'PVI': getattr(wf, 'PVI', {}).get(i, 0),
+            'HR': wf.HR.get(i, 0),
+            'reject': wf.reject.loc[i],
+            'bad_time': i in wf.bad_times,
+            'bad': i in wf.bad_segments,
+            'wlt': wvt.wltFeatures.loc[i],
+        }
+    wf_metrics.counter('wf_segments_processed_total', 'Segments run through the processing pipeline').inc(len(wf.segments))
+    wf_metrics.histogram('wf_segment_batch_seconds', 'Time to process a block of adjacent segments').observe(time.time() - t0)
+    return results
+
+
+def pipeline_classes (channel):
+    # (Waveform, Wavelet) classes for a segment channel
+    if channel.split('-')[0] in waveform.Waveform.CVP_cols:
+        return waveform.CVPWaveform, waveform.CVPWavelet
+    return waveform.Waveform, waveform.ABPWavelet
+
+
+class GridSegmenter:
+
+    def __init__ (self, filename, channel, level=8, compact=True, keep_raw=True):
+        # compact: read in float32 with the invalid sample bitmap (see Waveform.clean_compact)
+        # keep_raw: keep each segment's samples for display (False keeps only the per segment results)
+        self.filename = filename
+        self.compact = compact
+        self.keep_raw = keep_raw
+        self.channel = channel.split('-')[0]
+        self.level = level
+        self.wf_class, self.wvt_class = pipeline_classes(self.channel)
+        self.meta = wf_meta.get_meta(filename)
+        self.section_size = wf_meta.section_size(level, self.meta.Fs)
+        self.grid = self.meta.segment_grid(self.section_size)
+        self.done = {}   # grid segment start row -> per segment results
+
+    def matches (self, filename, channel, level):
+        return (self.filename, self.channel, self.level) == (filename, channel.split('-')[0], level)
+
+    def grid_range (self, start_time, end_time):
+        # start rows of the grid segments completely inside the selected time range
+        r0, r1 = self.meta.rows_for(start_time, end_time)
+        sel = (self.grid >= r0) & (self.grid + self.section_size <= r1)
+        return [int(k) for k in self.grid[sel]]
+
+    def runs (self, ks):
+        # split sorted segment start rows into blocks of adjacent segments: (first start row, last start row + section_size)
+        if not ks:
+            return []
+        ks = np.asarray(ks)
+        breaks = np.flatnonzero(np.diff(ks) != self.section_size) + 1
+        return [(int(r[0]), int(r[-1]) + self.section_size) for r in np.split(ks, breaks)]
+
+    def _process_run (self, start_row, stop_row, source=None):
+        # read and process the adjacent grid segments in rows start_row:stop_row
+        # one extra row is read so the segmenter produces every block (and the start time of the next one)
+        # source: a Waveform that already read exactly those rows (one read shared by several channels, see wf_chunked)
+        stop_row = min(stop_row + 1, self.meta.nrows)
+        wf = self.wf_class(level=self.level, seg_channel=self.channel, compact=self.compact)
+        if source is None:
+            wf.read_rows(self.filename, start_row, stop_row)
+        else:
+            wf.share(source)
+        for i, result in process_segments(wf, self.wvt_class, self.keep_raw).items():
+            self.done[start_row + (i - 1) * self.section_size] = result
+
+    def process (self, start_time, end_time):
+        # process any grid segments not seen before and return (wf, wvt) for the selection
+        ks = self.grid_range(start_time, end_time)
+        missing = [k for k in ks if k not in self.done]
+        print ('Selection covers {} grid segments, {} already processed, {} new'.format(len(ks), len(ks)-len(missing), len(missing)))
+        for start_row, stop_row in self.runs(missing):
+            self._process_run(start_row, stop_row)
+        ks = [k for k in ks if k in self.done]   # the last block of a file may be incomplete
+        return self.view(ks)
+
+    def view (self, ks):
+        # assemble Waveform / Wavelet objects for grid segments ks, numbered 1..N
+        wf = self.wf_class(level=self.level, seg_channel=self.channel)
+        results = [self.done[k] for k in ks]
+        N = range(1, len(ks) + 1)
+        wf.segments = {n: r['segment'] for n, r in zip(N, results)} if self.keep_raw else {}
+        wf.waves = pd.concat(list(wf.segments.values())) if wf.segments else pd.DataFrame(columns=[self.channel, 'II'])
+        wf.vitals = pd.DataFrame()
+        wf.Fs = self.meta.Fs
+        wf.section_size = self.section_size
+        wf.seg_start_time = {n: r['start'] for n, r in zip(N, results)}
+        wf.features = {n: r['features'] for n, r in zip(N, results)}
+        wf.seg_SQI = {n: r['SQI'] for n, r in zip(N, results)}
+        for attr in ['MAP', 'PP', 'PPV', 'PVI', 'HR']:
+            setattr(wf, attr, {n: r[attr] for n, r in zip(N, results)})
+        wf.reject = pd.DataFrame([r['reject'] for r in results], index=list(N))
+        wf.rejected = [n for n, r in zip(N, results) if r['reject']['reject']]
+        wf.bad_times = [n for n, r in zip(N, results) if r['bad_time']]
+        wf.bad_segments = [n for n, r in zip(N, results) if r['bad']]
+        wf.seg_rows = {n: k for n, k in zip(N, ks)}
+
+        wvt = self.wvt_class(wf, process=False)
+        wvt.segments = wf.segments
+        wvt.section_size = wf.section_size
+        wvt.bad_times = wf.bad_times
+        wvt.seg_rows = wf.seg_rows
+        wvt.wltFeatures = pd.DataFrame([r['wlt'] for r in results], index=list(N))
+        wvt.spectral = wvt.wltFeatures.reindex(columns=wf_spectral.spectral_columns())
+        wvt.wavelets = wvt.wltFeatures.drop(['MAP', 'HR'] + wf_spectral.spectral_columns(), axis=1, errors='ignore')
+        return wf, wvt
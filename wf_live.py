@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_live.py
+
+Live waveform view: streams a case file (replayed at its sample rate, or tailed while it is written) into Bokeh
+
+The rolling segment channel and ECG lead II plots show the last display_secs of samples, and every new segment's
+results (MAP, HR, SQI, reject / bad time) are added to the trend plot and table as soon as its stages finish
+(see wf_stream.py). A periodic callback every update_ms drains the stream and sends only the new rows with
+source.stream, so the browser keeps a fixed rolling window and nothing is resent. The lag paragraph shows the time
+from a sample's arrival to it being sent to the browser, and the processing lag of the last segment.
+
+    Usage: bokeh serve wf_live.py --args case.hd5 [--channel AR1] [--level 8] [--tail] [--speed 1]
+
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+from bokeh.io import curdoc
+from bokeh.layouts import column, row, widgetbox
+from bokeh.models import ColumnDataSource, DatetimeTickFormatter
+from bokeh.models.widgets import Paragraph, DataTable, TableColumn, NumberFormatter, DateFormatter
+from bokeh.plotting import figure
+
+import wf_sources
+import wf_stream
+
+update_ms = 100
+display_secs = 10
+trend_segments = 500   # segment results kept on the client
+
+parser = argparse.ArgumentParser(description='Live streaming waveform view')
+parser.add_argument('filename', help='converted hdf5 case file')
+parser.add_argument('--channel', default='AR1', help='segment channel (AR1, CVP1, ...)')
+parser.add_argument('--level', type=int, default=8, help='segmentation level')
+parser.add_argument('--tail', action='store_true', help='follow rows appended to the file instead of replaying it')
+parser.add_argument('--speed', type=float, default=1.0, help='replay speed relative to real time')
+parser.add_argument('--start-row', type=int, default=0, help='first row to replay')
+args = parser.parse_args(sys.argv[1:])
+
+if args.tail:
+    source = wf_stream.TailSource(args.filename)
+else:
+    source = wf_stream.ReplaySource(args.filename, start_row=args.start_row, speed=args.speed, loop=True)
+stream = wf_stream.LiveStream(source, args.channel, level=args.level)
+channel = stream.channel
+rollover = int(display_secs * source.Fs)
+
+wave_source = ColumnDataSource(data={'index': np.zeros(0), channel: np.zeros(0, dtype=np.float32),
+                                     'II': np.zeros(0, dtype=np.float32)})
+seg_source = ColumnDataSource(data={'time': np.zeros(0), 'seg': np.zeros(0), 'MAP': np.zeros(0), 'HR': np.zeros(0),
+                                    'SQI': np.zeros(0), 'reject': [], 'bad_time': [], 'lag': np.zeros(0)})
+
+tick_format = DatetimeTickFormatter(seconds=['%H:%M:%S'], minsecs=['%H:%M:%S'], minutes=['%H:%M'])
+p_wave = figure(plot_width=1000, plot_height=250, x_axis_type='datetime', title='{} (live)'.format(channel))
+p_wave.line('index', channel, source=wave_source, color='firebrick')
+p_wave.xaxis.formatter = tick_format
+p_ecg = figure(plot_width=1000, plot_height=200, x_axis_type='datetime', x_range=p_wave.x_range, title='II')
+p_ecg.line('index', 'II', source=wave_source, color='navy')
+p_ecg.xaxis.formatter = tick_format
+
+p_trend = figure(plot_width=1000, plot_height=200, x_axis_type='datetime', title='Segment MAP / HR')
+p_trend.circle('time', 'MAP', source=seg_source, color='firebrick', legend='MAP')
+p_trend.circle('time', 'HR', source=seg_source, color='green', legend='HR')
+
+seg_table = DataTable(source=seg_source, width=1000, height=200, columns=[
+    TableColumn(field='seg', title='Segment'),
+    TableColumn(field='time', title='Start', formatter=DateFormatter(format='%Y-%m-%d %H:%M:%S')),
+    TableColumn(field='MAP', title='MAP', formatter=NumberFormatter(format='0.0')),
+    TableColumn(field='HR', title='HR', formatter=NumberFormatter(format='0.0')),
+    TableColumn(field='SQI', title='SQI', formatter=NumberFormatter(format='0.00')),
+    TableColumn(field='reject', title='Reject'),
+    TableColumn(field='bad_time', title='Gap'),
+    TableColumn(field='lag', title='Processing (s)', formatter=NumberFormatter(format='0.00'))])
+
+lag_txt = Paragraph(text='Waiting for data from {}'.format(source.name), width=1000)
+
+def segment_frame (results):
+    # per segment results -> the scalar columns of seg_source
+    df = pd.DataFrame({
+        'seg': [r['seg'] for r in results],
+        'MAP': [float(r['MAP']) for r in results],
+        'HR': [float(r['HR']) for r in results],
+        'SQI': [float(np.mean(r['SQI'])) for r in results],
+        'reject': [str(bool(r['reject']['reject'])) for r in results],
+        'bad_time': [str(r['bad_time']) for r in results],
+        'lag': [r['lag'] for r in results]},
+        index=pd.DatetimeIndex([r['time'] for r in results], name='time'))
+    return df
+
+def update ():
+    waves, lag = stream.pop_samples()
+    if waves is not None:
+        cols = [c for c in [channel, 'II'] if c in waves.columns]
+        wf_sources.stream_frame(wave_source, waves[cols], rollover=rollover, index_name='index')
+    results = stream.pop_segments()
+    if results:
+        wf_sources.stream_frame(seg_source, segment_frame(results), rollover=trend_segments)
+    if stream.error is not None:
+        lag_txt.text = 'Stream stopped: {}'.format(stream.error)
+    elif waves is not None:
+        seg_lag = results[-1]['lag'] if results else None
+        lag_txt.text = 'Display lag {:0.0f} ms ({} rows), {} segments{}'.format(
+            lag*1000, len(waves), stream.segment_count,
+            '' if seg_lag is None else ', last segment processed in {:0.2f} s'.format(seg_lag))
+
+def session_destroyed (session_context):
+    stream.stop()
+
+stream.start()
+doc = curdoc()
+doc.add_periodic_callback(update, update_ms)
+doc.on_session_destroyed(session_destroyed)
+doc.add_root(column(p_wave, p_ecg, p_trend, row(seg_table), widgetbox(lag_txt)))
+doc.title = 'Live {}'.format(args.filename)
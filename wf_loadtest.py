@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_loadtest.py
+
+Load testing harness for the Bokeh annotation server (wf_explore.py)
+
+    python wf_loadtest.py run --sessions 1 2 4 8 [--cases 3] [--hours 1] [--steps 20] [--out loadtest]
+    python wf_loadtest.py report loadtest/run_*.json
+
+run writes synthetic cases (pulsatile AR1/CVP1 with a matching ECG lead II and 1 Hz vitals) and a workflow DB into
+the output directory, starts `bokeh serve wf_explore.py` on localhost, and for every session count drives that many
+concurrent bokeh.client sessions (one process each). Each scripted session
+
+    selects a file and presses Change File
+    sets the date range to a window of the record and presses Segment File
+    steps seg_slider through the segments and saves a label for each
+
+Widgets are found by name (see the name= arguments in wf_explore.py). Each action's latency is the time from the
+property change until a server round trip (request_server_info) returns - the server applies the change and runs
+the callback before it answers, and its resulting document patches arrive first.
+
+While sessions run the server process (and children, eg the MATLAB engine) is sampled with psutil for CPU and RSS,
+and loopback interface bytes are counted as the websocket traffic (everything on localhost, so keep the machine
+otherwise quiet). Each session count gives one run_<n>.json; report compares any set of runs.
+
+Buttons are pressed by incrementing Button.clicks, which is what Button.on_click listens to in the Bokeh version
+the app is written against.
+
+"""
+
+import os
+import os.path
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+import subprocess
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import psutil
+
+import wf_file_management as wfm
+
+app_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wf_explore.py')
+percentiles = [50, 90, 99]
+sample_secs = 0.5
+
+
+################################## Synthetic cases ##################################
+
+def synthetic_case (path, hours=1.0, Fs=240, seed=0, start='2018-01-01 08:00'):
+    # write a converted-case style hdf5 file with /Waveforms (AR1, CVP1, II) and /Vitals at 1 Hz
+    rng = np.random.RandomState(seed)
+    n = int(hours * 3600 * Fs)
+    t0 = pd.Timestamp(start).value
+    secs = np.arange(n) / Fs
+    hr = 70 + 8 * np.sin(2 * np.pi * secs / 900) + rng.normal(0, 0.5, n).cumsum() / np.sqrt(n)
+    phase = np.cumsum(hr / 60.0 / Fs)
+    frac = phase % 1.0
+    dist = np.minimum(frac, 1 - frac)
+    resp = np.sin(2 * np.pi * 0.25 * secs)
+    waves = pd.DataFrame({
+        'AR1': 75 + 45 * np.exp(-((frac - 0.2) / 0.12)**2) + 15 * np.exp(-((frac - 0.45) / 0.08)**2) + 3 * resp + rng.normal(0, 0.5, n),
+        'CVP1': 8 + 2 * np.sin(2 * np.pi * phase) + 1.5 * resp + rng.normal(0, 0.2, n),
+        'II': 1.2 * np.exp(-(dist / 0.012)**2) - 0.1 + rng.normal(0, 0.02, n),
+    }, index=pd.to_datetime(t0 + (secs * 1e9).astype(np.int64)))
+    step = Fs   # 1 Hz vitals
+    vitals = pd.DataFrame({
+        'AR1-M': waves['AR1'].values[::step][:n // step],
+        'CVP1': waves['CVP1'].values[::step][:n // step],
+        'HR': hr[::step][:n // step],
+        'SPO2-%': 97 + rng.normal(0, 0.5, n // step),
+    }, index=waves.index[::step][:n // step])
+    if os.path.isfile(path):
+        os.remove(path)
+    store = pd.HDFStore(path, 'w')
+    try:
+        for a in range(0, n, 500000):
+            store.append('Waveforms', waves.iloc[a:a + 500000].astype(np.float32), format='table')
+        store.append('Vitals', vitals.astype(np.float32), format='table')
+    finally:
+        store.close()
+    return path
+
+def make_cases (out_dir, ncases=3, hours=1.0):
+    # synthetic cases plus a workflow DB listing them
+    case_dir = os.path.join(out_dir, 'cases')
+    if not os.path.isdir(case_dir):
+        os.makedirs(case_dir)
+    for i in range(ncases):
+        path = os.path.join(case_dir, 'synthetic_case_{:03d}.hd5'.format(i + 1))
+        if not os.path.isfile(path):
+            print ('Writing synthetic case {}'.format(path))
+            synthetic_case(path, hours=hours, seed=i)
+    db_file = os.path.join(out_dir, 'loadtest.db')
+    wfm.build_db(db_file, case_dir)
+    wfm.make_seg_table(db_file)
+    return db_file
+
+
+################################## Server ##################################
+
+def free_port ():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_server (db_file, port):
+    cmd = [sys.executable, '-m', 'bokeh', 'serve', app_file, '--port', str(port),
+           '--allow-websocket-origin', 'localhost:{}'.format(port), '--args', db_file]
+    print (' '.join(cmd))
+    server = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise Exception('bokeh serve exited with code {}'.format(server.returncode))
+            time.sleep(0.5)
+    server.kill()
+    raise Exception('bokeh serve did not start on port {}'.format(port))
+
+
+class ResourceSampler (threading.Thread):
+    # samples CPU % and RSS of the server process tree, and loopback bytes, every sample_secs
+
+    def __init__ (self, pid):
+        threading.Thread.__init__(self, daemon=True)
+        self.proc = psutil.Process(pid)
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def _tree (self):
+        try:
+            return [self.proc] + self.proc.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return []
+
+    def _lo_bytes (self):
+        counters = psutil.net_io_counters(pernic=True)
+        lo = counters.get('lo') or counters.get('lo0')
+        return lo.bytes_sent if lo is not None else 0
+
+    def run (self):
+        for p in self._tree():
+            p.cpu_percent(None)   # first call primes the counters
+        self.lo0 = self._lo_bytes()
+        while not self.stopped.wait(sample_secs):
+            cpu, rss = 0.0, 0
+            for p in self._tree():
+                try:
+                    cpu += p.cpu_percent(None)
+                    rss += p.memory_info().rss
+                except psutil.NoSuchProcess:
+                    pass
+            self.samples.append((time.time(), cpu, rss))
+        self.lo_bytes = self._lo_bytes() - self.lo0
+
+    def stop (self):
+        self.stopped.set()
+        self.join()
+        return self.samples, self.lo_bytes
+
+
+################################## Scripted session ##################################
+
+def _click (button):
+    button.clicks += 1
+
+def _timed (session, log, action, fn):
+    # apply a change, wait for the server round trip and record the latency
+    t0 = time.time()
+    fn()
+    session.request_server_info()
+    log.append((action, (time.time() - t0) * 1000))
+
+def scripted_session (job):
+    # one annotator: select a file, segment a window, step through segments saving labels
+    url, session_no, steps, window_secs, seed = job
+    from bokeh.client import pull_session
+    rng = random.Random(seed)
+    log = []
+    try:
+        t0 = time.time()
+        session = pull_session(url=url)
+        log.append(('connect', (time.time() - t0) * 1000))
+        doc = session.document
+        get = doc.get_model_by_name
+        files = get('file_table')
+        nfiles = len(files.data['filename'])
+        i = (session_no + 1) % nfiles if nfiles > 1 else 0
+        _timed(session, log, 'select_file', lambda: (setattr(files.selected, 'indices', [i]), _click(get('sel_file_button'))))
+
+        slider = get('date_range_slider')
+        start = rng.uniform(slider.start, max(slider.start, slider.end - window_secs * 1000))
+        _timed(session, log, 'set_range', lambda: setattr(slider, 'value', (start, start + window_secs * 1000)))
+        _timed(session, log, 'segment', lambda: _click(get('seg_button')))
+
+        seg_slider = get('seg_slider')
+        rbg = get('rbg')
+        for k in range(steps):
+            rbg.active = rng.randrange(len(rbg.labels))
+            # save_button_cb saves the label and advances seg_slider (which runs seg_callback)
+            _timed(session, log, 'save', lambda: _click(get('save_seg_button')))
+            if seg_slider.value >= seg_slider.end:
+                break
+            _timed(session, log, 'step', lambda: setattr(seg_slider, 'value', max(seg_slider.start, seg_slider.value - 1)))
+            _timed(session, log, 'step', lambda: setattr(seg_slider, 'value', seg_slider.value + 1))
+        session.close()
+        return log, None
+    except Exception as e:
+        return log, '{}: {}'.format(type(e).__name__, e)
+
+
+################################## Runs and reports ##################################
+
+def run_load (db_file, sessions, out_dir, steps=20, window_secs=1800, port=None):
+    # one run per session count against a fresh server; returns the run summaries
+    summaries = []
+    for n in sessions:
+        port = port or free_port()
+        server = start_server(db_file, port)
+        url = 'http://localhost:{}/wf_explore'.format(port)
+        sampler = ResourceSampler(server.pid)
+        sampler.start()
+        t0 = time.time()
+        try:
+            with Pool(processes=n) as pool:
+                results = pool.map(scripted_session, [(url, s, steps, window_secs, s) for s in range(n)])
+        finally:
+            samples, lo_bytes = sampler.stop()
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        elapsed = time.time() - t0
+        summary = summarize(n, results, samples, lo_bytes, elapsed)
+        path = os.path.join(out_dir, 'run_{}.json'.format(n))
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=1)
+        print_summary(summary)
+        summaries.append(summary)
+        port = None
+    return summaries
+
+def summarize (n, results, samples, lo_bytes, elapsed):
+    log = pd.DataFrame([x for r, err in results for x in r], columns=['action', 'ms'])
+    latency = {}
+    for action, g in log.groupby('action'):
+        latency[action] = dict({'count': int(len(g))}, **{'p{}'.format(q): float(np.percentile(g['ms'], q)) for q in percentiles})
+    if len(log):
+        latency['all'] = dict({'count': int(len(log))}, **{'p{}'.format(q): float(np.percentile(log['ms'], q)) for q in percentiles})
+    S = np.array([(cpu, rss) for t, cpu, rss in samples]) if samples else np.zeros((0, 2))
+    return {'sessions': n, 'elapsed_s': elapsed, 'errors': [err for r, err in results if err],
+            'latency_ms': latency,
+            'cpu_mean': float(S[:, 0].mean()) if len(S) else None, 'cpu_max': float(S[:, 0].max()) if len(S) else None,
+            'rss_max_mb': float(S[:, 1].max() / 1e6) if len(S) else None,
+            'ws_mb': lo_bytes / 1e6, 'ws_mb_per_action': lo_bytes / 1e6 / max(len(log), 1)}
+
+def print_summary (s):
+    print ('{} sessions: {:0.0f} s, CPU mean {} % max {} %, RSS max {} MB, {:0.1f} MB over localhost, {} errors'.format(
+        s['sessions'], s['elapsed_s'], s['cpu_mean'], s['cpu_max'], s['rss_max_mb'], s['ws_mb'], len(s['errors'])))
+    for action, l in sorted(s['latency_ms'].items()):
+        print ('    {:12s} n={:5d}  '.format(action, l['count']) + '  '.join('p{} {:8.1f} ms'.format(q, l['p{}'.format(q)]) for q in percentiles))
+
+def report (paths):
+    # compare runs side by side: one row per run, latency percentiles of all actions plus resources
+    rows = []
+    for path in paths:
+        with open(path) as f:
+            s = json.load(f)
+        row = {'run': os.path.basename(path), 'sessions': s['sessions']}
+        for action in ['all', 'segment', 'step', 'save']:
+            for q in percentiles:
+                row['{}_p{}'.format(action, q)] = s['latency_ms'].get(action, {}).get('p{}'.format(q))
+        row.update({'cpu_mean': s['cpu_mean'], 'rss_max_mb': s['rss_max_mb'], 'ws_mb': s['ws_mb'], 'errors': len(s['errors'])})
+        rows.append(row)
+    df = pd.DataFrame(rows).sort_values('sessions')
+    with pd.option_context('display.width', 200, 'display.max_columns', 50, 'display.float_format', '{:0.1f}'.format):
+        print (df.to_string(index=False))
+    return df
+
+def main ():
+    parser = argparse.ArgumentParser(description='Load test the wf_explore Bokeh server with concurrent scripted sessions')
+    sub = parser.add_subparsers(dest='command')
+    r = sub.add_parser('run', help='run the load test')
+    r.add_argument('--sessions', type=int, nargs='+', default=[1, 2, 4, 8], help='concurrent session counts to test')
+    r.add_argument('--cases', type=int, default=3, help='number of synthetic cases')
+    r.add_argument('--hours', type=float, default=1.0, help='length of each synthetic case')
+    r.add_argument('--steps', type=int, default=20, help='segments saved per session')
+    r.add_argument('--window', type=float, default=1800, help='seconds of record segmented per session')
+    r.add_argument('--out', default='loadtest', help='output directory for cases, DB and run results')
+    c = sub.add_parser('report', help='compare run results')
+    c.add_argument('runs', nargs='+', help='run_<n>.json files')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        if not os.path.isdir(args.out):
+            os.makedirs(args.out)
+        db_file = make_cases(args.out, args.cases, args.hours)
+        run_load(db_file, args.sessions, args.out, steps=args.steps, window_secs=args.window)
+        report([os.path.join(args.out, 'run_{}.json'.format(n)) for n in args.sessions])
+    elif args.command == 'report':
+        report(args.runs)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+
+    main ()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_meta.py
+
+Cached per-file metadata for converted hdf5 case files
+
+The /Waveforms timestamps are read once (index column only, chunk_rows at a time) into an int64 nanosecond .npy
+file in cache_dir, which is then memory mapped, so that times can be mapped to record row offsets without scanning
+the table or holding the index in RAM. The rates and gap index go in a small .npz alongside it. The cache is
+rebuilt whenever the case file is newer than the cached metadata.
+
+The record sample rate (Fs) is the Fs attribute on /Waveforms when the converter declared one, otherwise it is
+measured as (n-1)/(t_last-t_first) over the longest gap free run (a median step is wrong for timestamps quantized
+to ms: 240 Hz steps are 4 or 5 ms). Channels sampled slower than the table (mixed rate files) are declared by the
+converter in a channel_Fs attribute on /Waveforms ({channel: Hz}); every other channel runs at the record rate.
+
+Segments last the same time at every rate: section_size(level, Fs) is 100*2**level/4 samples at default_Fs (6400
+at level 8) scaled by Fs/default_Fs. The wavelet levels still cover different frequency bands at different rates, so
+the features and segments tables record Fs and everything that compares segments (wf_similarity, wf_model,
+wf_export) only compares segments of one rate (same_rate).
+
+The gap index is built from the mapped timestamps chunk by chunk: np.diff against the expected 1/Fs gives every
+discontinuity in the record and the contiguous runs between them.
+
+    meta = get_meta(filename)
+    meta.rows_for(start_time, end_time)     # record rows covering a time range
+    meta.time_at(row)
+    meta.Fs, meta.channel_Fs                # record rate and per channel rates (Hz)
+    meta.gap_rows                           # first row after each gap
+    meta.runs                               # (start_row, stop_row) of each contiguous run
+    meta.segment_grid(section_size)         # start rows of whole segments inside contiguous runs
+    section_size(level, meta.Fs)            # segment length in samples at the record rate
+
+"""
+
+import os
+import os.path
+import hashlib
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+cache_dir = os.environ.get('WF_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wf_cache'))
+
+_meta = {}   # in-process cache: filename -> FileMeta
+
+# what np.load raises for a truncated or otherwise unreadable cache file - treated as a cache miss
+cache_errors = (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile)
+
+default_Fs = 240      # canonical rate: segment lengths are defined at this rate and older rows without Fs were at it
+gap_tol = 0.5          # a step longer than (1 + gap_tol)/Fs is a gap
+rate_tol = 0.01        # rates within 1% are the same rate (measured rates aren't exact)
+chunk_rows = 1000000   # timestamps read / scanned per chunk (8 MB)
+
+
+def gap_index (timestamps, Fs=default_Fs, tol=gap_tol):
+    # rows of int64 ns timestamps that start after a gap (the step from the previous row is too long)
+    # scanned chunk_rows at a time (overlapping by one row) so a memory mapped index is never read into RAM whole
+    limit = (1 + tol) * 1e9 / Fs
+    gaps = [np.zeros(0, dtype=np.int64)]
+    for a in range(0, max(len(timestamps) - 1, 0), chunk_rows):
+        steps = np.diff(np.asarray(timestamps[a:a + chunk_rows + 1]))
+        gaps.append(np.flatnonzero(steps > limit) + a + 1)
+    return np.concatenate(gaps)
+
+def infer_Fs (timestamps, default=default_Fs):
+    # record sample rate from the span of the longest gap free run; the median step of the first rows is only close
+    # enough to find the gaps (with ms timestamps it reads 240 Hz as 250 Hz)
+    steps = np.diff(np.asarray(timestamps[:100001]))
+    if len(steps) == 0 or np.median(steps) <= 0:
+        return float(default)
+    rough = 1e9 / np.median(steps)
+    runs = contiguous_runs(gap_index(timestamps, rough), len(timestamps))
+    r0, r1 = runs[np.argmax(runs[:, 1] - runs[:, 0])]
+    span = int(timestamps[r1 - 1]) - int(timestamps[r0])
+    if span <= 0:
+        return float(round(rough, 2))
+    return float(round((r1 - r0 - 1) * 1e9 / span, 2))
+
+def section_size (level, Fs=default_Fs):
+    # segment length in samples: 100*2**level/4 at default_Fs, scaled to the same duration at Fs and rounded to a
+    # whole number of 2**level sample blocks (the SWT needs that)
+    step = 2**level
+    return max(int(round(100 * step / 4 * Fs / default_Fs / step)), 1) * step
+
+def same_rate (Fs, target):
+    # True where Fs (number or array; missing = a row written before rates were stored, ie default_Fs) is target
+    Fs = np.asarray(Fs, dtype=np.float64)
+    Fs = np.where(np.isnan(Fs), default_Fs, Fs)
+    return np.abs(Fs - target) <= rate_tol * target
+
+def contiguous_runs (gap_rows, nrows):
+    # (start, stop) rows of the gap free runs
+    starts = np.concatenate([[0], gap_rows])
+    stops = np.concatenate([gap_rows, [nrows]])
+    return np.stack([starts, stops], axis=1)
+
+
+def cache_path (filename, suffix):
+    # location of a cached artefact for a case file, keyed on its absolute path so same-named cases in other
+    # directories (or case.repack.hd5 next to case.hd5) never share a cache entry
+    full = os.path.abspath(filename)
+    stem = os.path.splitext(os.path.basename(full))[0]
+    key = hashlib.sha1(full.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, '{}.{}.{}'.format(stem, key, suffix))
+
+
+def save_npz (path, **arrays):
+    # write an .npz cache file atomically (temporary file then os.replace) so an interrupted write never leaves a
+    # truncated cache behind for the next reader
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+
+
+class FileMeta:
+
+    def __init__ (self, filename):
+        self.filename = filename
+        self.path = cache_path(filename, 'meta.npz')
+        self.timestamps_path = cache_path(filename, 'meta.ts.npy')
+        self.extra = {}
+        if not self.load():
+            self.build()
+        if 'Fs' not in self.extra:
+            # caches written before rates were recorded assumed 240 Hz for the gap index - redo it at the real rate
+            rates = self.read_rates()
+            self.save(gap_rows=gap_index(self.timestamps, rates['Fs']), **rates)
+        self.Fs = float(self.extra['Fs'])
+        self.channel_Fs = dict(zip(self.extra['fs_channels'].tolist(), self.extra['fs_values'].tolist()))
+        self.gap_rows = self.extra['gap_rows']
+        self.runs = contiguous_runs(self.gap_rows, self.nrows)
+
+    def build (self):
+        # copy the index column into the .npy chunk by chunk, then map it read only
+        print ('Indexing timestamps for {}'.format(self.filename))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp = self.timestamps_path + '.tmp'
+        store = pd.HDFStore(self.filename, 'r')
+        try:
+            nrows = store.get_storer('/Waveforms').nrows
+            out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.int64, shape=(nrows,))
+            for a in range(0, nrows, chunk_rows):
+                b = min(a + chunk_rows, nrows)
+                out[a:b] = pd.DatetimeIndex(store.select_column('/Waveforms', 'index', start=a, stop=b)).asi8
+            out.flush()
+            del out
+        finally:
+            store.close()
+        os.replace(tmp, self.timestamps_path)
+        self.extra = {}
+        self.timestamps = np.load(self.timestamps_path, mmap_mode='r')
+        self.nrows = len(self.timestamps)
+
+    def read_rates (self):
+        # record rate from the converter's Fs attribute or else the timestamps, channel rates from its channel_Fs
+        # attribute (if any)
+        store = pd.HDFStore(self.filename, 'r')
+        try:
+            columns = list(store.select('/Waveforms', start=0, stop=1).columns)
+            attrs = store.get_storer('/Waveforms').attrs
+            declared = getattr(attrs, 'channel_Fs', None) or {}
+            Fs = getattr(attrs, 'Fs', None)
+        finally:
+            store.close()
+        Fs = float(Fs) if Fs else infer_Fs(self.timestamps)
+        return {'Fs': np.float64(Fs), 'fs_channels': np.array(columns, dtype=str),
+                'fs_values': np.array([float(declared.get(c, Fs)) for c in columns])}
+
+    def load (self):
+        # use the cached metadata unless the case file has changed since it was written
+        for path in (self.timestamps_path, self.path):
+            if not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(self.filename):
+                return False
+        try:
+            with np.load(self.path, allow_pickle=False) as cached:
+                self.extra = {k: cached[k] for k in cached.files}
+            self.timestamps = np.load(self.timestamps_path, mmap_mode='r')
+        except cache_errors as e:
+            print ('Rebuilding unreadable metadata cache for {}: {}'.format(self.filename, e))
+            self.extra = {}
+            return False
+        self.nrows = len(self.timestamps)
+        return True
+
+    def save (self, **arrays):
+        # write the rates and gap index (plus any extra named arrays) next to the timestamps
+        self.extra.update(arrays)
+        save_npz(self.path, **self.extra)
+
+    def rows_for (self, start_time, end_time):
+        # first row at or after start_time and the row after the last one before end_time
+        r0 = int(np.searchsorted(self.timestamps, pd.Timestamp(start_time).value, side='left'))
+        r1 = int(np.searchsorted(self.timestamps, pd.Timestamp(end_time).value, side='right'))
+        return r0, r1
+
+    def time_at (self, row):
+        return pd.Timestamp(self.timestamps[min(row, self.nrows - 1)])
+
+    def gaps (self, min_secs=0):
+        # DataFrame of gaps (last sample before, first sample after, duration in s) at least min_secs long
+        before = self.timestamps[self.gap_rows - 1]
+        after = self.timestamps[self.gap_rows]
+        secs = (after - before) / 1e9
+        keep = secs >= min_secs
+        return pd.DataFrame({'row': self.gap_rows[keep], 'start': pd.to_datetime(before[keep]),
+                             'end': pd.to_datetime(after[keep]), 'secs': secs[keep]})
+
+    def segment_grid (self, section_size):
+        # start rows of every whole segment that fits inside a contiguous run (segments never straddle a gap)
+        starts = [np.arange(r0, r1 - section_size + 1, section_size) for r0, r1 in self.runs]
+        return np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+
+def get_meta (filename):
+    if filename not in _meta:
+        _meta[filename] = FileMeta(filename)
+    return _meta[filename]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_metrics.py
+
+In-process metrics registry (counters and histograms) with Prometheus text output
+
+The processing modules record into the registry as they run:
+
+    wf_callback_seconds{callback}           Bokeh callback duration (wf_sources.timed_callback)
+    wf_segments_processed_total             segments run through the pipeline (rate() gives segments/s)
+    wf_segment_batch_seconds                time to process one block of adjacent segments (GridSegmenter)
+    wf_stage_cache_total{stage,result}      StageCache lookups, result = hit / miss (hit rate per stage)
+    wf_hdf5_bytes_read_total{key}           bytes of /Waveforms and /Vitals frames read from hdf5
+    wf_feature_seconds{engine}              per segment feature time: matlab (wabp_wrap / jSQI) or biosppy (HR)
+    wf_stream_samples_total                 samples ingested by the live stream (wf_stream.py)
+    wf_stream_lag_seconds{kind}             live lag: samples (arrival -> sent to the browser) or segment (processing)
+
+render() produces the Prometheus text exposition format; wf_serve.py serves it from /metrics next to the app.
+
+    wf_metrics.counter('wf_segments_processed_total', 'Segments processed').inc(n)
+    with wf_metrics.histogram('wf_feature_seconds', 'Feature time', engine='matlab').time():
+        ...
+
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.RLock()
+_metrics = {}   # name -> Metric
+
+
+def _label_str (labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(labels)) + '}'
+
+
+class Counter:
+
+    def __init__ (self):
+        self.value = 0.0
+
+    def inc (self, amount=1):
+        with _lock:
+            self.value += amount
+
+    def lines (self, name, labels):
+        return ['{}{} {}'.format(name, _label_str(labels), self.value)]
+
+
+class Histogram:
+
+    def __init__ (self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe (self, value):
+        with _lock:
+            self.sum += value
+            self.count += 1
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    self.counts[i] += 1
+                    break
+
+    @contextmanager
+    def time (self):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - t0)
+
+    def lines (self, name, labels):
+        out = []
+        cumulative = 0
+        for b, c in zip(self.buckets, self.counts):
+            cumulative += c
+            out.append('{}_bucket{} {}'.format(name, _label_str(labels + (('le', repr(float(b))),)), cumulative))
+        out.append('{}_bucket{} {}'.format(name, _label_str(labels + (('le', '+Inf'),)), self.count))
+        out.append('{}_sum{} {}'.format(name, _label_str(labels), self.sum))
+        out.append('{}_count{} {}'.format(name, _label_str(labels), self.count))
+        return out
+
+
+class Metric:
+    # one named metric family: a counter or histogram per label combination
+
+    def __init__ (self, name, help, kind, **kwargs):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.kwargs = kwargs
+        self.children = {}
+
+    def labels (self, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            if key not in self.children:
+                self.children[key] = Counter() if self.kind == 'counter' else Histogram(**self.kwargs)
+            return self.children[key]
+
+    def lines (self):
+        out = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        for key, child in sorted(self.children.items()):
+            out += child.lines(self.name, key)
+        return out
+
+
+def _get (name, help, kind, **kwargs):
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = Metric(name, help, kind, **kwargs)
+        return _metrics[name]
+
+def counter (name, help='', **labels):
+    return _get(name, help, 'counter').labels(**labels)
+
+def histogram (name, help='', buckets=default_buckets, **labels):
+    return _get(name, help, 'histogram', buckets=buckets).labels(**labels)
+
+def render ():
+    # Prometheus text exposition format (version 0.0.4)
+    with _lock:
+        metrics = list(_metrics.values())
+    lines = []
+    for m in sorted(metrics, key=lambda m: m.name):
+        lines += m.lines()
+    return '\n'.join(lines) + '\n'
+
+def reset ():
+    with _lock:
+        _metrics.clear()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_model.py
+
+Segment classifier pre-scoring and an uncertainty ordered annotation queue
+
+A scikit-learn pipeline (median imputation, scaling, logistic regression) is trained on the annotated rows of the
+segments table using the batch feature columns (wf_file_management.feature_cols). Scoring is one vectorized
+predict_proba call per frame of segments, either for the segments loaded in the viewer or for the whole catalog
+(the features table written by wf_batch.py), and the catalog scores are stored in the scores table. A model is
+trained on and scores segments of one record rate (--Fs, default wf_meta.default_Fs) as the wavelet features of
+different rates aren't comparable.
+
+The annotation queue orders a file's segments by model uncertainty (1 - probability of the predicted class, highest
+first) so annotators see the segments the model is least sure about before the obvious ones.
+
+    python wf_model.py workflow.db train [--Fs 240]   # fit on the segments table and save to wf_cache/<db>.model.pkl
+    python wf_model.py workflow.db score      # score every row of the features table into the scores table
+
+"""
+
+import os
+import os.path
+import pickle
+import sqlite3
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.pipeline import make_pipeline
+from sklearn.impute import SimpleImputer
+from sklearn.preprocessing import StandardScaler
+from sklearn.linear_model import LogisticRegression
+
+import wf_meta
+import wf_file_management as wfm
+
+unlabelled = ['Unclassified']
+score_chunk = 100000   # features table rows scored per call
+
+
+def model_path (db_file):
+    return wf_meta.cache_path(db_file, 'model.pkl')
+
+
+class SegmentModel:
+
+    def __init__ (self, features=None, Fs=wf_meta.default_Fs):
+        self.features = features or list(wfm.feature_cols)
+        self.Fs = Fs          # record rate of the segments the model is trained on and can score
+        self.pipeline = None
+        self.classes = []
+        self.trained = None   # training time stamp, stored with the scores
+
+    def fit (self, df):
+        # df: annotated segments with the feature columns and seg_class (only those recorded at self.Fs are used)
+        df = df[~df['seg_class'].isin(unlabelled) & df['seg_class'].notnull()]
+        if 'Fs' in df.columns:
+            df = df[wf_meta.same_rate(df['Fs'].values, self.Fs)]
+        if df['seg_class'].nunique() < 2:
+            raise Exception('Need annotated segments of at least two classes to train ({} labelled rows)'.format(len(df)))
+        self.pipeline = make_pipeline(SimpleImputer(strategy='median'), StandardScaler(),
+                                      LogisticRegression(max_iter=1000, class_weight='balanced'))
+        self.pipeline.fit(df[self.features].to_numpy(dtype=np.float64), df['seg_class'].values)
+        self.classes = list(self.pipeline.classes_)
+        self.trained = pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')
+        print ('Trained on {} segments ({})'.format(len(df), ', '.join('{} {}'.format(c, n) for c, n in df['seg_class'].value_counts().items())))
+        return self
+
+    def score (self, df):
+        # class probabilities, predicted class and uncertainty for every row of df in one call
+        X = df.reindex(columns=self.features).to_numpy(dtype=np.float64)
+        P = self.pipeline.predict_proba(X)
+        out = pd.DataFrame(P, columns=['p_{}'.format(c) for c in self.classes], index=df.index)
+        out['pred'] = np.array(self.classes, dtype=object)[P.argmax(axis=1)]
+        out['uncertainty'] = 1 - P.max(axis=1)
+        # rows without any features (rejected segments) can't be scored
+        empty = np.isnan(X).all(axis=1)
+        out.loc[empty, 'uncertainty'] = np.nan
+        out.loc[empty, 'pred'] = None
+        return out
+
+    def save (self, path):
+        # saved as a plain dict so the file loads whether it was written by the CLI (__main__) or an importer
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            pickle.dump({'features': self.features, 'Fs': self.Fs, 'classes': self.classes, 'trained': self.trained,
+                         'pipeline': self.pipeline}, f)
+
+    @staticmethod
+    def load (path):
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        model = SegmentModel(state['features'], state.get('Fs', wf_meta.default_Fs))
+        model.classes = state['classes']
+        model.trained = state['trained']
+        model.pipeline = state['pipeline']
+        return model
+
+
+def train (db_file, Fs=wf_meta.default_Fs):
+    db = sqlite3.connect(db_file)
+    df = pd.read_sql('SELECT * FROM segments', db)
+    db.close()
+    model = SegmentModel(Fs=Fs).fit(df)
+    model.save(model_path(db_file))
+    return model
+
+def load_model (db_file):
+    # the saved model for a workflow DB, or None if it hasn't been trained
+    path = model_path(db_file)
+    return SegmentModel.load(path) if os.path.isfile(path) else None
+
+def make_score_table (db_file):
+    db = sqlite3.connect(db_file)
+    db.execute('''CREATE TABLE IF NOT EXISTS scores(id INTEGER PRIMARY KEY,
+                  file TEXT,
+                  channel TEXT,
+                  seg INTEGER,
+                  seg_start_time TEXT,
+                  pred TEXT,
+                  uncertainty FLOAT,
+                  model TEXT)''')
+    db.execute('CREATE INDEX IF NOT EXISTS scores_file ON scores(file, channel, seg)')
+    db.commit()
+    db.close()
+
+def score_catalog (db_file, model=None):
+    # score the features table rows at the model's rate, chunk by chunk, replacing earlier scores
+    model = model or load_model(db_file)
+    if model is None:
+        raise Exception('No model for {} - run "python wf_model.py {} train" first'.format(db_file, db_file))
+    make_score_table(db_file)
+    db = sqlite3.connect(db_file)
+    wfm.ensure_columns(db, 'scores', {'p_{}'.format(c): 'FLOAT' for c in model.classes})
+    wfm.ensure_columns(db, 'features', {'Fs':'FLOAT'})
+    t0 = time.time()
+    n = 0
+    with db:
+        db.execute('DELETE FROM scores')
+        sql = 'SELECT file, channel, seg, seg_start_time, {} FROM features WHERE ABS(COALESCE(Fs, ?) - ?) <= ?'.format(
+            ', '.join(model.features))
+        rate = (wf_meta.default_Fs, model.Fs, wf_meta.rate_tol * model.Fs)
+        for chunk in pd.read_sql(sql, db, params=rate, chunksize=score_chunk):
+            scores = model.score(chunk)
+            out = pd.concat([chunk[['file', 'channel', 'seg', 'seg_start_time']], scores], axis=1)
+            out['model'] = model.trained
+            out.to_sql('scores', db, if_exists='append', index=False, chunksize=1000)
+            n += len(out)
+    db.close()
+    print ('Scored {} segments in {:0.1f} s'.format(n, time.time()-t0))
+
+def annotation_queue (scores, exclude=()):
+    # segment numbers ordered by uncertainty (most informative first), unscorable and excluded segments left out
+    q = scores['uncertainty'].drop([x for x in exclude if x in scores.index]).dropna()
+    return list(q.sort_values(ascending=False, kind='mergesort').index)
+
+def main ():
+    parser = argparse.ArgumentParser(description='Train the segment classifier or score the catalog')
+    parser.add_argument('db_file', help='workflow sqlite DB')
+    parser.add_argument('action', choices=['train', 'score'])
+    parser.add_argument('--Fs', type=float, default=wf_meta.default_Fs, help='record rate (Hz) of the segments to train on')
+    args = parser.parse_args()
+    if args.action == 'train':
+        train(args.db_file, Fs=args.Fs)
+    else:
+        score_catalog(args.db_file)
+
+if __name__ == "__main__":
+
+    main ()
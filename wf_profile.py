@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_profile.py
+
+Per channel profiles of the pressure channels, stored in the catalog and used to pick the ABP / CVP channels
+
+Which of AR1/AR2/AR3 carries the arterial line (and which CVP channel is live) used to be decided by
+Waveform.rename_wfs / Summary.rename_wfs (which column has data), Segment.ABP_correlate (mean in 20..200 per
+segment) and the radio button on the vitals tab. Here every AR and CVP channel of a file is profiled once, in one
+chunked pass over its /Waveforms columns (the same pass builds the whole record resampling caches of the ABP and
+slower channels, see wf_resample.py):
+
+    coverage        fraction of the channel's samples (at its own rate, wf_meta) that are inside its valid range
+    mean, variance  of the valid samples
+    pulsatility     median peak to peak amplitude of fully valid pulse_secs windows (~pulse pressure for a live line,
+                    near zero for a flushed, zeroed or clamped transducer)
+
+The profiles go into the channels table and the chosen channels into files.abp_channel / files.cvp_channel, so the
+viewer (which reads the files table anyway) and batch runs (wf_batch.py, wf_queue.py) select channels without
+reading any waveform data.
+
+    python wf_profile.py workflow.db [--workers 4] [--refresh]
+
+"""
+
+import sqlite3
+import time
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+import waveform
+import wf_meta
+import wf_resample
+import wf_file_management as wfm
+
+pulse_secs = 2          # pulsatility window
+chunk_windows = 1000    # windows read per chunk
+min_coverage = 0.05     # channels with less valid data are never selected
+
+# plausible (mean, pulsatility) ranges for a live line
+abp_mean = (20, 200)    # as Segment.ABP_correlate
+abp_pulse = 10
+cvp_mean = (-5, 40)
+cvp_pulse = 1
+
+
+def channel_range (chan):
+    if chan in waveform.Waveform.ABP_cols:
+        return waveform.ABP_class.ABP_lo, waveform.ABP_class.ABP_hi
+    return waveform.CVP_class.CVP_lo, waveform.CVP_class.CVP_hi
+
+def profile_file (path):
+    # one chunked pass over the AR / CVP columns of a case file -> DataFrame indexed by channel
+    first = pd.read_hdf(path, 'Waveforms', start=0, stop=1)
+    chans = [c for c in waveform.Waveform.ABP_cols + waveform.Waveform.CVP_cols if c in first.columns]
+    meta = wf_meta.get_meta(path)
+    window = int(pulse_secs * meta.Fs)
+    # a channel slower than the table only has a value every few rows (its pulses are still whole in a window)
+    share = np.array([meta.channel_Fs.get(c, meta.Fs) / meta.Fs for c in chans])
+    resample = wf_resample.builders(path, wf_resample.targets(path, chans, waveform.Waveform.ABP_cols))
+    row0 = 0
+    lo = np.array([channel_range(c)[0] for c in chans], dtype=np.float32)
+    hi = np.array([channel_range(c)[1] for c in chans], dtype=np.float32)
+    n = np.zeros(len(chans))
+    valid = np.zeros(len(chans))
+    total = np.zeros(len(chans))
+    sumsq = np.zeros(len(chans))
+    ptp = [[] for c in chans]
+    if chans:
+        for chunk in pd.read_hdf(path, 'Waveforms', columns=chans, chunksize=window * chunk_windows):
+            wf_resample.feed_all(resample, row0, chunk)
+            row0 += len(chunk)
+            X = chunk.to_numpy(dtype=np.float32)
+            ok = (X > lo) & (X < hi)    # NaN compares False
+            # rows that should carry a sample: all of them, or the non-NaN rows of a slower channel
+            expected = ~np.isnan(X) | (share == 1)
+            Z = np.where(ok, X, 0).astype(np.float64)
+            n += len(X)
+            valid += ok.sum(axis=0)
+            total += Z.sum(axis=0)
+            sumsq += (Z * Z).sum(axis=0)
+            # windows of the chunk (chunks are whole windows apart from the last one)
+            m = len(X) // window * window
+            W = X[:m].reshape(-1, window, len(chans))
+            ok_w = ok[:m].reshape(-1, window, len(chans))
+            full = (ok_w | ~expected[:m].reshape(-1, window, len(chans))).all(axis=1) & \
+                   (ok_w.sum(axis=1) >= np.floor(share * window))
+            amp = np.where(ok_w, W, -np.inf).max(axis=1) - np.where(ok_w, W, np.inf).min(axis=1)
+            for j in range(len(chans)):
+                ptp[j].append(amp[full[:, j], j])
+    wf_resample.finish_all(resample)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / valid
+        variance = sumsq / valid - mean * mean
+    pulsatility = [float(np.median(np.concatenate(p))) if sum(len(x) for x in p) else np.nan for p in ptp]
+    return pd.DataFrame({'coverage': np.minimum(valid / np.maximum(n * share, 1), 1), 'mean': mean, 'variance': variance,
+                         'pulsatility': pulsatility}, index=pd.Index(chans, name='channel'))
+
+def select_channels (profile):
+    # (abp_channel, cvp_channel) from a profile: the best covered plausible channel of each kind, or None
+    def best (cols, mean_range, pulse):
+        df = profile[profile.index.isin(cols)]
+        df = df[(df['coverage'] >= min_coverage) & df['mean'].between(*mean_range) & (df['pulsatility'] >= pulse)]
+        return df['coverage'].idxmax() if len(df) else None
+    return best(waveform.Waveform.ABP_cols, abp_mean, abp_pulse), best(waveform.Waveform.CVP_cols, cvp_mean, cvp_pulse)
+
+def write_profile (db, filename, profile):
+    abp, cvp = select_channels(profile)
+    with db:
+        db.execute('DELETE FROM channels WHERE file = ?', (filename,))
+        db.executemany('INSERT INTO channels(file, channel, coverage, mean, variance, pulsatility) VALUES (?, ?, ?, ?, ?, ?)',
+                       [(filename, c) + tuple(None if np.isnan(v) else float(v) for v in row)
+                        for c, row in zip(profile.index, profile[['coverage', 'mean', 'variance', 'pulsatility']].values)])
+        # an empty string marks a profiled file without a usable channel (NULL = not profiled yet)
+        db.execute('UPDATE files SET abp_channel = ?, cvp_channel = ? WHERE filename = ?', (abp or '', cvp or '', filename))
+    return abp, cvp
+
+def _profile_job (job):
+    # worker: (filename, path) -> (filename, profile or None, seconds, error message)
+    filename, path = job
+    t0 = time.time()
+    try:
+        return filename, profile_file(path), time.time() - t0, None
+    except Exception as e:
+        return filename, None, time.time() - t0, '{}: {}'.format(type(e).__name__, e)
+
+def profile_catalog (db_file, workers=4, refresh=False):
+    # profile every catalog file that hasn't been profiled (or all of them with refresh)
+    wfm.make_channel_table(db_file)
+    db = sqlite3.connect(db_file)
+    files = pd.read_sql('SELECT filename, path FROM files' + ('' if refresh else ' WHERE abp_channel IS NULL'), db)
+    jobs = list(zip(files.filename, files.path))
+    if jobs:
+        print ('Profiling channels of {} files with {} workers'.format(len(jobs), workers))
+        done = 0
+        with Pool(processes=workers) as pool:
+            for filename, profile, secs, err in pool.imap_unordered(_profile_job, jobs):
+                done += 1
+                if err is not None:
+                    print ('[{}/{}] Error profiling {}: {}'.format(done, len(jobs), filename, err))
+                    continue
+                abp, cvp = write_profile(db, filename, profile)
+                print ('[{}/{}] {}: ABP {}, CVP {} ({:0.1f} s)'.format(done, len(jobs), filename, abp, cvp, secs))
+    db.close()
+
+def ensure_profile (db, filename, path):
+    # (abp_channel, cvp_channel) of a file, profiling it first if needed (make_channel_table must have been run)
+    selected = file_channels(db, filename)
+    if selected is None:
+        selected = write_profile(db, filename, profile_file(path))
+    return selected
+
+def file_channels (db, filename):
+    # (abp_channel, cvp_channel) from the catalog, None if the file hasn't been profiled
+    try:
+        row = db.execute('SELECT abp_channel, cvp_channel FROM files WHERE filename = ?', (filename,)).fetchone()
+    except sqlite3.OperationalError:
+        return None   # catalog without the profile columns
+    if row is None or row[0] is None:
+        return None
+    return row[0] or None, row[1] or None
+
+def batch_channels (selected):
+    # channels to process for a file: the selected ABP / CVP channels, or None (= every channel present) if the file
+    # is unprofiled or no channel passed the thresholds (eg a damped line) - a file is never processed with no channels
+    if selected is None:
+        return None
+    return [c for c in selected if c] or None
+
+def main ():
+    parser = argparse.ArgumentParser(description='Profile the AR / CVP channels of every catalog file')
+    parser.add_argument('db_file', help='workflow sqlite DB')
+    parser.add_argument('--workers', type=int, default=4, help='number of worker processes')
+    parser.add_argument('--refresh', action='store_true', help='profile files again even if they already have a profile')
+    args = parser.parse_args()
+    profile_catalog(args.db_file, workers=args.workers, refresh=args.refresh)
+    db = sqlite3.connect(args.db_file)
+    print (pd.read_sql('SELECT * FROM channels ORDER BY file, channel', db).to_string())
+    db.close()
+
+if __name__ == "__main__":
+
+    main ()
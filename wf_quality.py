@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_quality.py
+
+Cheap vectorized artifact detectors used to pre-screen segments before feature extraction
+
+Each detector works on a 2-D (segments x samples) matrix in a few NumPy passes and returns one boolean per segment.
+Waveform.prescreen builds the matrices from the segmentation and records the result in Waveform.reject;
+wf_features (MATLAB wabp/jSQI + biosppy HR) and the SWT in ABPWavelet/CVPWavelet.processWaveform are skipped
+for rejected segments. ECG lead off (or a missing lead) is recorded but doesn't reject the pressure segment - it
+only gates HR, so the lead checked is the one HR is computed from (Waveform.HR_lead).
+
+Detectors:
+    flatline        pressure channel has (almost) no variation
+    clipped         pressure channel sits on the high/low rail (ABP_hi / CVP_hi) or holds its maximum for plateau_secs
+    zero_run        long run of exact zeros (the fill value written by Waveform.wf_clean for out of range data)
+    time_gap        timestamps within the segment jump by more than the expected 1/Fs
+    ecg_lead_off    HR lead is missing, flat, zero-filled or pinned at the ECG rails (not a reject reason)
+
+"""
+
+import numpy as np
+import pandas as pd
+
+reject_reasons = ['flatline', 'clipped', 'zero_run', 'time_gap']
+
+# thresholds
+flat_range = 1.0        # mmHg peak to peak below which a pressure segment is flat
+clip_frac = 0.05        # fraction of samples at the rail to call a segment clipped
+rail_tol = 0.5          # mmHg from the rail counted as on the rail
+plateau_secs = 0.5      # seconds held at the segment maximum (quantized signals touch it often, but briefly)
+zero_run_secs = 2.0     # seconds of consecutive zeros
+gap_tol = 0.5           # tolerated timestamp jitter as a fraction of 1/Fs
+ecg_flat_range = 0.05   # mV peak to peak below which the ECG lead is considered off
+ecg_zero_frac = 0.2     # fraction of zero samples in the ECG lead
+
+
+def segment_matrix (values, section_size, nseg):
+    # reshape the first nseg*section_size samples of a 1-D array into (nseg, section_size) without copying
+    values = np.asarray(values)
+    return values[:nseg*section_size].reshape(nseg, section_size)
+
+def flatline (X, min_range=flat_range):
+    return np.ptp(X, axis=1) < min_range
+
+def clipped (X, hi, lo, max_plateau, frac=clip_frac, tol=rail_tol):
+    # samples on either rail, or one contiguous plateau at the segment maximum of at least max_plateau samples
+    # (pinned transducer / saturated amplifier)
+    on_rail = ((X >= hi - tol) | (X <= lo + tol)).mean(axis=1) > frac
+    at_max = longest_run(X >= X.max(axis=1, keepdims=True) - 1e-6) >= max_plateau
+    return on_rail | at_max
+
+def longest_run (mask):
+    # length of the longest run of True in each row of a 2-D boolean array
+    n, L = mask.shape
+    padded = np.zeros((n, L + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    d = np.diff(padded, axis=1)
+    srow, scol = np.nonzero(d == 1)
+    _, ecol = np.nonzero(d == -1)    # run ends pair with starts in row-major order
+    out = np.zeros(n, dtype=np.int64)
+    np.maximum.at(out, srow, ecol - scol)
+    return out
+
+def zero_run (X, max_run):
+    return longest_run(X == 0) >= max_run
+
+def time_gap (T, Fs, tol=gap_tol):
+    # T: (nseg, section_size) int64 nanosecond timestamps
+    expected = 1e9 / Fs
+    return (np.diff(T, axis=1) > expected * (1 + tol)).any(axis=1)
+
+def ecg_lead_off (E, hi, lo, min_range=ecg_flat_range, zero_frac=ecg_zero_frac, frac=clip_frac):
+    flat = np.ptp(E, axis=1) < min_range
+    zeros = (E == 0).mean(axis=1) > zero_frac
+    pinned = ((E >= hi * 0.98) | (E <= lo * 0.98)).mean(axis=1) > frac
+    return flat | zeros | pinned
+
+def prescreen (waves, channel, section_size, Fs, hi, lo, ecg_channel='I', ecg_hi=1, ecg_lo=-1, nseg=None, values=None):
+    # run all detectors over a segmented waveform
+    # waves: DataFrame with a DatetimeIndex, segments are consecutive blocks of section_size rows (as Waveform.segmenter)
+    # values: optional {channel: array} of cleaned channel values to use instead of the waves columns (compact mode)
+    # returns a DataFrame indexed by segment number (1..nseg) with one boolean column per reason and ecg_lead_off,
+    # a 'reject' column and a 'reasons' string column (comma separated, '' for accepted segments)
+    if nseg is None:
+        nseg = max(len(np.arange(0, len(waves), section_size)) - 1, 0)
+    result = pd.DataFrame(index=np.arange(1, nseg + 1))
+    if nseg == 0:
+        for reason in reject_reasons + ['ecg_lead_off']:
+            result[reason] = np.zeros(0, dtype=bool)
+        result['reject'] = np.zeros(0, dtype=bool)
+        result['reasons'] = np.zeros(0, dtype=object)
+        return result
+
+    values = values or {}
+    X = segment_matrix(values.get(channel, waves[channel].values), section_size, nseg)
+    result['flatline'] = flatline(X)
+    result['clipped'] = clipped(X, hi, lo, int(plateau_secs * Fs))
+    result['zero_run'] = zero_run(X, int(zero_run_secs * Fs))
+    result['time_gap'] = time_gap(segment_matrix(waves.index.asi8, section_size, nseg), Fs)
+    if ecg_channel in waves.columns:
+        E = segment_matrix(values.get(ecg_channel, waves[ecg_channel].values), section_size, nseg)
+        result['ecg_lead_off'] = ecg_lead_off(E, ecg_hi, ecg_lo)
+    else:
+        result['ecg_lead_off'] = True   # no HR lead in the file: no HR, but the pressure features are still worth having
+
+    flags = result[reject_reasons].values
+    result['reject'] = flags.any(axis=1)
+    names = np.array(reject_reasons, dtype=object)
+    result['reasons'] = [','.join(names[row]) for row in flags]
+    print ('Pre-screen: {} of {} segments rejected ({}), ECG lead off in {}'.format(int(result['reject'].sum()), nseg,
+           ', '.join('{} {}'.format(r, int(result[r].sum())) for r in reject_reasons), int(result['ecg_lead_off'].sum())))
+    return result
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_queue.py
+
+Lease based job queue in the workflow DB for processing the catalog on several machines
+
+wf_batch.py runs all its workers in one process pool on one machine. Here the jobs live in a jobs table of the
+workflow DB on the shared mount, and any number of worker processes on any node that can see the DB and the case
+files claim them:
+
+    python wf_queue.py workflow.db init                 # create the jobs table and queue every file not DONE
+    python wf_queue.py workflow.db worker [--level 8] [--compact] [--max-memory MB] [--lease 600]
+    python wf_queue.py workflow.db status
+
+A claim sets the job's worker (host:pid) and a lease expiry inside one BEGIN IMMEDIATE transaction, so two workers
+can't take the same job. While a job runs a heartbeat thread extends the lease; if the worker dies the lease runs
+out and the job is claimed again by another worker (up to max_attempts). Processing is wf_batch.process_file (the
+same Waveform / Wavelet pipeline, on the channels picked by wf_profile.py), and the feature rows are committed (as wf_batch.write_results does) only while
+the worker still holds the lease, in the same transaction that marks the job done.
+
+The queue relies on sqlite file locking, which works on local disks and most NFS setups with working locks;
+keep wf_batch.py and queue workers off the same DB at the same time (wf_batch resets RUNNING files on start).
+
+"""
+
+import os
+import os.path
+import socket
+import sqlite3
+import threading
+import time
+import argparse
+
+import pandas as pd
+
+import wf_batch
+import wf_profile
+import wf_file_management as wfm
+
+JOB_NEW = 0
+JOB_RUNNING = 1
+JOB_DONE = 2
+JOB_ERROR = -1
+
+lease_secs = 600
+max_attempts = 3
+poll_secs = 30      # idle workers check for reclaimable jobs this often
+db_timeout = 60     # seconds to wait for the sqlite lock
+
+
+def connect (db_file):
+    # write transactions are opened with BEGIN IMMEDIATE so the write lock is taken before anything is read
+    return sqlite3.connect(db_file, timeout=db_timeout)
+
+def make_job_table (db_file):
+    db = connect(db_file)
+    db.execute('''CREATE TABLE IF NOT EXISTS jobs(id INTEGER PRIMARY KEY,
+                  filename TEXT UNIQUE,
+                  path TEXT,
+                  status INTEGER,
+                  worker TEXT,
+                  lease_until FLOAT,
+                  attempts INTEGER,
+                  error TEXT,
+                  started FLOAT,
+                  finished FLOAT)''')
+    db.close()
+
+def init_queue (db_file, retry_errors=False):
+    # queue every catalog file that isn't DONE (existing jobs are left alone unless they failed and retry_errors)
+    make_job_table(db_file)
+    wfm.make_feature_table(db_file)
+    wfm.make_channel_table(db_file)
+    db = connect(db_file)
+    db.execute('BEGIN IMMEDIATE')
+    n = db.execute('''INSERT OR IGNORE INTO jobs(filename, path, status, attempts)
+                      SELECT filename, path, ?, 0 FROM files WHERE status != ?''', (JOB_NEW, wfm.STATUS_DONE)).rowcount
+    if retry_errors:
+        db.execute('UPDATE jobs SET status = ?, attempts = 0, error = NULL WHERE status = ?', (JOB_NEW, JOB_ERROR))
+    db.commit()
+    db.close()
+    print ('Queued {} new jobs'.format(n))
+
+def worker_id ():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def claim (db, worker, lease=lease_secs):
+    # take the next new job, or one whose lease has expired; returns (filename, path) or None
+    now = time.time()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        # jobs whose workers died too often are given up on (and their files marked ERROR with them)
+        dead = [r[0] for r in db.execute('SELECT filename FROM jobs WHERE status = ? AND lease_until < ? AND attempts >= ?',
+                                         (JOB_RUNNING, now, max_attempts)).fetchall()]
+        for filename in dead:
+            db.execute('''UPDATE jobs SET status = ?, error = 'lease expired {} times' WHERE filename = ?'''.format(max_attempts),
+                       (JOB_ERROR, filename))
+            wfm.set_file_status(db, filename, wfm.STATUS_ERROR)
+        row = db.execute('''SELECT id, filename, path FROM jobs
+                            WHERE status = ? OR (status = ? AND lease_until < ?)
+                            ORDER BY status DESC, id LIMIT 1''', (JOB_NEW, JOB_RUNNING, now)).fetchone()
+        if row is None:
+            db.commit()
+            return None
+        db.execute('''UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, started = ?
+                      WHERE id = ?''', (JOB_RUNNING, worker, now + lease, now, row[0]))
+        wfm.set_file_status(db, row[1], wfm.STATUS_RUNNING)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return row[1], row[2]
+
+def holds_lease (db, filename, worker):
+    row = db.execute('SELECT worker, status FROM jobs WHERE filename = ?', (filename,)).fetchone()
+    return row is not None and row[0] == worker and row[1] == JOB_RUNNING
+
+
+class Heartbeat (threading.Thread):
+    # extends the lease of the running job every lease/3 seconds until stopped
+
+    def __init__ (self, db_file, filename, worker, lease=lease_secs):
+        threading.Thread.__init__(self, daemon=True)
+        self.db_file = db_file
+        self.filename = filename
+        self.worker = worker
+        self.lease = lease
+        self.stopped = threading.Event()
+
+    def run (self):
+        db = connect(self.db_file)
+        while not self.stopped.wait(self.lease / 3):
+            try:
+                with db:
+                    db.execute('UPDATE jobs SET lease_until = ? WHERE filename = ? AND worker = ? AND status = ?',
+                               (time.time() + self.lease, self.filename, self.worker, JOB_RUNNING))
+            except sqlite3.OperationalError as e:
+                print ('Heartbeat for {} failed: {}'.format(self.filename, e))
+        db.close()
+
+    def stop (self):
+        self.stopped.set()
+        self.join()
+
+
+def finish (db, filename, path, worker, df, err):
+    # commit results (or the error) if the lease is still ours - a reclaimed job belongs to the new worker
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        if not holds_lease(db, filename, worker):
+            db.rollback()
+            print ('Lost the lease on {} - discarding results'.format(filename))
+            return False
+        if err is None:
+            db.execute('DELETE FROM features WHERE file = ?', (path,))
+            if df is not None and len(df):
+                # plain executemany rather than to_sql, which would commit part way through the transaction
+                cols = ', '.join('"{}"'.format(c) for c in df.columns)
+                db.executemany('INSERT INTO features ({}) VALUES ({})'.format(cols, ', '.join('?' * len(df.columns))),
+                               df.astype(object).where(df.notnull(), None).values.tolist())
+            wfm.set_file_status(db, filename, wfm.STATUS_DONE)
+            db.execute('UPDATE jobs SET status = ?, finished = ?, error = NULL WHERE filename = ?', (JOB_DONE, time.time(), filename))
+        else:
+            wfm.set_file_status(db, filename, wfm.STATUS_ERROR)
+            db.execute('UPDATE jobs SET status = ?, finished = ?, error = ? WHERE filename = ?', (JOB_ERROR, time.time(), err, filename))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return True
+
+def work (db_file, level=8, compact=False, max_memory_mb=None, lease=lease_secs, once=False):
+    # claim and process jobs until none are left (and no running job can expire), or after one job with once
+    worker = worker_id()
+    db = connect(db_file)
+    t0 = time.time()
+    total_segs = 0
+    print ('Worker {} started'.format(worker))
+    while True:
+        job = claim(db, worker, lease)
+        if job is None:
+            running = db.execute('SELECT COUNT(*) FROM jobs WHERE status = ?', (JOB_RUNNING,)).fetchone()[0]
+            if running == 0 or once:
+                break
+            time.sleep(poll_secs)   # other workers are busy - wait in case one of their leases expires
+            continue
+        filename, path = job
+        print ('{}: processing {}'.format(worker, filename))
+        beat = Heartbeat(db_file, filename, worker, lease)
+        beat.start()
+        try:
+            # files not profiled by wf_profile.py are profiled here, once
+            try:
+                channels = wf_profile.batch_channels(wf_profile.ensure_profile(db, filename, path))
+            except Exception as e:
+                print ('{}: profiling {} failed ({}), processing every channel'.format(worker, filename, e))
+                channels = None
+            filename, df, nseg, nbytes, err = wf_batch.process_file((filename, path, level, compact, max_memory_mb, channels))
+        finally:
+            beat.stop()
+        if finish(db, filename, path, worker, df, err) and err is None:
+            total_segs += nseg
+            print ('{}: {} done, {} segments ({:0.1f} segments/s for this worker)'.format(
+                worker, filename, nseg, total_segs / (time.time() - t0)))
+        elif err is not None:
+            print ('{}: error processing {}: {}'.format(worker, filename, err))
+        if once:
+            break
+    db.close()
+    print ('Worker {} finished: {} segments in {:0.1f} s'.format(worker, total_segs, time.time() - t0))
+
+def status (db_file):
+    db = connect(db_file)
+    df = pd.read_sql('SELECT status, worker, lease_until, attempts FROM jobs', db)
+    db.close()
+    names = {JOB_NEW: 'new', JOB_RUNNING: 'running', JOB_DONE: 'done', JOB_ERROR: 'error'}
+    print (df['status'].map(names).value_counts().to_string())
+    running = df[df['status'] == JOB_RUNNING]
+    expired = running['lease_until'] < time.time()
+    print ('{} running on {} workers, {} with expired leases'.format(len(running), running['worker'].nunique(), int(expired.sum())))
+    return df
+
+def main ():
+    parser = argparse.ArgumentParser(description='Lease based multi-machine job queue for catalog processing')
+    parser.add_argument('db_file', help='workflow sqlite DB on the shared mount')
+    parser.add_argument('action', choices=['init', 'worker', 'status'])
+    parser.add_argument('--retry-errors', action='store_true', help='init: re-queue failed jobs')
+    parser.add_argument('--level', type=int, default=8, help='wavelet/segmentation level')
+    parser.add_argument('--compact', action='store_true', help='float32 reads with a packed invalid sample mask')
+    parser.add_argument('--max-memory', type=float, default=None, help='process files out of core within this many MB')
+    parser.add_argument('--lease', type=float, default=lease_secs, help='lease length in seconds')
+    parser.add_argument('--once', action='store_true', help='process a single job and exit')
+    args = parser.parse_args()
+    if not os.path.isfile(args.db_file):
+        raise Exception('.db file does not exist')
+    if args.action == 'init':
+        init_queue(args.db_file, args.retry_errors)
+    elif args.action == 'worker':
+        work(args.db_file, level=args.level, compact=args.compact, max_memory_mb=args.max_memory,
+             lease=args.lease, once=args.once)
+    else:
+        status(args.db_file)
+
+if __name__ == "__main__":
+
+    main ()
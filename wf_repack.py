@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_repack.py
+
+Repack converted hdf5 case files for fast time range queries
+
+Every pd.read_hdf(..., where='index>start_time & index<end_time') in Waveform.read / Segment.read scans the whole
+table unless the time column is indexed, and the files carry whatever compression the converter used.
+repack() rewrites /Waveforms and /Vitals (other keys are copied unchanged):
+
+    - Blosc/LZ4 compression (fast enough that decompression is cheaper than reading uncompressed data)
+    - rows appended in blocks that are a multiple of the segment length (wf_meta.section_size)
+    - a completely sorted index (CSI: kind='full', optlevel=9) on the time column
+
+and reports the file size and the latency of a 10 minute where= query before and after.
+
+    Usage: python wf_repack.py <file.hd5 | directory> [--replace] [--level 8] [--complevel 5]
+
+Without --replace the repacked copy is written next to the original as <name>.repack.hd5.
+
+"""
+
+import os
+import os.path
+import glob
+import time
+import argparse
+
+import pandas as pd
+
+import wf_meta
+
+indexed_keys = ['/Waveforms', '/Vitals']
+query_secs = 600        # length of the time range used for the latency test
+blocks_per_write = 16   # segments per append
+
+
+def time_query (filename, key='/Waveforms', secs=query_secs, repeat=3):
+    # best of repeat timings of a where= query over secs seconds from the middle of the table
+    store = pd.HDFStore(filename, 'r')
+    try:
+        nrows = store.get_storer(key).nrows
+        start_time = store.select(key, start=nrows // 2, stop=nrows // 2 + 1).index[0]
+        end_time = start_time + pd.Timedelta(secs, 's')
+        best = None
+        for i in range(repeat):
+            t0 = time.time()
+            df = store.select(key, where='index>start_time & index<end_time')
+            t = time.time() - t0
+            best = t if best is None else min(best, t)
+    finally:
+        store.close()
+    return best, len(df)
+
+def repack (filename, outfile=None, level=8, complib='blosc:lz4', complevel=5):
+    # write a compressed, CSI indexed copy of a case file and return it's name
+    if outfile is None:
+        outfile = filename.rsplit('.', 1)[0] + '.repack.hd5'
+    if os.path.isfile(outfile):
+        os.remove(outfile)
+    section_size = wf_meta.section_size(level, wf_meta.get_meta(filename).Fs)
+    chunk = section_size * blocks_per_write
+
+    src = pd.HDFStore(filename, 'r')
+    dst = pd.HDFStore(outfile, 'w', complib=complib, complevel=complevel)
+    try:
+        for key in src.keys():
+            if key not in indexed_keys:
+                # keep each key's storer format so table keys still support where= queries
+                storer = src.get_storer(key)
+                print ('Copying {} ({})'.format(key, 'table' if storer.is_table else 'fixed'))
+                if storer.is_table:
+                    dst.put(key, src.get(key), format='table', data_columns=storer.data_columns or None)
+                else:
+                    dst.put(key, src.get(key))
+                continue
+            nrows = src.get_storer(key).nrows
+            print ('Repacking {} ({} rows)'.format(key, nrows))
+            for df in src.select(key, chunksize=chunk):
+                dst.append(key, df, format='table', index=False, expectedrows=nrows, chunksize=chunk)
+            # completely sorted index on the time column (the table index)
+            dst.create_table_index(key, columns=['index'], optlevel=9, kind='full')
+            # per channel sample rates of mixed rate files (wf_meta)
+            channel_Fs = getattr(src.get_storer(key).attrs, 'channel_Fs', None)
+            if channel_Fs is not None:
+                dst.get_storer(key).attrs.channel_Fs = channel_Fs
+    finally:
+        src.close()
+        dst.close()
+    return outfile
+
+def repack_report (filename, replace=False, **kwargs):
+    # repack one file and print the size and query latency change
+    size0 = os.path.getsize(filename)
+    t0, rows0 = time_query(filename)
+    outfile = repack(filename, **kwargs)
+    size1 = os.path.getsize(outfile)
+    t1, rows1 = time_query(outfile)
+    if rows0 != rows1:
+        raise Exception('Repacked file returned {} rows instead of {} - keeping the original'.format(rows1, rows0))
+    if replace:
+        os.replace(outfile, filename)   # newer mtime also invalidates the cached wf_meta metadata
+        outfile = filename
+    print ('{}: size {:0.1f} -> {:0.1f} MB ({:+0.0f}%), {} s query {:0.1f} -> {:0.1f} ms ({:0.1f}x)'.format(
+        os.path.basename(filename), size0/1e6, size1/1e6, (size1-size0)*100/size0, query_secs,
+        t0*1000, t1*1000, t0/t1 if t1 > 0 else float('inf')))
+    return {'file': filename, 'size_before': size0, 'size_after': size1, 'query_before': t0, 'query_after': t1}
+
+def main ():
+    parser = argparse.ArgumentParser(description='Repack case hdf5 files with Blosc compression and CSI time indexes')
+    parser.add_argument('source', help='hdf5 case file or a directory of .hd5 files')
+    parser.add_argument('--replace', action='store_true', help='replace the original file with the repacked copy')
+    parser.add_argument('--level', type=int, default=8, help='segmentation level used to size the write blocks')
+    parser.add_argument('--complevel', type=int, default=5, help='Blosc compression level')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.source):
+        files = sorted(f for f in glob.glob(os.path.join(args.source, '*.hd5')) if not f.endswith('.repack.hd5'))
+    else:
+        files = [args.source]
+    report = []
+    for f in files:
+        report.append(repack_report(f, replace=args.replace, level=args.level, complevel=args.complevel))
+    if len(report) > 1:
+        df = pd.DataFrame(report)
+        print ('Total: {:0.1f} -> {:0.1f} MB, median query speedup {:0.1f}x'.format(
+            df.size_before.sum()/1e6, df.size_after.sum()/1e6, (df.query_before/df.query_after).median()))
+
+if __name__ == "__main__":
+
+    main ()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_report.py
+
+Cohort PDF report of the .sum vitals summaries, rendered in parallel from decimated data
+
+plot_summary_to_pdf used to plot every full resolution summary serially into one PdfPages. Here each case is a
+page rendered by a worker process: the summary is decimated to at most max_points bins per trend (bin mean plus a
+min/max envelope, so short excursions stay visible) and drawn with the Agg backend to a PNG in a page directory
+next to the report. The pages are then placed into the PDF in file name order.
+
+The page directory keeps a manifest (pages.json) of the .sum size and modification time each page was rendered
+from, updated as every page finishes, so an interrupted run loses nothing and a re-run only renders cases whose
+.sum changed (or that are new); --full renders everything again.
+
+    python wf_report.py report.pdf [--path './*.sum'] [--workers 4] [--full] [--max-points 2000] [--dpi 100]
+
+"""
+
+import os
+import os.path
+import glob
+import json
+import time
+import hashlib
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+
+max_points = 2000          # bins per trend on a page
+page_size = (10, 10)       # inches, as the old report
+drop_cols = ['NBP-S', 'NBP-D']
+
+
+def page_dir (outfile):
+    return os.path.splitext(outfile)[0] + '.pages'
+
+def page_name (sum_file):
+    # PNG name of a summary's page: its stem plus a short hash of the full path, so same-named summaries in
+    # different directories (a glob across directories) get their own pages
+    full = os.path.abspath(sum_file)
+    stem = os.path.splitext(os.path.basename(full))[0]
+    return '{}.{}.png'.format(stem, hashlib.sha1(full.encode('utf-8')).hexdigest()[:12])
+
+def read_summary (sum_file):
+    # the vitals summary as Summary.read() loads it from a .sum file
+    df = pd.read_hdf(sum_file, key='/Vitals_summary')
+    return df.dropna(axis='columns', how='all').drop(drop_cols, axis='columns', errors='ignore')
+
+def decimate (df, points=max_points):
+    # (mean, min, max) frames of at most points rows: consecutive rows averaged in bins of equal size
+    if len(df) <= points:
+        return df, df, df
+    per_bin = -(-len(df) // points)
+    groups = df.groupby(np.arange(len(df)) // per_bin)
+    index = df.index[::per_bin]
+    out = []
+    for agg in [groups.mean(), groups.min(), groups.max()]:
+        agg.index = index
+        out.append(agg)
+    return tuple(out)
+
+def render_page (job):
+    # worker: render one summary to a PNG page
+    # returns (sum_file, png, source stamp, seconds, error message)
+    sum_file, png, stamp, points, dpi = job
+    t0 = time.time()
+    try:
+        mean, lo, hi = decimate(read_summary(sum_file), points)
+        cols = list(mean.columns)
+        fig, axes = plt.subplots(max(len(cols), 1), 1, sharex=True, figsize=page_size, squeeze=False)
+        for ax, col in zip(axes[:, 0], cols):
+            if hi is not mean:
+                ax.fill_between(mean.index, lo[col].values, hi[col].values, color='C0', alpha=0.3, linewidth=0)
+            ax.plot(mean.index, mean[col].values, color='C0', linewidth=0.8)
+            ax.set_ylabel(col, fontsize=8)
+            ax.tick_params(labelsize=7)
+        axes[0, 0].set_title(str(sum_file))
+        fig.autofmt_xdate()
+        fig.savefig(png, dpi=dpi)
+        plt.close(fig)
+        return sum_file, png, stamp, time.time() - t0, None
+    except Exception as e:
+        plt.close('all')
+        return sum_file, png, stamp, time.time() - t0, '{}: {}'.format(type(e).__name__, e)
+
+def source_stamp (sum_file):
+    st = os.stat(sum_file)
+    return [st.st_size, st.st_mtime]
+
+def load_manifest (pages):
+    path = os.path.join(pages, 'pages.json')
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest (pages, manifest):
+    # write then rename so an interrupted run never leaves a truncated manifest
+    path = os.path.join(pages, 'pages.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+def merge_pages (outfile, pngs):
+    # one PDF page per PNG, in the given order
+    with PdfPages(outfile) as pdf:
+        for png in pngs:
+            img = plt.imread(png)
+            fig = plt.figure(figsize=page_size)
+            ax = fig.add_axes([0, 0, 1, 1])
+            ax.imshow(img)
+            ax.axis('off')
+            pdf.savefig(fig)
+            plt.close(fig)
+
+def make_report (outfile, spath='./*.sum', workers=4, full=False, points=max_points, dpi=100):
+    files = sorted(glob.glob(spath))
+    pages = page_dir(outfile)
+    if not os.path.isdir(pages):
+        os.makedirs(pages)
+    manifest = {} if full else load_manifest(pages)
+
+    jobs = []
+    for f in files:
+        png = os.path.join(pages, page_name(f))
+        stamp = source_stamp(f)
+        entry = manifest.get(f)
+        if entry is None or entry['stamp'] != stamp or not os.path.isfile(entry['png']):
+            jobs.append((f, png, stamp, points, dpi))
+    print ('{} summaries, {} pages to render with {} workers ({} unchanged)'.format(len(files), len(jobs), workers, len(files)-len(jobs)))
+
+    t0 = time.time()
+    done = 0
+    errors = 0
+    if jobs:
+        with Pool(processes=workers) as pool:
+            for sum_file, png, stamp, secs, err in pool.imap_unordered(render_page, jobs):
+                done += 1
+                if err is not None:
+                    errors += 1
+                    manifest.pop(sum_file, None)
+                    print ('[{}/{}] Error rendering {}: {}'.format(done, len(jobs), sum_file, err))
+                else:
+                    manifest[sum_file] = {'png': png, 'stamp': stamp}
+                    elapsed = time.time() - t0
+                    print ('[{}/{}] {} ({:0.1f} s) | {:0.1f} pages/s, about {:0.0f} s left'.format(
+                        done, len(jobs), sum_file, secs, done/elapsed, (len(jobs)-done)*elapsed/done))
+                save_manifest(pages, manifest)
+    # summaries that were removed since the last run drop out of the manifest
+    manifest = {f: manifest[f] for f in files if f in manifest}
+    save_manifest(pages, manifest)
+
+    merge_pages(outfile, [manifest[f]['png'] for f in files if f in manifest])
+    print ('Wrote {} pages to {} ({} rendered, {} errors) in {:0.1f} s'.format(
+        len(manifest), outfile, done-errors, errors, time.time()-t0))
+
+def main ():
+    parser = argparse.ArgumentParser(description='Render the cohort summary PDF in parallel from decimated data')
+    parser.add_argument('outfile', help='output PDF')
+    parser.add_argument('--path', default='./*.sum', help='glob for the .sum summary files')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes')
+    parser.add_argument('--full', action='store_true', help='render every page again, not just changed summaries')
+    parser.add_argument('--max-points', type=int, default=max_points, help='bins per trend')
+    parser.add_argument('--dpi', type=int, default=100, help='page resolution')
+    args = parser.parse_args()
+    make_report(args.outfile, args.path, workers=args.workers, full=args.full, points=args.max_points, dpi=args.dpi)
+
+if __name__ == "__main__":
+
+    main ()
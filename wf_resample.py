@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_resample.py
+
+Whole record resampling stage, cached once per record / channel / rate
+
+Rate conversions used to happen once per segment: wabp_wrap.m resampled every 240 Hz ABP segment to the 125 Hz the
+wfdb functions (wabp, abpfeature, jSQI) expect. Here a channel is resampled for the whole record with
+scipy.signal.resample_poly, one contiguous run at a time (the filter never bridges a gap), and the result is kept
+in cache_dir next to the file metadata, so each conversion is done once per record whatever the segmentation,
+level or selection:
+
+    rs = cached(filename, 'AR1', wabp_Fs)      # AR1 at 125 Hz, or None if the cache hasn't been built
+    rs.rows(start_row, stop_row)                # the samples covering record rows start_row:stop_row
+    rs.row_values(start_row, stop_row)          # at the record rate: exactly one value per record row
+
+Caches are built in a pass over the file, never as a side effect of processing a segment. ChannelBuilder takes
+consecutive chunks of record rows and resamples them in blocks of block samples, each with pad samples of overlap
+on both sides (more than the filter half length, and a multiple of the decimation factor) so the blocks join into
+exactly the whole run result; the output goes straight to a memory mapped .npy file. Only a block plus its overlap
+is held per channel, so memory does not depend on the recording length. The builders are fed by the channel
+profile pass (wf_profile.profile_file reads the pressure columns anyway), and precompute() reads just the missing
+columns for files that were profiled earlier:
+
+    python wf_resample.py case.hd5 [--channels AR1 AR2] [--max-memory 512]
+
+Without a cache the viewer converts each segment on its own (convert()), and slower channels are brought to the
+record rate from the rows that were read (fill_rows()).
+
+The source rate of a channel comes from wf_meta (FileMeta.channel_Fs). A channel sampled slower than the table
+(mixed rate files, eg 125 Hz pressure in a 250 Hz table) sits on every k-th row; it is taken from those rows and
+brought to the record rate with row_values, which Waveform uses when reading so every column has one sample per
+row. Missing input samples are interpolated across for the filter and marked missing (NaN) again afterwards.
+
+"""
+
+import os
+import os.path
+import time
+import argparse
+from fractions import Fraction
+
+import numpy as np
+import pandas as pd
+from scipy import signal
+
+import wf_meta
+
+wabp_Fs = 125          # rate the wfdb ABP functions expect
+read_chunk = 1000000   # rows per chunk when reading a channel (without a memory budget)
+block_overhead = 4     # float64 working copies per input sample while a block is resampled
+
+_resampled = {}   # in-process cache: (filename, channel, Fs) -> ResampledChannel
+
+
+def rate_ratio (Fs_from, Fs_to):
+    # (up, down) integers for resample_poly
+    r = Fraction(float(Fs_to) / float(Fs_from)).limit_denominator(1000)
+    return r.numerator, r.denominator
+
+def _fill_missing (x):
+    # interpolate across NaNs so they don't spread through the filter; returns (filled, missing mask)
+    missing = np.isnan(x)
+    if missing.all():
+        return np.zeros_like(x), missing
+    if missing.any():
+        x = x.copy()
+        x[missing] = np.interp(np.flatnonzero(missing), np.flatnonzero(~missing), x[~missing])
+    return x, missing
+
+def convert (x, Fs_from, Fs_to):
+    # resample one contiguous float array, keeping missing samples missing
+    if float(Fs_from) == float(Fs_to) or len(x) == 0:
+        return np.asarray(x, dtype=np.float64)
+    up, down = rate_ratio(Fs_from, Fs_to)
+    x, missing = _fill_missing(np.asarray(x, dtype=np.float64))
+    y = signal.resample_poly(x, up, down)
+    if missing.any():
+        y[missing[np.minimum(np.arange(len(y)) * down // up, len(x) - 1)]] = np.nan
+    return y
+
+def fill_rows (x, stride, Fs_from, Fs_to):
+    # one value per row from a channel with a sample on every stride-th row of x, without a cache
+    # (the filter only sees these rows, so the ends differ slightly from the whole record result)
+    x = np.asarray(x, dtype=np.float64)
+    ok = np.flatnonzero(~np.isnan(x[:stride]))
+    p = int(ok[0]) if len(ok) else 0
+    y = convert(x[p::stride], Fs_from, Fs_to)
+    out = np.full(len(x), np.nan)
+    n = max(min(len(y), len(x) - p), 0)
+    out[p:p + n] = y[:n]
+    return out
+
+def channel_stride (meta, channel):
+    # rows per sample of a channel (1 at the record rate)
+    source_Fs = float(meta.channel_Fs.get(channel, meta.Fs))
+    step = meta.Fs / source_Fs
+    stride = int(round(step))
+    if stride < 1 or abs(step - stride) > 1e-6:
+        raise Exception('{}: {} Hz channel {} in a {} Hz table - the table rate must be a multiple of the channel rate'.format(
+            meta.filename, source_Fs, channel, meta.Fs))
+    return stride
+
+def cache_paths (filename, channel, Fs):
+    # (values .npy, run index .npz) of a channel's cache
+    name = 'rs.{}.{:g}'.format(channel, float(Fs))
+    return wf_meta.cache_path(filename, name + '.npy'), wf_meta.cache_path(filename, name + '.npz')
+
+def block_rows (max_memory_mb=None, channels=1):
+    # rows read (and input samples resampled) at a time for a memory budget
+    if not max_memory_mb:
+        return read_chunk
+    return max(int(max_memory_mb * 1e6 / (max(channels, 1) * 8 * block_overhead)), 10000)
+
+
+class ResampledChannel:
+
+    def __init__ (self, filename, channel, Fs):
+        self.filename = filename
+        self.channel = channel
+        self.Fs = float(Fs)
+        self.meta = wf_meta.get_meta(filename)
+        self.source_Fs = float(self.meta.channel_Fs.get(channel, self.meta.Fs))
+        self.values_path, self.index_path = cache_paths(filename, channel, Fs)
+        self.ready = self.load()
+
+    def load (self):
+        # use the cached arrays unless the case file has changed since they were written
+        mtime = os.path.getmtime(self.filename)
+        for path in [self.values_path, self.index_path]:
+            if not os.path.isfile(path) or os.path.getmtime(path) < mtime:
+                return False
+        with np.load(self.index_path, allow_pickle=False) as cached:
+            self.run_out = cached['run_out']
+            self.phase = cached['phase']
+        self.values = np.load(self.values_path, mmap_mode='r')
+        return len(self.phase) == len(self.meta.runs)
+
+    def _runs (self, start_row, stop_row):
+        # (run number, first row, last row + 1) of the runs overlapping start_row:stop_row
+        runs = self.meta.runs
+        k = max(int(np.searchsorted(runs[:, 0], start_row, side='right')) - 1, 0)
+        while k < len(runs) and runs[k][0] < stop_row:
+            yield k, int(runs[k][0]), int(runs[k][1])
+            k += 1
+
+    def rows (self, start_row, stop_row):
+        # samples at Fs covering record rows start_row:stop_row (joined across runs)
+        out = []
+        for k, r0, r1 in self._runs(start_row, stop_row):
+            a, b = max(start_row, r0), min(stop_row, r1)
+            lo, hi = self.run_out[k], self.run_out[k + 1]
+            # output sample j of a run is at record row r0 + phase + j * record Fs / Fs
+            ia = lo + int(np.ceil((a - r0 - self.phase[k]) * self.Fs / self.meta.Fs - 1e-9))
+            ib = lo + int(np.ceil((b - r0 - self.phase[k]) * self.Fs / self.meta.Fs - 1e-9))
+            out.append(self.values[max(ia, lo):min(ib, hi)])
+        return np.concatenate(out) if out else np.zeros(0, dtype=np.float32)
+
+    def row_values (self, start_row, stop_row):
+        # at the record rate: one value per record row start_row:stop_row (NaN where the channel has no sample)
+        if self.Fs != self.meta.Fs:
+            raise Exception('row_values needs the record rate ({} Hz), not {} Hz'.format(self.meta.Fs, self.Fs))
+        out = np.full(stop_row - start_row, np.nan, dtype=np.float32)
+        for k, r0, r1 in self._runs(start_row, stop_row):
+            a, b = max(start_row, r0), min(stop_row, r1)
+            lo, hi = self.run_out[k], self.run_out[k + 1]
+            j0, j1 = a - r0 - self.phase[k], b - r0 - self.phase[k]
+            src = self.values[lo + max(j0, 0):min(lo + j1, hi)]
+            dst = a - start_row + max(-j0, 0)
+            out[dst:dst + len(src)] = src
+        return out
+
+
+class ChannelBuilder:
+    # builds the cache of one channel at one rate from consecutive chunks of record rows (feed), block by block
+
+    def __init__ (self, filename, channel, Fs, block=read_chunk):
+        self.filename = filename
+        self.channel = channel
+        self.Fs = float(Fs)
+        self.meta = wf_meta.get_meta(filename)
+        self.stride = channel_stride(self.meta, channel)
+        self.source_Fs = float(self.meta.channel_Fs.get(channel, self.meta.Fs))
+        self.up, self.down = rate_ratio(self.source_Fs, self.Fs)
+        # overlap: more than the resample_poly filter half length (10 * max(up, down) taps at the upsampled rate),
+        # in whole multiples of down so every block starts on the output grid of the whole run
+        half = 10 * max(self.up, self.down) / self.up
+        self.pad = self.down * int(np.ceil((half + 1) / self.down))
+        self.block = max(block // self.down, 1) * self.down
+        self.values_path, self.index_path = cache_paths(filename, channel, Fs)
+        # output length is at most ceil(samples * up / down) per run
+        samples = [-(-(int(r1) - int(r0)) // self.stride) for r0, r1 in self.meta.runs]
+        bound = sum(-(-n * self.up // self.down) for n in samples)
+        if not os.path.isdir(wf_meta.cache_dir):
+            os.makedirs(wf_meta.cache_dir)
+        self.out = np.lib.format.open_memmap(self.values_path + '.tmp', mode='w+', dtype=np.float32, shape=(max(bound, 1),))
+        self.pos = 0
+        self.run_out = [0]
+        self.phase = []
+        self.k = -1
+        self.t0 = time.time()
+
+    def _start_run (self, k):
+        if self.k >= 0:
+            self._finish_run()
+        self.k = k
+        self.buf = np.zeros(0)
+        self.left = 0            # samples at the start of buf that were already emitted (left overlap)
+        self.run_phase = None
+        self.next_row = None     # next record row holding a sample of the channel
+
+    def _take (self, row0, part):
+        # append the channel's samples in rows row0:row0+len(part) of the current run
+        if self.run_phase is None:
+            ok = np.flatnonzero(~np.isnan(part[:self.stride])) if self.stride > 1 else [0]
+            self.run_phase = int(ok[0]) if len(ok) else 0
+            self.next_row = row0 + self.run_phase
+        start = self.next_row - row0
+        samples = part[start::self.stride]
+        self.next_row = row0 + start + len(samples) * self.stride
+        self.buf = np.concatenate([self.buf, samples])
+        while len(self.buf) - self.left >= self.block + self.pad:
+            n = self.left + self.block
+            y = convert(self.buf[:n + self.pad], self.source_Fs, self.Fs)
+            self._emit(y[self.left * self.up // self.down:n * self.up // self.down])
+            self.buf = self.buf[n - self.pad:]
+            self.left = self.pad
+
+    def _emit (self, y):
+        self.out[self.pos:self.pos + len(y)] = y
+        self.pos += len(y)
+
+    def _finish_run (self):
+        y = convert(self.buf, self.source_Fs, self.Fs)
+        self._emit(y[self.left * self.up // self.down:])
+        self.run_out.append(self.pos)
+        self.phase.append(self.run_phase or 0)
+        self.buf = np.zeros(0)
+
+    def feed (self, row0, x):
+        # x: the channel's values for record rows row0:row0+len(x), following on from the previous chunk
+        x = np.asarray(x, dtype=np.float64)
+        runs = self.meta.runs
+        a, end = row0, row0 + len(x)
+        while a < end:
+            k = int(np.searchsorted(runs[:, 0], a, side='right')) - 1
+            if k != self.k:
+                self._start_run(k)
+            b = min(end, int(runs[k][1]))
+            self._take(a, x[a - row0:b - row0])
+            a = b
+
+    def finish (self):
+        # write the cache (the values file and its run index replace any older ones together)
+        if self.k >= 0:
+            self._finish_run()
+        if len(self.phase) != len(self.meta.runs):
+            raise Exception('{}: {} fed {} of {} runs'.format(self.filename, self.channel, len(self.phase), len(self.meta.runs)))
+        self.out.flush()
+        del self.out
+        np.savez(self.index_path + '.tmp.npz', run_out=np.array(self.run_out, dtype=np.int64), phase=np.array(self.phase, dtype=np.int64))
+        os.replace(self.values_path + '.tmp', self.values_path)
+        os.replace(self.index_path + '.tmp.npz', self.index_path)
+        print ('Resampled {} of {} from {:g} to {:g} Hz in {:0.1f} s'.format(
+            self.channel, self.filename, self.source_Fs, self.Fs, time.time()-self.t0))
+
+
+def cached (filename, channel, Fs):
+    # the cached resampling of a channel, or None if it hasn't been built (see precompute) - never builds it
+    key = (filename, channel, float(Fs))
+    if key not in _resampled:
+        rs = ResampledChannel(filename, channel, Fs)
+        if not rs.ready:
+            return None
+        _resampled[key] = rs
+    return _resampled[key]
+
+def targets (filename, columns, wabp_channels=()):
+    # (channel, Fs) caches processing a file uses: wabp_channels at wabp_Fs, slower channels at the record rate
+    meta = wf_meta.get_meta(filename)
+    out = []
+    if meta.Fs != wabp_Fs:
+        out += [(c, float(wabp_Fs)) for c in columns if c in wabp_channels]
+    out += [(c, meta.Fs) for c in columns if float(meta.channel_Fs.get(c, meta.Fs)) != meta.Fs]
+    return out
+
+def builders (filename, wanted, block=read_chunk):
+    # ChannelBuilders for the (channel, Fs) caches in wanted that aren't built yet
+    out = []
+    for channel, Fs in wanted:
+        if cached(filename, channel, Fs) is not None:
+            continue
+        try:
+            out.append(ChannelBuilder(filename, channel, Fs, block=block))
+        except Exception as e:
+            print ('Not resampling {} of {}: {}'.format(channel, filename, e))
+    return out
+
+def feed_all (todo, row0, chunk):
+    # one chunk of /Waveforms rows (starting at record row row0) to every builder
+    for b in todo:
+        b.feed(row0, chunk[b.channel].to_numpy(dtype=np.float64))
+
+def finish_all (todo):
+    for b in todo:
+        b.finish()
+
+def precompute (filename, wabp_channels=(), max_memory_mb=None):
+    # build the missing caches of a file in one chunked pass over just the columns they need
+    columns = pd.read_hdf(filename, 'Waveforms', start=0, stop=1).columns
+    wanted = targets(filename, columns, wabp_channels)
+    rows = block_rows(max_memory_mb, len(wanted))
+    todo = builders(filename, wanted, block=rows)
+    if not todo:
+        return []
+    chans = sorted(set(b.channel for b in todo))
+    row0 = 0
+    for chunk in pd.read_hdf(filename, 'Waveforms', columns=chans, chunksize=rows):
+        feed_all(todo, row0, chunk)
+        row0 += len(chunk)
+    finish_all(todo)
+    return [(b.channel, b.Fs) for b in todo]
+
+def main ():
+    parser = argparse.ArgumentParser(description='Build the whole record resampling caches of case files')
+    parser.add_argument('filenames', nargs='+', help='converted hdf5 case files')
+    parser.add_argument('--channels', nargs='*', default=['AR1', 'AR2', 'AR3'], help='ABP channels to resample to {} Hz'.format(wabp_Fs))
+    parser.add_argument('--max-memory', type=float, default=None, help='memory budget in MB')
+    args = parser.parse_args()
+    for filename in args.filenames:
+        built = precompute(filename, args.channels, args.max_memory)
+        print ('{}: {}'.format(filename, ', '.join('{} at {:g} Hz'.format(c, Fs) for c, Fs in built) or 'nothing to build'))
+
+if __name__ == "__main__":
+
+    main ()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_serve.py
+
+Run the annotation app (wf_explore.py) on a Bokeh server with a Prometheus /metrics route
+
+`bokeh serve` has no way to add HTTP routes, so this starts the same server programmatically with an extra tornado
+handler that returns wf_metrics.render(). The app runs in the same process, so the metrics are the ones its
+callbacks and processing stages record.
+
+    Usage: python wf_serve.py workflow.db [--port 5006] [--allow-websocket-origin host:port]
+
+    app:      http://localhost:5006/wf_explore
+    metrics:  http://localhost:5006/metrics
+
+"""
+
+import os.path
+import argparse
+
+from tornado.web import RequestHandler
+from bokeh.server.server import Server
+from bokeh.application import Application
+from bokeh.application.handlers import ScriptHandler
+
+import wf_metrics
+
+app_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wf_explore.py')
+
+
+class MetricsHandler (RequestHandler):
+
+    def get (self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(wf_metrics.render())
+
+
+def main ():
+    parser = argparse.ArgumentParser(description='Serve wf_explore.py with a Prometheus /metrics endpoint')
+    parser.add_argument('db_file', help='workflow sqlite DB')
+    parser.add_argument('--port', type=int, default=5006)
+    parser.add_argument('--allow-websocket-origin', action='append', default=None,
+                        help='host[:port] allowed to connect (default localhost:<port>)')
+    args = parser.parse_args()
+
+    app = Application(ScriptHandler(filename=app_file, argv=[args.db_file]))
+    origins = args.allow_websocket_origin or ['localhost:{}'.format(args.port)]
+    server = Server({'/wf_explore': app}, port=args.port, allow_websocket_origin=origins,
+                    extra_patterns=[('/metrics', MetricsHandler)])
+    server.start()
+    print ('Serving http://localhost:{0}/wf_explore (metrics at http://localhost:{0}/metrics)'.format(args.port))
+    server.io_loop.start()
+
+if __name__ == "__main__":
+
+    main ()
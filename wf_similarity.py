@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_similarity.py
+
+Nearest-neighbour index over wavelet energy features ("show me segments that look like this one")
+
+Collects the per-segment feature vectors written by wf_batch.py (features table: cA8, cD3-cD8, MAP, HR)
+into a single standardized float32 matrix and answers top-k queries against it. The wavelet levels cover different
+bands at different record rates, so an index only holds segments of one rate (Fs, default wf_meta.default_Fs).
+
+    - small catalogs (< brute_max rows) are searched brute force with one BLAS matrix-vector product
+    - larger catalogs use a sklearn KDTree (the feature space is only 9-dimensional)
+
+Usage:
+    idx = FeatureIndex.from_db('workflow.db', Fs=wf.Fs)
+    idx.query_segment(path, seg, channel, k=10)     # DataFrame of file/channel/seg/distance
+    idx.query(wvt.wltFeatures.loc[N], k=10, exclude=idx.locate(path, None, channel, start_time=wf.seg_start_time[N]))
+
+"""
+
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+
+import wf_meta
+import wf_file_management as wfm
+
+id_cols = ['entry', 'file', 'channel', 'seg', 'seg_start_time']
+
+
+class FeatureIndex:
+    brute_max = 50000   # above this many rows a KDTree is built instead of brute force search
+
+    def __init__ (self, features, meta):
+        # features: (n, len(feature_cols)) array of raw feature values, meta: DataFrame of id_cols
+        X = np.asarray(features, dtype=np.float64)
+        self.mean = np.nanmean(X, axis=0)
+        self.std = np.nanstd(X, axis=0)
+        self.std[~(self.std > 0)] = 1.0
+        self.mean[np.isnan(self.mean)] = 0.0
+        self.X = self._scale(X)
+        self.meta = meta.reset_index(drop=True)
+        self.sqnorm = np.einsum('ij,ij->i', self.X, self.X)
+        self.tree = None
+        self.Fs = wf_meta.default_Fs   # record rate of the indexed segments (set by from_db)
+        if len(self.X) > FeatureIndex.brute_max:
+            self.tree = KDTree(self.X, leaf_size=40)
+        print ('Feature index built: {} segments, {} features, {}'.format(
+            self.X.shape[0], self.X.shape[1], 'KDTree' if self.tree is not None else 'brute force'))
+
+    @classmethod
+    def from_db (cls, db_file, channel=None, include_bad=False, Fs=wf_meta.default_Fs):
+        # read the processed segments recorded at Fs from the features table (rows without Fs are default_Fs)
+        db = sqlite3.connect(db_file)
+        wfm.ensure_columns(db, 'features', {'Fs':'FLOAT'})
+        sql = 'SELECT {} FROM features'.format(','.join(id_cols + wfm.feature_cols))
+        clauses = ['ABS(COALESCE(Fs, ?) - ?) <= ?']
+        params = [wf_meta.default_Fs, Fs, wf_meta.rate_tol * Fs]
+        if not include_bad:
+            clauses.append('bad = 0')
+        if channel is not None:
+            clauses.append('channel = ?')
+            params.append(channel)
+        sql += ' WHERE ' + ' AND '.join(clauses)
+        df = pd.read_sql(sql, db, params=params)
+        db.close()
+        if len(df) == 0:
+            raise Exception('No processed {:g} Hz segments in {} - run wf_batch.py first'.format(Fs, db_file))
+        index = cls(df[wfm.feature_cols].values, df[id_cols])
+        index.Fs = Fs
+        return index
+
+    def _scale (self, X):
+        # standardize and zero missing values (eg MAP for CVP channels) so they don't dominate distances
+        Z = (np.asarray(X, dtype=np.float64) - self.mean) / self.std
+        Z[np.isnan(Z)] = 0.0
+        return Z.astype(np.float32)
+
+    def query (self, features, k=10, exclude=None):
+        # features: one raw feature vector (Series with feature_cols or array in that order)
+        # returns a DataFrame of the k nearest segments, closest first
+        if isinstance(features, pd.Series):
+            features = features.reindex(wfm.feature_cols).values
+        q = self._scale(np.asarray(features, dtype=np.float64).reshape(1, -1))[0]
+        k_search = min(k + (1 if exclude is not None else 0), len(self.X))
+        t0 = time.time()
+        if self.tree is not None:
+            dist, idx = self.tree.query(q.reshape(1, -1), k=k_search)
+            dist, idx = dist[0], idx[0]
+        else:
+            d2 = self.sqnorm - 2.0 * (self.X @ q) + q @ q
+            idx = np.argpartition(d2, k_search - 1)[:k_search]
+            idx = idx[np.argsort(d2[idx])]
+            dist = np.sqrt(np.maximum(d2[idx], 0))
+        if exclude is not None:
+            keep = idx != exclude
+            idx, dist = idx[keep][:k], dist[keep][:k]
+        self.last_query_ms = (time.time() - t0) * 1000
+        res = self.meta.iloc[idx].copy()
+        res['distance'] = dist
+        return res.reset_index(drop=True)
+
+    def locate (self, path, seg, channel=None, start_time=None):
+        # row number of a segment in the index (or None)
+        # start_time: match on the segment start time instead of the number (the viewer numbers segments per selection)
+        if start_time is not None:
+            mask = (self.meta['file'] == path) & (self.meta['seg_start_time'] == str(start_time))
+        else:
+            mask = (self.meta['file'] == path) & (self.meta['seg'] == seg)
+        if channel is not None:
+            mask &= self.meta['channel'] == channel
+        rows = np.flatnonzero(mask.values)
+        return rows[0] if len(rows) else None
+
+    def query_segment (self, path, seg, channel=None, k=10):
+        # similar segments to one already in the index
+        row = self.locate(path, seg, channel)
+        if row is None:
+            raise KeyError('Segment {} of {} is not in the feature index'.format(seg, path))
+        q = self.X[row] * self.std + self.mean
+        return self.query(q, k=k, exclude=row)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_sources.py
+
+Helpers for feeding Bokeh ColumnDataSources from waveform DataFrames
+
+ColumnDataSource(df).data keeps the DatetimeIndex as datetime64 objects and float64 columns, which Bokeh
+converts and re-serializes on every update. The functions here build plain dicts of typed NumPy arrays
+instead (float64 epoch-ms times, float32 values) so Bokeh uses its binary array transport:
+
+    frame_to_columns(df)         -> dict of typed arrays for source.data
+    set_source(source, df)       -> replace source.data (logging payload size and time taken when verbose)
+    stream_frame(source, df)     -> append rows with source.stream (eg live data)
+    binned_image(df)             -> (features x time) float32 image for an image glyph, binned to a pixel budget
+
+Writing the same data as a JSON list payload (the old behaviour) costs more than the binary transport saves, so
+the comparison isn't made on updates; it is a one-off benchmark over rows of a case file:
+
+    python wf_sources.py case.hd5 [--rows 100000] [--repeats 5]
+
+"""
+
+import json
+import time
+import argparse
+import warnings
+from functools import wraps
+
+import numpy as np
+import pandas as pd
+
+import wf_metrics
+
+verbose = False   # print payload size and latency for every set_source / timed callback
+
+
+def time_to_ms (values):
+    # datetime-like array / index -> float64 milliseconds since epoch (what Bokeh datetime axes use)
+    values = pd.DatetimeIndex(values) if not isinstance(values, pd.DatetimeIndex) else values
+    return values.asi8.astype(np.float64) / 1e6
+
+def frame_to_columns (df, index_name=None, value_dtype=np.float32, aliases=()):
+    # DataFrame -> dict of typed NumPy arrays
+    # the index becomes a float64 epoch-ms column (named after the index, or 'index')
+    # numeric columns are cast to value_dtype, anything else is passed through as an object array
+    # aliases: extra names for the index column (eg 'DateTime' for glyphs expecting that field)
+    name = index_name or df.index.name or 'index'
+    data = {}
+    if isinstance(df.index, pd.DatetimeIndex):
+        data[name] = time_to_ms(df.index)
+    else:
+        data[name] = np.asarray(df.index)
+    for alias in aliases:
+        data[alias] = data[name]
+    for col in df.columns:
+        values = df[col].values
+        if np.issubdtype(values.dtype, np.datetime64):
+            data[str(col)] = time_to_ms(values)
+        elif np.issubdtype(values.dtype, np.number):
+            data[str(col)] = values.astype(value_dtype, copy=False)
+        else:
+            data[str(col)] = np.asarray(values, dtype=object)
+    return data
+
+def payload_bytes (data):
+    # bytes sent for a dict of columns: typed arrays go binary, everything else as JSON
+    total = 0
+    for v in data.values():
+        if isinstance(v, np.ndarray) and v.dtype != object:
+            total += v.nbytes
+        else:
+            total += len(json.dumps([str(x) for x in v]))
+    return total
+
+def json_payload_bytes (data):
+    # bytes the same columns take as a JSON list payload (datetimes and floats written out as text)
+    total = 0
+    for v in data.values():
+        if isinstance(v, np.ndarray) and v.dtype != object:
+            total += len(json.dumps(v.astype(np.float64).tolist()))
+        else:
+            total += len(json.dumps([str(x) for x in v]))
+    return total
+
+def set_source (source, df, name='source', **kwargs):
+    # replace source.data with typed columns built from df
+    t0 = time.time()
+    data = frame_to_columns(df, **kwargs) if isinstance(df, pd.DataFrame) else df
+    source.data = data
+    elapsed = time.time() - t0
+    if verbose:
+        print ('{}: {} rows, payload {:0.1f} kB binary, {:0.1f} ms'.format(
+            name, len(next(iter(data.values()), [])), payload_bytes(data)/1e3, elapsed*1000))
+    return data
+
+def stream_frame (source, df, rollover=None, **kwargs):
+    # append rows to a source, keeping at most rollover rows on the client
+    data = frame_to_columns(df, **kwargs)
+    data = {k: v for k, v in data.items() if k in source.data or len(source.data) == 0}
+    source.stream(data, rollover=rollover)
+    return data
+
+def binned_image (df, max_cols=1000):
+    # feature frame (one row per segment) -> (columns x time) float32 image, each feature min-max scaled
+    # more than max_cols rows are averaged server side into bins of equal size so the image stays within the
+    # pixel budget whatever the number of segments; returns (image, rows per bin)
+    X = df.to_numpy(dtype=np.float64)
+    n, m = X.shape
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)   # all-NaN columns / bins (rejected segments)
+        lo = np.nanmin(X, axis=0) if n else np.zeros(m)
+        hi = np.nanmax(X, axis=0) if n else np.zeros(m)
+        X = (X - lo) / np.where(hi > lo, hi - lo, 1)
+        per_bin = max(1, -(-n // max_cols))
+        if per_bin > 1:
+            X = np.concatenate([X, np.full((-n % per_bin, m), np.nan)])
+            X = np.nanmean(X.reshape(-1, per_bin, m), axis=1)
+    return np.ascontiguousarray(X.T, dtype=np.float32), per_bin
+
+def timed_callback (fn):
+    # wrap a Bokeh callback and report how long it took on the server (also recorded in wf_metrics)
+    @wraps(fn)
+    def wrapper (*args, **kwargs):
+        t0 = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.time() - t0
+            wf_metrics.histogram('wf_callback_seconds', 'Bokeh callback duration', callback=fn.__name__).observe(elapsed)
+            if verbose:
+                print ('{} callback: {:0.1f} ms'.format(fn.__name__, elapsed*1000))
+    return wrapper
+
+def benchmark_payload (df, repeats=5):
+    # typed array payload vs the old JSON list payload for the same frame: (kB, ms) of each
+    t0 = time.time()
+    for _ in range(repeats):
+        data = frame_to_columns(df)
+    binary_ms = (time.time() - t0) * 1000 / repeats
+    t0 = time.time()
+    for _ in range(repeats):
+        json_kb = json_payload_bytes(data) / 1e3
+    json_ms = (time.time() - t0) * 1000 / repeats
+    return {'binary_kB': payload_bytes(data) / 1e3, 'binary_ms': binary_ms, 'json_kB': json_kb, 'json_ms': json_ms}
+
+def main ():
+    parser = argparse.ArgumentParser(description='Compare the binary and JSON payloads of /Waveforms rows')
+    parser.add_argument('filename', help='converted hdf5 case file')
+    parser.add_argument('--rows', type=int, default=100000, help='rows to read')
+    parser.add_argument('--repeats', type=int, default=5, help='conversions to average over')
+    args = parser.parse_args()
+    df = pd.read_hdf(args.filename, 'Waveforms', start=0, stop=args.rows)
+    res = benchmark_payload(df, args.repeats)
+    print ('{} rows x {} columns: binary {:0.1f} kB in {:0.1f} ms, JSON {:0.1f} kB in {:0.1f} ms'.format(
+        len(df), len(df.columns), res['binary_kB'], res['binary_ms'], res['json_kB'], res['json_ms']))
+
+if __name__ == "__main__":
+
+    main ()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_spectral.py
+
+Batched spectral and morphology features for segments
+
+The segments of a Waveform / ABPWavelet / CVPWavelet are stacked into one (segments x samples) matrix per channel
+and every feature is computed for all segments at once (one scipy.signal.welch call per channel, the rest are
+NumPy reductions along the sample axis):
+
+    <prefix>_bp_<band>      Welch PSD band power (trapezoid over the band)
+    <prefix>_sp_entropy     normalized spectral entropy (0 = a single spectral line, 1 = white)
+    <prefix>_dom_freq       dominant frequency (Hz, DC excluded)
+    <prefix>_skew           skewness
+    <prefix>_kurt           excess kurtosis
+    <prefix>_zcr            zero crossings of the mean removed signal per second
+
+prefix is 'wf' for the segmented pressure channel and 'ecg' for lead II, so ABP and CVP rows share the same columns.
+Rejected segments (Waveform.rejected) get NaN like their wavelet energies.
+
+    wf_spectral.join_features(wvt)   # adds the columns to wvt.wltFeatures (and keeps them in wvt.spectral)
+
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import signal, stats
+
+import wf_meta
+
+wf_bands = {'resp': (0.1, 0.5), 'card': (0.5, 3.5), 'harm': (3.5, 10.0), 'hf': (10.0, 40.0)}
+ecg_bands = {'low': (0.5, 5.0), 'qrs': (5.0, 15.0), 'hf': (15.0, 40.0)}
+channel_prefix = [('wf', wf_bands), ('ecg', ecg_bands)]
+nperseg = 1024   # Welch window (samples), about 4 s at 240 Hz - resolves the respiratory band
+
+
+def spectral_columns ():
+    # names of all feature columns, in output order
+    cols = []
+    for prefix, bands in channel_prefix:
+        cols += ['{}_bp_{}'.format(prefix, b) for b in bands]
+        cols += ['{}_{}'.format(prefix, f) for f in ['sp_entropy', 'dom_freq', 'skew', 'kurt', 'zcr']]
+    return cols
+
+def column_types ():
+    # sqlite types for ensure_columns
+    return {c: 'FLOAT' for c in spectral_columns()}
+
+def segment_matrix (segments, channel):
+    # stack channel values of equal length segments ({N: DataFrame}) into an (nseg, section_size) float64 array
+    keys = sorted(segments)
+    if not keys:
+        return keys, np.zeros((0, 0))
+    return keys, np.stack([np.asarray(segments[k][channel].values, dtype=np.float64) for k in keys])
+
+def matrix_features (X, Fs, bands, prefix):
+    # all features for one channel: X is (nseg, samples)
+    n, L = X.shape
+    out = {}
+    f, P = signal.welch(X, fs=Fs, nperseg=min(nperseg, L), axis=-1, detrend='constant')
+    for band, (lo, hi) in bands.items():
+        sel = (f >= lo) & (f < hi)
+        out['{}_bp_{}'.format(prefix, band)] = np.trapz(P[:, sel], f[sel], axis=1) if sel.sum() > 1 else np.zeros(n)
+    total = P.sum(axis=1, keepdims=True)
+    p = np.divide(P, total, out=np.zeros_like(P), where=total > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        H = -np.where(p > 0, p * np.log2(p), 0).sum(axis=1)
+    out['{}_sp_entropy'.format(prefix)] = H / np.log2(P.shape[1])
+    out['{}_dom_freq'.format(prefix)] = f[1:][np.argmax(P[:, 1:], axis=1)]
+    out['{}_skew'.format(prefix)] = stats.skew(X, axis=1)
+    out['{}_kurt'.format(prefix)] = stats.kurtosis(X, axis=1)
+    centered = X - X.mean(axis=1, keepdims=True)
+    crossings = (np.signbit(centered[:, 1:]) != np.signbit(centered[:, :-1])).sum(axis=1)
+    out['{}_zcr'.format(prefix)] = crossings * Fs / L
+    return out
+
+def segment_features (wf):
+    # spectral / morphology features for every segment of a segmented Waveform (or Wavelet) object
+    Fs = getattr(wf, 'Fs', wf_meta.default_Fs)
+    keys = sorted(wf.segments)
+    df = pd.DataFrame(index=keys, columns=spectral_columns(), dtype=np.float64)
+    if not keys:
+        return df
+    for (prefix, bands), channel in zip(channel_prefix, [wf.seg_channel, 'II']):
+        if channel not in wf.segments[keys[0]].columns:
+            continue
+        keys, X = segment_matrix(wf.segments, channel)
+        for col, values in matrix_features(X, Fs, bands, prefix).items():
+            df[col] = values
+    rejected = [k for k in getattr(wf, 'rejected', []) if k in df.index]
+    df.loc[rejected] = np.nan
+    return df
+
+def join_features (wvt):
+    # join the spectral features onto wltFeatures (replacing any earlier copy)
+    wvt.spectral = segment_features(wvt)
+    wvt.wltFeatures = wvt.wltFeatures.drop(spectral_columns(), axis=1, errors='ignore').join(wvt.spectral)
+    return wvt.wltFeatures
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wf_stream.py
+
+Live ingest of /Waveforms rows with rolling segmentation
+
+A source yields chunks of /Waveforms rows as they arrive:
+
+    ReplaySource(filename)      replays a converted case file at its record rate (wf_meta, eg 240 Hz) in real time
+                                (or speed x real time), a stand-in for a bedside feed
+    TailSource(filename)        follows a case file that another process is appending to
+
+LiveStream runs the source on an ingest thread that writes each chunk into a ring buffer (float32 samples plus the
+int64 timestamps). Every time section_size new samples are in the buffer a segment thread cuts them out and runs
+them through the same clean/segment/quality/features/wavelet stages as the viewer (Waveform.read_frame and
+wf_incremental.process_segments), so a new segment's results are available one section (26.7 s at level 8) after
+its first sample plus the processing time. Segments are anchored to the first streamed sample, the same way the
+grid of wf_meta anchors them to the start of a run; a timestamp gap inside a segment marks it bad_time.
+
+The consumer (wf_live.py) drains the new samples and segment results with pop_samples() / pop_segments() and
+pushes them to the browser with source.stream. Arrival times are kept with every chunk so the end to end lag
+(sample arrival -> sent to the browser) can be measured; it is recorded in wf_metrics as wf_stream_lag_seconds.
+
+    stream = LiveStream(ReplaySource('case.hd5'), 'AR1', level=8)
+    stream.start()
+    ...
+    waves, lag = stream.pop_samples()      # new rows since the last call
+    segments = stream.pop_segments()       # list of per segment results (see wf_incremental.process_segments)
+    stream.stop()
+
+TailSource reads the table while it is written, which HDF5 only supports safely for a writer that flushes after
+each append (PyTables has no single-writer/multiple-reader mode); a read that catches the file mid-write fails and
+is retried at the next poll.
+
+"""
+
+import time
+import threading
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+import wf_meta
+import wf_metrics
+import wf_incremental
+
+chunk_secs = 0.1     # replay chunk length: one chunk per 100 ms keeps the display lag well under a second
+poll_secs = 0.2      # TailSource polling interval
+read_block = 24000   # rows read from the case file at a time when replaying
+
+
+class ReplaySource:
+
+    def __init__ (self, filename, start_row=0, speed=1.0, loop=False):
+        # speed: replay rate relative to real time; loop: start again from start_row at the end of the file
+        self.filename = filename
+        self.name = 'replay:{}'.format(filename)
+        self.start_row = start_row
+        self.speed = speed
+        self.Fs = wf_meta.get_meta(filename).Fs
+        self.loop = loop
+        self.chunk_rows = max(1, int(round(self.Fs * chunk_secs)))
+        with pd.HDFStore(filename, mode='r') as store:
+            self.nrows = store.get_storer('Waveforms').nrows
+
+    def chunks (self, stopped):
+        # yield DataFrames of chunk_rows rows, paced so row n is released n/(Fs*speed) s after the first
+        t0 = time.time()
+        sent = 0
+        row = self.start_row
+        while not stopped.is_set():
+            if row >= self.nrows:
+                if not self.loop:
+                    return
+                row = self.start_row
+            block = pd.read_hdf(self.filename, 'Waveforms', start=row, stop=min(row + read_block, self.nrows))
+            row += len(block)
+            for a in range(0, len(block), self.chunk_rows):
+                chunk = block.iloc[a:a + self.chunk_rows]
+                wait = t0 + (sent + len(chunk)) / (self.Fs * self.speed) - time.time()
+                if wait > 0 and stopped.wait(wait):
+                    return
+                sent += len(chunk)
+                yield chunk
+
+
+class TailSource:
+
+    def __init__ (self, filename, start_row=None, poll=poll_secs, Fs=None):
+        # start_row: first row to stream (default: rows appended after the source is opened)
+        # Fs: sample rate of the feed (default: the rate of the rows already in the file)
+        self.filename = filename
+        self.name = 'tail:{}'.format(filename)
+        self.poll = poll
+        self.row = start_row
+        self.Fs = Fs or wf_meta.get_meta(filename).Fs
+
+    def _nrows (self):
+        with pd.HDFStore(self.filename, mode='r') as store:
+            return store.get_storer('Waveforms').nrows
+
+    def chunks (self, stopped):
+        # yield the rows appended since the last poll
+        if self.row is None:
+            self.row = self._nrows()
+        while not stopped.wait(self.poll):
+            try:
+                nrows = self._nrows()
+                if nrows > self.row:
+                    chunk = pd.read_hdf(self.filename, 'Waveforms', start=self.row, stop=nrows)
+                    self.row += len(chunk)
+                    yield chunk
+            except (OSError, KeyError, ValueError) as e:
+                # the writer is part way through an append - try again at the next poll
+                print ('Tail of {}: read failed ({}), retrying'.format(self.filename, e))
+
+
+class RingBuffer:
+    # the last capacity samples of every channel, addressed by absolute sample number (0 = first streamed sample)
+
+    def __init__ (self, capacity, columns):
+        self.capacity = capacity
+        self.columns = list(columns)
+        self.values = np.zeros((capacity, len(self.columns)), dtype=np.float32)
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.written = 0   # samples appended so far
+
+    def append (self, df):
+        X = df.reindex(columns=self.columns).to_numpy(dtype=np.float32)
+        T = df.index.asi8
+        if len(X) > self.capacity:
+            X, T = X[-self.capacity:], T[-self.capacity:]
+            self.written += len(df) - self.capacity
+        pos = np.arange(self.written, self.written + len(X)) % self.capacity
+        self.values[pos] = X
+        self.times[pos] = T
+        self.written += len(X)
+
+    def oldest (self):
+        return max(0, self.written - self.capacity)
+
+    def take (self, start, stop):
+        # samples start:stop as a DataFrame (they must still be in the buffer)
+        if start < self.oldest() or stop > self.written:
+            raise IndexError('samples {}:{} not in the buffer ({}:{})'.format(start, stop, self.oldest(), self.written))
+        pos = np.arange(start, stop) % self.capacity
+        return pd.DataFrame(self.values[pos], columns=self.columns, index=pd.DatetimeIndex(self.times[pos]))
+
+
+class LiveStream:
+
+    def __init__ (self, source, channel, level=8, compact=True, buffer_sections=4):
+        self.source = source
+        self.channel = channel.split('-')[0]
+        self.level = level
+        self.compact = compact
+        self.section_size = wf_meta.section_size(level, source.Fs)
+        self.buffer_sections = buffer_sections
+        self.wf_class, self.wvt_class = wf_incremental.pipeline_classes(self.channel)
+        self.ring = None
+        self.next_segment = 0          # first sample of the next segment to process
+        self.segment_count = 0
+        self.samples = deque()         # (chunk, arrival time) waiting for the display
+        self.segments = deque()        # per segment results waiting for the display
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.stopped = threading.Event()
+        self.threads = []
+        self.error = None
+
+    def start (self):
+        self.threads = [threading.Thread(target=self._ingest, daemon=True),
+                        threading.Thread(target=self._segment, daemon=True)]
+        for t in self.threads:
+            t.start()
+        print ('Streaming {} ({}, level {}, section {} samples)'.format(self.source.name, self.channel, self.level, self.section_size))
+
+    def stop (self):
+        self.stopped.set()
+        with self.ready:
+            self.ready.notify_all()
+        for t in self.threads:
+            t.join()
+
+    def _ingest (self):
+        try:
+            for chunk in self.source.chunks(self.stopped):
+                now = time.time()
+                with self.ready:
+                    if self.ring is None:
+                        # the first chunk fixes the channels; room for a few sections so a slow segment doesn't lose data
+                        self.ring = RingBuffer(self.buffer_sections * self.section_size + 1, chunk.columns)
+                    self.ring.append(chunk)
+                    self.samples.append((chunk, now))
+                    self.ready.notify_all()
+                wf_metrics.counter('wf_stream_samples_total', 'Samples ingested from the live stream').inc(len(chunk))
+        except Exception as e:
+            self.error = '{}: {}'.format(type(e).__name__, e)
+            print ('Stream {} stopped: {}'.format(self.source.name, self.error))
+        finally:
+            self.stopped.set()
+            with self.ready:
+                self.ready.notify_all()
+
+    def _segment (self):
+        # process each segment once its section_size samples (and one more, as for the grid) have arrived
+        while True:
+            with self.ready:
+                while not self.stopped.is_set() and (self.ring is None or self.ring.written < self.next_segment + self.section_size + 1):
+                    self.ready.wait()
+                if self.ring is None or self.ring.written < self.next_segment + self.section_size + 1:
+                    return
+                if self.next_segment < self.ring.oldest():
+                    # fell more than the buffer behind - skip to the oldest whole segment still buffered
+                    skip = -(-(self.ring.oldest() - self.next_segment) // self.section_size)
+                    print ('Segment processing behind the stream: skipping {} segments'.format(skip))
+                    self.next_segment += skip * self.section_size
+                    self.segment_count += skip
+                    continue
+                start = self.next_segment
+                waves = self.ring.take(start, start + self.section_size + 1)
+                arrived = time.time()
+            self._process(start, waves, arrived)
+            self.next_segment = start + self.section_size
+
+    def _process (self, start, waves, arrived):
+        wf = self.wf_class(level=self.level, seg_channel=self.channel, compact=self.compact)
+        wf.Fs = self.source.Fs
+        wf.read_frame(waves, pd.DataFrame(), (self.source.name, start, start + len(waves)))
+        try:
+            results = wf_incremental.process_segments(wf, self.wvt_class, keep_raw=False)
+        except Exception as e:
+            print ('Segment at sample {} failed: {}: {}'.format(start, type(e).__name__, e))
+            results = {}
+        lag = time.time() - arrived
+        wf_metrics.histogram('wf_stream_lag_seconds', 'Live stream lag', kind='segment').observe(lag)
+        with self.lock:
+            for i, result in results.items():
+                self.segment_count += 1
+                result = dict(result, seg=self.segment_count, seg_row=start + (i - 1) * self.section_size,
+                              time=waves.index[(i - 1) * self.section_size], lag=lag)
+                self.segments.append(result)
+
+    def pop_samples (self):
+        # rows that arrived since the last call as one DataFrame, and the lag of the oldest of them (s)
+        with self.lock:
+            chunks = list(self.samples)
+            self.samples.clear()
+        if not chunks:
+            return None, 0.0
+        lag = time.time() - chunks[0][1]
+        wf_metrics.histogram('wf_stream_lag_seconds', 'Live stream lag', kind='samples').observe(lag)
+        return pd.concat([c for c, _ in chunks]), lag
+
+    def pop_segments (self):
+        with self.lock:
+            out = list(self.segments)
+            self.segments.clear()
+        return out